@@ -15,10 +15,8 @@ from werkzeug.utils import secure_filename
 from zipfile import ZipFile
 from io import BytesIO
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import shortuuid
-import mercadopago
 import base64
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -35,6 +33,7 @@ from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from urllib.parse import urlencode, quote, unquote
 from google.cloud.firestore import ArrayUnion
+from google.api_core.exceptions import AlreadyExists
 from flask_talisman import Talisman
 from google.auth.transport.requests import Request
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
@@ -44,6 +43,33 @@ from correo_argentino import (
     validar_credenciales, crear_orden, cancelar_orden,
     obtener_rotulos, consultar_historial, obtener_sucursales
 )
+from catalogo import (
+    leer_catalogo, leer_cambios_catalogo, listar_productos,
+    reconstruir_catalogo, actualizar_productos_catalogo,
+    stock_canonico, asegurar_stock_canonico,
+    migrar_stock_canonico, normalizar_producto, version_catalogo
+)
+import click
+from cache_memoria import CacheLRU, SingleFlight
+from catalogo_caliente import CatalogoCaliente
+from compresion import serializar_json, precomprimir, elegir_codificacion
+from catalogo_r2 import PublicadorCatalogo, R2_CATALOGO_DEMORA_FRAGMENTOS_SEG
+from busqueda import IndicesBusqueda
+from facetas import IndiceFacetas, FACETAS
+from cola_trabajos import ColaSQLite, ejecutar_worker
+from escritura_lotes import EscritorLotes
+from clientes_mp import ClientesMP
+from stock import (
+    descontar_stock_orden, reservar_stock, liberar_reservas,
+    liberar_reservas_vencidas, iniciar_barrido_reservas
+)
+from precios import cargar_productos, cotizar_carrito
+from ordenes import completar_items_mp
+from pedidos import listar_pedidos, campos_busqueda_pedido, migrar_pedidos
+from ventas import registrar_venta, fecha_venta, leer_resumen_ventas
+from stock_fragmentado import (
+    PromotorFragmentos, con_stock_fragmentado, preparar_edicion_stock, iniciar_consolidacion_fragmentos
+)
 
 ##################
 # 🔐 Inicialización segura de Firebase con logs
@@ -70,9 +96,11 @@ if db:
         pass
 ####################
 # 🔑 Inicialización segura de Mercado Pago
+# Un SDK por access token, todos sobre la misma sesión HTTP con keep-alive
+clientes_mercadopago = ClientesMP()
 access_token = os.getenv("MERCADO_PAGO_TOKEN")
 if access_token and isinstance(access_token, str):
-    sdk = mercadopago.SDK(access_token.strip())
+    sdk = clientes_mercadopago.sdk(access_token)
 else:
     sdk = None
 ####################
@@ -222,6 +250,63 @@ ca_token_cache = {
 allowed_origins_cache = {}
 CACHE_TTL = 300
 
+# Caché en el edge (functions/_middleware.js) de las respuestas de /api/productos
+EDGE_S_MAXAGE = int(os.getenv("EDGE_S_MAXAGE", "300"))
+EDGE_STALE_WHILE_REVALIDATE = int(os.getenv("EDGE_STALE_WHILE_REVALIDATE", "600"))
+
+# Respuestas serializadas de /api/productos por vendedor: (({codificación: bytes}, etag), version del snapshot)
+cache_catalogo = CacheLRU(
+    max_bytes=int(os.getenv("CATALOGO_CACHE_BYTES", str(64 * 1024 * 1024))),
+    ttl=int(os.getenv("CATALOGO_CACHE_TTL", "30")),
+    stale_ttl=int(os.getenv("CATALOGO_CACHE_STALE_TTL", "300")),
+    medir=lambda valor: sum(len(cuerpo) for cuerpo in valor[0][0].values())
+)
+
+# Detalle de un producto por (vendedor, id_base): ((cuerpo_bytes, etag) o None si no existe, version del snapshot)
+cache_producto = CacheLRU(
+    max_bytes=int(os.getenv("PRODUCTO_CACHE_BYTES", str(16 * 1024 * 1024))),
+    ttl=int(os.getenv("CATALOGO_CACHE_TTL", "30")),
+    stale_ttl=int(os.getenv("CATALOGO_CACHE_STALE_TTL", "300")),
+    medir=lambda valor: len(valor[0][0]) if valor[0] else 64
+)
+
+# Versión del snapshot por vendedor. El worker de webhooks escribe el catálogo desde otro proceso, así que
+# cada hit de las cachés de arriba se compara con esta versión (releída como mucho cada pocos segundos)
+cache_versiones_catalogo = CacheLRU(
+    max_bytes=int(os.getenv("CATALOGO_VERSIONES_MAX", "10000")),
+    ttl=float(os.getenv("CATALOGO_VERSION_TTL", "2")),
+    medir=lambda valor: 1
+)
+
+# Cola durable (SQLite) entre el webhook de MP y el worker que procesa los pagos
+cola_webhooks = ColaSQLite()
+
+# Webhook de MP: tópicos que se procesan
+TOPICOS_WEBHOOK_MP = {"payment"}
+
+# Un solo rebuild en vuelo por (tipo, vendedor); las peticiones concurrentes esperan su resultado
+singleflight = SingleFlight()
+
+# Vendedores con mucho tráfico: catálogo en memoria alimentado por listeners de Firestore
+catalogo_caliente = CatalogoCaliente(db, al_cambiar=cache_catalogo.invalidar)
+
+# Copia estática del catálogo en R2 para que las tiendas no consulten a Flask en cada visita
+publicador_catalogo = PublicadorCatalogo(db, s3_client, os.getenv('R2_BUCKET_NAME'))
+
+# Libera periódicamente las reservas de stock de checkouts abandonados
+if db:
+    iniciar_barrido_reservas(db)
+
+# Productos con muchas ventas: el stock pasa a fragmentos y vuelve al documento cuando se enfrían
+promotor_fragmentos = PromotorFragmentos(db)
+if db:
+    iniciar_consolidacion_fragmentos(db, al_consolidar=lambda email, ids: update_products_last_modified(email, ids))
+
+# Índice invertido en memoria para /api/productos/buscar
+indices_busqueda = IndicesBusqueda(db)
+# Bitsets de talle/color/grupo/disponibilidad y precios ordenados para /api/productos/facetas
+indices_facetas = IndicesBusqueda(db, crear=IndiceFacetas)
+
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -351,7 +436,7 @@ def add_cors_headers(response):
         response.headers['Access-Control-Allow-Credentials'] = 'true'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
         response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-Vendor-Email'
-        response.headers['Access-Control-Expose-Headers'] = 'Content-Type, X-Vendor-Email'
+        response.headers['Access-Control-Expose-Headers'] = 'Content-Type, X-Vendor-Email, X-Catalogo-Version'
     return response
     
 
@@ -632,7 +717,7 @@ def ca_guardar_credenciales():
     return jsonify({'status': 'ok'})
         
 
-def subir_a_firestore(producto, email, es_edicion=False):
+def subir_a_firestore(producto, email, es_edicion=False, escritor=None):
     try:
         if not isinstance(producto, dict):
             return {"status": "error", "error": "Producto inválido (no es dict)"}
@@ -771,13 +856,16 @@ def subir_a_firestore(producto, email, es_edicion=False):
             doc["talles"] = []
             doc["colores"] = []
 
+        doc.update(stock_canonico(doc))
+
         ruta = f"usuarios/{email}/productos/{custom_id}"
-        if es_edicion:
-            db.collection("usuarios").document(email).collection("productos").document(custom_id).set(doc, merge=True)
+        producto_ref = db.collection("usuarios").document(email).collection("productos").document(custom_id)
+        if escritor is not None:
+            # Alta masiva: el escritor agrupa los productos en lotes y el llamador actualiza el catálogo una vez
+            escritor.set(producto_ref, doc, merge=es_edicion)
         else:
-            db.collection("usuarios").document(email).collection("productos").document(custom_id).set(doc)
-            
-        update_products_last_modified(email)
+            producto_ref.set(doc, merge=es_edicion)
+            update_products_last_modified(email, [custom_id])
         
         return {
             "status": "ok", 
@@ -814,66 +902,38 @@ def verificar_stock():
         if not carrito:
             return jsonify({'ok': False, 'error': 'Carrito vacío'}), 400
 
-        faltantes = []
-        stock_actualizado = {} 
-
-        for item in carrito:
-            id_base = item.get('id_base')
-            talle = item.get('talle', 'unico')
-            cantidad_solicitada = item.get('cantidad', 1)
-
-            if not id_base:
-                continue
-
-            prod_ref = db.collection('usuarios').document(email_vendedor)\
-                         .collection('productos').where('id_base', '==', id_base).limit(1).get()
-            
-            if not prod_ref:
-                faltantes.append({
-                    'id_base': id_base,
-                    'nombre': item.get('nombre', 'Producto'),
-                    'error': 'Producto no encontrado'
-                })
-                continue
-
-            prod_data = prod_ref[0].to_dict()
-
-            stock_disponible = 0
-            if prod_data.get('tiene_variantes'):
-                variantes = prod_data.get('variantes', {})
-                for key, var in variantes.items():
-                    if var.get('talle') == talle:
-                        stock_disponible = var.get('stock', 0)
-                        break
-            elif prod_data.get('stock_por_talle'):
-                stock_por_talle = prod_data.get('stock_por_talle', {})
-                stock_disponible = stock_por_talle.get(talle, 0)
-            else:
-                stock_disponible = prod_data.get('stock', 0)
-
-            stock_actualizado[f"{id_base}_{talle}"] = stock_disponible
-
-            if stock_disponible < cantidad_solicitada:
-                faltantes.append({
-                    'id_base': id_base,
-                    'nombre': item.get('nombre', 'Producto'),
-                    'talle': talle,
-                    'solicitado': cantidad_solicitada,
-                    'disponible': stock_disponible
-                })
+        # Misma cotización que /pagar: una sola lectura (o el catálogo caliente) y precios del servidor
+        productos = cargar_productos(db, email_vendedor, [item.get('id_base') for item in carrito],
+                                     catalogo_caliente, con_reservas=True)
+        cotizacion = cotizar_carrito(productos, [item for item in carrito if item.get('id_base')])
+
+        faltantes = [
+            {'id_base': linea['id_base'], 'nombre': linea['nombre'], 'error': 'Producto no encontrado'}
+            for linea in cotizacion['no_encontrados']
+        ]
+        faltantes.extend(cotizacion['faltantes'])
+        stock_actualizado = {
+            f"{id_base}_{talle}": disponible
+            for (id_base, talle, _), disponible in cotizacion['disponibles'].items()
+        }
+        precios_actualizados = {linea['id_base']: linea['precio_unitario'] for linea in cotizacion['lineas']}
 
         if faltantes:
             return jsonify({
                 'ok': False,
                 'error': 'Stock insuficiente',
                 'faltantes': faltantes,
-                'stock_actualizado': stock_actualizado
+                'stock_actualizado': stock_actualizado,
+                'precios_actualizados': precios_actualizados,
+                'total': cotizacion['total']
             }), 200 
 
         return jsonify({
             'ok': True,
             'mensaje': 'Stock verificado correctamente',
-            'stock_actualizado': stock_actualizado
+            'stock_actualizado': stock_actualizado,
+            'precios_actualizados': precios_actualizados,
+            'total': cotizacion['total']
         })
 
     except Exception as e:
@@ -1068,29 +1128,70 @@ def subir_foto():
 
 
 
-def update_products_last_modified(email):
+def update_products_last_modified(email, ids=None):
     try:
-        doc_ref = db.collection('usuarios').document(email).collection('metadata').document('productos')
-        doc_ref.set({'last_updated': firestore.SERVER_TIMESTAMP}, merge=True)
+        if ids:
+            actualizar_productos_catalogo(db, email, ids)
+        else:
+            reconstruir_catalogo(db, email)
     except Exception as e:
         pass
 
+    cache_versiones_catalogo.invalidar(email)
+    cache_catalogo.invalidar(email)
+    for producto_id in ids or []:
+        cache_producto.invalidar((email, producto_id))
+    publicador_catalogo.programar(email)
+
+    for indices in (indices_busqueda, indices_facetas):
+        try:
+            indices.actualizar(email)
+        except Exception as e:
+            pass
+
+
+def cabeceras_cache_edge(response, email):
+    """Marca una respuesta del catálogo como cacheable en el edge, etiquetada por vendedor."""
+    response.headers['Cache-Control'] = (
+        f'public, max-age=0, s-maxage={EDGE_S_MAXAGE}, '
+        f'stale-while-revalidate={EDGE_STALE_WHILE_REVALIDATE}'
+    )
+    clave = 'catalogo-' + hashlib.sha1(email.encode('utf-8')).hexdigest()[:16]
+    response.headers['Cache-Tag'] = clave
+    response.headers['Surrogate-Key'] = clave
+    response.vary.add('X-Vendor-Email')
+    return response
 
 
-def get_products_etag(email):
+def version_vigente(email):
+    """Versión del snapshot del vendedor según Firestore; None si no se pudo leer."""
     try:
-        doc = db.collection('usuarios').document(email).collection('metadata').document('productos').get()
-        if doc.exists:
-            data = doc.to_dict()
-            ts = data.get('last_updated')
-            if ts:
-                if hasattr(ts, 'timestamp'):
-                    return str(ts.timestamp())
-                return str(ts)
+        return cache_versiones_catalogo.obtener(email, lambda: version_catalogo(db, email))
     except Exception as e:
         return None
 
 
+def obtener_vigente(cache, clave, email, cargar):
+    """(valor, version) de `clave`: el cacheado si se armó con la versión vigente del catálogo; si no, lo recarga."""
+    version = version_vigente(email)
+    cargar_con_version = lambda: (cargar(), version)
+    valor, version_cacheada = cache.obtener(clave, cargar_con_version)
+    if version is not None and version_cacheada != version:
+        cache.invalidar(clave)
+        valor, version_cacheada = cache.obtener(clave, cargar_con_version)
+    return valor, version_cacheada
+
+
+def cargar_respuesta_catalogo(email):
+    productos = catalogo_caliente.obtener(email)
+    if productos is None:
+        productos, _ = leer_catalogo(db, email)
+    productos = con_stock_fragmentado(db, email, productos)
+    cuerpo = serializar_json(productos)
+    # ETag por contenido: igual en todos los workers, venga del listener o del snapshot
+    return precomprimir(cuerpo), hashlib.sha1(cuerpo).hexdigest()[:20]
+
+
 @app.route("/api/productos")
 def api_productos():
     # Obtener el email del vendedor desde la cabecera (obligatorio)
@@ -1100,125 +1201,213 @@ def api_productos():
 
     email = vendor_email  # El email del vendedor que se usará para consultar productos
 
-    etag = get_products_etag(email)
+    catalogo_caliente.registrar_peticion(email)
+
+    since = request.args.get('since')
+    if since is not None:
+        # Sincronización incremental: solo lo que cambió desde la versión que tiene el cliente
+        try:
+            desde = int(since)
+        except ValueError:
+            return jsonify({'error': 'since debe ser un número de versión'}), 400
+        if desde > 0:
+            try:
+                return cabeceras_cache_edge(jsonify(leer_cambios_catalogo(db, email, desde)), email)
+            except Exception as e:
+                return jsonify({"error": str(e)}), 500
+        # since=0 es una primera carga: va por la respuesta completa cacheada, con la versión en X-Catalogo-Version
+
+    if any(param in request.args for param in ('limite', 'cursor', 'fields', 'grupo', 'subgrupo')):
+        # Vista paginada (grillas, panel admin): filtros y proyección resueltos en Firestore
+        try:
+            limite = min(max(int(request.args.get('limite', 50)), 1), 200)
+        except ValueError:
+            return jsonify({'error': 'limite inválido'}), 400
+        fields = request.args.get('fields')
+        campos = [c.strip() for c in fields.split(',') if c.strip()] if fields else None
+        try:
+            productos, siguiente = listar_productos(
+                db, email, limite,
+                cursor=request.args.get('cursor'),
+                grupo=request.args.get('grupo'),
+                subgrupo=request.args.get('subgrupo'),
+                campos=campos
+            )
+        except (ValueError, TypeError):
+            return jsonify({'error': 'cursor inválido'}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        return cabeceras_cache_edge(jsonify({'productos': productos, 'siguiente': siguiente}), email)
+
+    try:
+        # Respuesta ya serializada y comprimida en memoria; en un miss se lee el snapshot normalizado
+        (cuerpos, etag), version = obtener_vigente(
+            cache_catalogo, email, email,
+            lambda: singleflight.hacer(("catalogo", email), lambda: cargar_respuesta_catalogo(email))
+        )
+
+        codificacion = elegir_codificacion(request.headers.get('Accept-Encoding'), cuerpos)
+        # Cada codificación lleva su propio ETag fuerte, pero todas validan el mismo contenido
+        etag_respuesta = etag if codificacion == 'identity' else f'{etag}-{codificacion}'
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and any(
+            tag.strip().replace('W/', '', 1).strip('"').split('-')[0] == etag
+            for tag in if_none_match.split(',')
+        ):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(cuerpos[codificacion], mimetype='application/json')
+            if codificacion != 'identity':
+                response.headers['Content-Encoding'] = codificacion
+        if version is not None:
+            # Base para los próximos ?since= del cliente
+            response.headers['X-Catalogo-Version'] = str(version)
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag_respuesta)
+        return cabeceras_cache_edge(response, email)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def cargar_respuesta_producto(email, id_base):
+    doc = db.collection("usuarios").document(email).collection("productos").document(id_base).get()
+    if not doc.exists:
+        return None
+    cuerpo = serializar_json(con_stock_fragmentado(db, email, [normalizar_producto(doc.id, doc.to_dict())])[0])
+    return cuerpo, hashlib.sha1(cuerpo).hexdigest()[:20]
+
+
+@app.route("/api/productos/<id_base>")
+def api_producto(id_base):
+    vendor_email = request.headers.get('X-Vendor-Email')
+    if not vendor_email:
+        return jsonify({'error': 'Falta cabecera X-Vendor-Email'}), 400
+
+    try:
+        clave = (vendor_email, id_base)
+        respuesta, _ = obtener_vigente(
+            cache_producto, clave, vendor_email,
+            lambda: singleflight.hacer(("producto", clave), lambda: cargar_respuesta_producto(vendor_email, id_base))
+        )
+        if respuesta is None:
+            return jsonify({'error': 'Producto no encontrado'}), 404
+        cuerpo, etag = respuesta
 
-    if etag:
         if_none_match = request.headers.get('If-None-Match')
         if if_none_match and if_none_match == f'"{etag}"':
             return '', 304
 
+        response = app.response_class(cuerpo, mimetype='application/json')
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/productos/buscar")
+def buscar_productos():
+    vendor_email = request.headers.get('X-Vendor-Email')
+    if not vendor_email:
+        return jsonify({'error': 'Falta cabecera X-Vendor-Email'}), 400
+
+    consulta = (request.args.get('q') or '').strip()
+    if not consulta:
+        return jsonify({'error': 'Falta el parámetro q'}), 400
     try:
-        productos_ref = db.collection("usuarios").document(email).collection("productos")
-        docs = productos_ref.stream()
+        limite = min(max(int(request.args.get('limite', 20)), 1), 100)
+    except ValueError:
+        return jsonify({'error': 'limite inválido'}), 400
 
-        productos = []
-        for doc in docs:
-            data = doc.to_dict() or {}
+    try:
+        productos, total = indices_busqueda.buscar(vendor_email, consulta[:200], limite,
+                                                   version=version_vigente(vendor_email))
+        return jsonify({'productos': productos, 'total': total})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-            # Transformar datos según el esquema (igual que antes)
-            if data.get("tiene_variantes", False):
-                pass
-            elif data.get("tiene_stock_por_talle", False):
-                stock_pt = data.get("stock_por_talle", {})
-                if "unico" in stock_pt:
-                    variantes = {"unico_unico": {
-                        "talle": "unico",
-                        "color": "unico",
-                        "stock": stock_pt["unico"],
-                        "imagen_url": ""
-                    }}
-                    talles = ["unico"]
-                    colores = ["unico"]
-                else:
-                    variantes = {}
-                    talles = list(stock_pt.keys())
-                    colores = ["General"]
-                    for talle, stock in stock_pt.items():
-                        key = f"{talle}_General".replace(" ", "_")
-                        variantes[key] = {
-                            "talle": talle,
-                            "color": "General",
-                            "stock": stock,
-                            "imagen_url": ""
-                        }
-                data["tiene_variantes"] = True
-                data["variantes"] = variantes
-                data["talles"] = talles
-                data["colores"] = colores
-            else:
-                stock_simple = data.get("stock", 0)
-                variantes = {"unico_unico": {
-                    "talle": "unico",
-                    "color": "unico",
-                    "stock": stock_simple,
-                    "imagen_url": ""
-                }}
-                data["tiene_variantes"] = True
-                data["variantes"] = variantes
-                data["talles"] = ["unico"]
-                data["colores"] = ["unico"]
-
-            talles_originales = data.get("talles", [])
-            if isinstance(talles_originales, str):
-                talles_originales = [t.strip() for t in talles_originales.split(",") if t.strip()]
-            elif not isinstance(talles_originales, list):
-                talles_originales = []
-            
-            fotos_adicionales = data.get("fotos_adicionales", [])
-            if not isinstance(fotos_adicionales, list):
-                fotos_adicionales = []
-
-            variantes = data.get("variantes", {})
-            stock_por_talle_filtrado = {}
-            stock_disponible = 0
-            for var in variantes.values():
-                talle = var.get("talle")
-                if talle:
-                    stock = var.get("stock", 0)
-                    stock_por_talle_filtrado[talle] = stock_por_talle_filtrado.get(talle, 0) + stock
-                    stock_disponible += stock
-                else:
-                    stock_disponible += var.get("stock", 0)
 
-            if len(stock_por_talle_filtrado) == 1 and "unico" in stock_por_talle_filtrado:
-                pass
-            elif len(stock_por_talle_filtrado) == 0:
-                stock_por_talle_filtrado = {"unico": 0}
-                stock_disponible = 0
-            
-            disponible = stock_disponible > 0
-            
-            productos.append({
-                "id": doc.id,
-                "id_base": data.get("id_base"),
-                "nombre": data.get("nombre"),
-                "precio": data.get("precio"),
-                "stock": stock_disponible,
-                "stock_por_talle": stock_por_talle_filtrado,
-                "disponible": disponible,
-                "grupo": data.get("grupo"),
-                "subgrupo": data.get("subgrupo"),
-                "descripcion": data.get("descripcion"),
-                "imagen_url": data.get("imagen_url"),
-                "fotos_adicionales": fotos_adicionales,
-                "precio_anterior": data.get("precio_anterior", 0),
-                "orden": data.get("orden"),
-                "talles": talles_originales,
-                "colores": data.get("colores", []),
-                "variantes": variantes,
-                "tiene_variantes": data.get("tiene_variantes", True),
-                "tiene_stock_por_talle": False,
-                "sistema_stock": "variantes_unificado",
-                "timestamp": str(data.get("timestamp")) if data.get("timestamp") else None
-            })
+@app.route("/api/productos/facetas")
+def facetas_productos():
+    vendor_email = request.headers.get('X-Vendor-Email')
+    if not vendor_email:
+        return jsonify({'error': 'Falta cabecera X-Vendor-Email'}), 400
 
-        productos = sorted(productos, key=lambda p: p.get("orden") or 0)
+    # ?talle=M,L&color=rojo&disponible=1&precio_min=1000&precio_max=5000
+    filtros = {}
+    for faceta in FACETAS:
+        valores = [v.strip() for param in request.args.getlist(faceta) for v in param.split(',') if v.strip()]
+        if valores:
+            filtros[faceta] = valores
+    if 'disponible' in filtros:
+        filtros['disponible'] = ['si' if v.lower() in ('1', 'true', 'si') else 'no' for v in filtros['disponible']]
+    try:
+        precio_min = float(request.args['precio_min']) if request.args.get('precio_min') else None
+        precio_max = float(request.args['precio_max']) if request.args.get('precio_max') else None
+    except ValueError:
+        return jsonify({'error': 'precio inválido'}), 400
+
+    try:
+        resultado = indices_facetas.consultar(
+            vendor_email, lambda indice: indice.filtrar(filtros, precio_min, precio_max),
+            version=version_vigente(vendor_email)
+        )
+        return jsonify(resultado)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/pedidos")
+def api_pedidos():
+    session_email = session.get('email')
+    if not session_email:
+        return jsonify({'error': 'Debes iniciar sesión'}), 401
+
+    vendor_email = request.headers.get('X-Vendor-Email')
+    if not vendor_email or vendor_email != session_email:
+        return jsonify({"error": "No autorizado"}), 403
+
+    # ?limite=25&cursor=...&estado=approved&cliente_email=... o &cliente_telefono=...
+    try:
+        limite = min(max(int(request.args.get('limite', 25)), 1), 100)
+    except ValueError:
+        return jsonify({'error': 'limite inválido'}), 400
+
+    try:
+        pedidos, siguiente = listar_pedidos(
+            db, session_email, limite,
+            cursor=request.args.get('cursor'),
+            estado=request.args.get('estado'),
+            cliente_email=request.args.get('cliente_email'),
+            cliente_telefono=request.args.get('cliente_telefono')
+        )
+    except (ValueError, TypeError):
+        return jsonify({'error': 'cursor inválido'}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({'pedidos': pedidos, 'siguiente': siguiente})
 
-        response = jsonify(productos)
-        if etag:
-            response.set_etag(etag)
-        return response
 
+@app.route("/api/ventas/resumen")
+def api_ventas_resumen():
+    session_email = session.get('email')
+    if not session_email:
+        return jsonify({'error': 'Debes iniciar sesión'}), 401
+
+    vendor_email = request.headers.get('X-Vendor-Email')
+    if not vendor_email or vendor_email != session_email:
+        return jsonify({"error": "No autorizado"}), 403
+
+    # ?dias=30&meses=12: a lo sumo 90 + 24 documentos de resumen, sin leer órdenes
+    try:
+        dias = min(max(int(request.args.get('dias', 30)), 1), 90)
+        meses = min(max(int(request.args.get('meses', 12)), 1), 24)
+    except ValueError:
+        return jsonify({'error': 'dias/meses inválidos'}), 400
+
+    try:
+        return jsonify(leer_resumen_ventas(db, session_email, dias, meses))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
         
@@ -1505,7 +1694,9 @@ def comprobante(orden_id):
     cliente_email = data.get("cliente_email", "Sin email").strip()
     cliente_telefono = data.get("cliente_telefono", "Sin teléfono").strip()
     email_vendedor = data.get("email_vendedor")
-    productos_data = data.get("carrito") or data.get("items") or data.get("items_mp") or []
+    lineas = data.get("lineas") or []
+    # Las órdenes viejas, sin líneas normalizadas, se siguen armando desde carrito/items
+    productos_data = [] if lineas else (data.get("carrito") or data.get("items") or data.get("items_mp") or [])
 
     if isinstance(productos_data, str):
         try:
@@ -1515,6 +1706,19 @@ def comprobante(orden_id):
     
     total = 0
     productos = []
+
+    for linea in lineas:
+        subtotal = linea["precio_unitario"] * linea["cantidad"]
+        total += subtotal
+        productos.append({
+            "nombre": linea["nombre"],
+            "cantidad": linea["cantidad"],
+            "precio": linea["precio_unitario"],
+            "subtotal": subtotal,
+            "imagen_url": linea["imagen_url"],
+            "color": linea["color"],
+            "talle": linea["talle"]
+        })
     
     for idx, p in enumerate(productos_data):
         try:
@@ -1670,7 +1874,9 @@ def enviar_comprobante(email_vendedor, orden_id):
     cliente_email = data.get("cliente_email", "").strip()
     cliente_telefono = data.get("cliente_telefono", "No especificado").strip()
     
-    productos_data = data.get("carrito") or data.get("items") or data.get("items_mp") or []
+    lineas = data.get("lineas") or []
+    # Las órdenes viejas, sin líneas normalizadas, se siguen armando desde carrito/items
+    productos_data = [] if lineas else (data.get("carrito") or data.get("items") or data.get("items_mp") or [])
     
     if isinstance(productos_data, str):
         try:
@@ -1680,6 +1886,19 @@ def enviar_comprobante(email_vendedor, orden_id):
     
     total = 0
     productos_procesados = []
+
+    for linea in lineas:
+        subtotal = linea["precio_unitario"] * linea["cantidad"]
+        total += subtotal
+        productos_procesados.append({
+            "title": linea["nombre"],
+            "unit_price": linea["precio_unitario"],
+            "quantity": linea["cantidad"],
+            "subtotal": subtotal,
+            "talle": linea["talle"],
+            "color": linea["color"],
+            "imagen_url": linea["imagen_url"]
+        })
     
     for idx, p in enumerate(productos_data):
         try:
@@ -1812,292 +2031,309 @@ def enviar_comprobante(email_vendedor, orden_id):
     except Exception as e:
         return False
 
+
+def consultar_pago_mp(payment_id):
+    """Detalle de un pago en MP; las consultas simultáneas del mismo pago comparten una sola llamada.
+
+    No se guarda entre notificaciones: cada una tiene que ver el estado actual del pago.
+    """
+    def cargar():
+        access_token = os.getenv("MERCADO_PAGO_TOKEN")
+        headers = {"Authorization": f"Bearer {access_token}"}
+        r = clientes_mercadopago.http.sesion.get(f"https://api.mercadopago.com/v1/payments/{payment_id}",
+                                                 headers=headers, timeout=15)
+        if r.status_code != 200:
+            raise RuntimeError(f"MP respondió {r.status_code} para el pago {payment_id}")
+        return r.json()
+
+    clave = str(payment_id)
+    return singleflight.hacer(("pago_mp", clave), cargar)
+
+
 @app.route("/webhook_mp", methods=["POST"])
 def webhook_mp():
     evento = request.get_json(force=True) or {}
+
+    # Solo se procesan pagos; merchant_order y demás tópicos se descartan sin llamar a MP
+    topico = evento.get("type") or evento.get("topic") or request.args.get("type") or request.args.get("topic")
+    if topico and topico not in TOPICOS_WEBHOOK_MP:
+        return jsonify({"ok": True, "ignorado": topico})
     
     payment_id = None
     if "data" in evento and isinstance(evento["data"], dict):
         payment_id = evento["data"].get("id")
     elif "id" in evento:
         payment_id = evento.get("id")
+    if not payment_id:
+        payment_id = request.args.get("data.id") or request.args.get("id")
     
     if not payment_id:
         return jsonify({"ok": False}), 400
-    
-    access_token = os.getenv("MERCADO_PAGO_TOKEN")
-    headers = {"Authorization": f"Bearer {access_token}"}
-    
+
+    # Se guarda en la cola y se responde enseguida; el worker (flask worker-webhooks) hace el resto
     try:
-        r = requests.get(f"https://api.mercadopago.com/v1/payments/{payment_id}", 
-                        headers=headers, timeout=15)
-        detalle = r.json()
-        
-        if r.status_code != 200:
-            return jsonify({"ok": False}), 500
-        
-        external_ref = detalle.get("external_reference")
-        if not external_ref:
-            return jsonify({"ok": False}), 400
-        
-        estado = detalle.get("status")
-        
-        doc_ref = db.collection("ordenes").document(external_ref)
-        doc = doc_ref.get()
-        
-        if not doc.exists:
-            return jsonify({"ok": False}), 404
-        
-        orden_data = doc.to_dict()
+        cola_webhooks.encolar("pago_mp", {"payment_id": str(payment_id)}, clave=f"pago_mp:{payment_id}")
+    except Exception as e:
+        return jsonify({"ok": False}), 500
+    return jsonify({"ok": True})
 
-        todos_items = orden_data.get("carrito") or orden_data.get("items_mp") or orden_data.get("items") or []
 
-        if estado == "approved":
-            email_vendedor = orden_data.get("email_vendedor")
-            cliente_nombre = orden_data.get("cliente_nombre", "")
-            total_final = orden_data.get("total", 0)
-            cliente_direccion = orden_data.get("cliente_direccion", {})
-            
-            if email_vendedor:
-                for item in todos_items:
-                    try:
-                        if not isinstance(item, dict):
-                            continue
-                            
-                        producto_id = item.get("id_base")
-                        if not producto_id:
-                            continue
-                        
-                        cantidad = int(item.get("cantidad", 1))
-                        talle = item.get("talle", "")
-                        color = item.get("color", "")
-
-                        if not talle and not color:
-                            title = item.get("title", "") or item.get("nombre", "") or ""
-                            import re
-                            talle_match = re.search(r"[Tt]alle[:\s]*([A-Za-z0-9]+)", title)
-                            color_match = re.search(r"[Cc]olor[:\s]*([A-Za-z\s]+)", title)
-                            if talle_match:
-                                talle = talle_match.group(1).strip()
-                            if color_match:
-                                color = color_match.group(1).strip()
-                            if not talle and not color:
-                                parts = title.split('-')
-                                if len(parts) >= 3:
-                                    talle = parts[-2].strip()
-                                    color = parts[-1].strip()
-                            if not talle:
-                                talle = item.get("metadata", {}).get("talle", "") or item.get("metadata", {}).get("size", "")
-                            if not color:
-                                color = item.get("metadata", {}).get("color", "") or item.get("metadata", {}).get("colour", "")
-                        
-                        talle = str(talle).strip()
-                        color = str(color).strip()
-                        
-                        prod_ref = db.collection("usuarios").document(email_vendedor)\
-                                      .collection("productos").document(producto_id)
-                        prod_doc = prod_ref.get()
-                        
-                        if prod_doc.exists:
-                            data = prod_doc.to_dict()
-                            tiene_variantes = data.get("tiene_variantes", False)
-                            variantes = data.get("variantes", {})
-                            
-                            if tiene_variantes and variantes and talle and color:
-                                variante_encontrada = None
-                                variante_key_encontrada = None
-                                variante_key_exacta = f"{talle}_{color}".replace(" ", "_")
-                                if variante_key_exacta in variantes:
-                                    variante_encontrada = variantes[variante_key_exacta]
-                                    variante_key_encontrada = variante_key_exacta
-                                else:
-                                    for key, variante in variantes.items():
-                                        variante_talle = variante.get("talle", "").lower().strip()
-                                        variante_color = variante.get("color", "").lower().strip()
-                                        if (variante_talle == talle.lower() and 
-                                            variante_color == color.lower()):
-                                            variante_encontrada = variante
-                                            variante_key_encontrada = key
-                                            break
-                                
-                                if variante_encontrada and variante_key_encontrada:
-                                    stock_variante = variante_encontrada.get("stock", 0)
-                                    nuevo_stock_variante = max(0, stock_variante - cantidad)
-                                    prod_ref.update({
-                                        f"variantes.{variante_key_encontrada}.stock": nuevo_stock_variante
-                                    })
-                                    historial_ref = db.collection("usuarios").document(email_vendedor)\
-                                                       .collection("productos").document(producto_id)\
-                                                       .collection("stock_historial").document(f"{external_ref}_{variante_key_encontrada}")
-                                    historial_ref.set({
-                                        "orden_id": external_ref,
-                                        "fecha": firestore.SERVER_TIMESTAMP,
-                                        "stock_antes": stock_variante,
-                                        "stock_despues": nuevo_stock_variante,
-                                        "cantidad_descontada": cantidad,
-                                        "payment_id": payment_id,
-                                        "tipo": "compra_webhook_variante",
-                                        "talle": talle,
-                                        "color": color,
-                                        "variante_key": variante_key_encontrada,
-                                        "nombre_producto": data.get("nombre", "")
-                                    })
-                                else:
-                                    stock_actual = data.get("stock", 0)
-                                    nuevo_stock = max(0, stock_actual - cantidad)
-                                    prod_ref.update({"stock": nuevo_stock})
-                                    historial_ref = db.collection("usuarios").document(email_vendedor)\
-                                                       .collection("productos").document(producto_id)\
-                                                       .collection("stock_historial").document(external_ref)
-                                    historial_ref.set({
-                                        "orden_id": external_ref,
-                                        "fecha": firestore.SERVER_TIMESTAMP,
-                                        "stock_antes": stock_actual,
-                                        "stock_despues": nuevo_stock,
-                                        "cantidad_descontada": cantidad,
-                                        "payment_id": payment_id,
-                                        "tipo": "compra_webhook_general",
-                                        "talle": talle,
-                                        "color": color,
-                                        "nombre_producto": data.get("nombre", "")
-                                    })
-                            else:
-                                stock_actual = data.get("stock", 0)
-                                nuevo_stock = max(0, stock_actual - cantidad)
-                                prod_ref.update({"stock": nuevo_stock})
-                                historial_ref = db.collection("usuarios").document(email_vendedor)\
-                                                   .collection("productos").document(producto_id)\
-                                                   .collection("stock_historial").document(external_ref)
-                                historial_ref.set({
-                                    "orden_id": external_ref,
-                                    "fecha": firestore.SERVER_TIMESTAMP,
-                                    "stock_antes": stock_actual,
-                                    "stock_despues": nuevo_stock,
-                                    "cantidad_descontada": cantidad,
-                                    "payment_id": payment_id,
-                                    "tipo": "compra_webhook",
-                                    "talle": talle,
-                                    "color": color,
-                                    "nombre_producto": data.get("nombre", "")
-                                })
-                            
-                            try:
-                                prod_doc_actualizado = prod_ref.get()
-                                if prod_doc_actualizado.exists:
-                                    data_actualizado = prod_doc_actualizado.to_dict()
-                                    variantes_actualizadas = data_actualizado.get("variantes", {})
-                                    if variantes_actualizadas:
-                                        stock_total_actualizado = sum(v.get('stock', 0) for v in variantes_actualizadas.values())
-                                        prod_ref.update({"stock": stock_total_actualizado})
-                            except Exception:
-                                pass
-                        else:
-                            nombre_producto = item.get("nombre") or item.get("title", "")
-                            if nombre_producto:
-                                try:
-                                    query = db.collection("usuarios").document(email_vendedor)\
-                                              .collection("productos").where("nombre", "==", nombre_producto).get()
-                                    for prod_doc in query:
-                                        prod_data = prod_doc.to_dict()
-                                        stock_actual_real = prod_data.get("stock", 0)
-                                        nuevo_stock_real = max(0, stock_actual_real - cantidad)
-                                        prod_doc.reference.update({"stock": nuevo_stock_real})
-                                        break
-                                except Exception:
-                                    pass
-                    except Exception as e:
-                        continue
-                try:
+def procesar_pago_mp(datos):
+    """Etapa 1 del webhook: estado del pago, descuento de stock y estado de la orden.
 
-                    remitente_data = obtener_datos_remitente(email_vendedor, db)
-                    destinatario_data = {
-                        "name": cliente_nombre,
-                        "address": {
-                            "streetName": cliente_direccion.get("calle", ""),
-                            "streetNumber": cliente_direccion.get("numero", ""),
-                            "cityName": cliente_direccion.get("localidad", ""),
-                            "state": cliente_direccion.get("provincia_codigo", ""),
-                            "zipCode": cliente_direccion.get("codigo_postal", "")
-                        }
-                    }
-                    
-                    peso_total = 0
-                    for item in todos_items:
-                        peso_item = item.get("peso_gramos", 500)
-                        try:
-                            peso_total += int(peso_item) * int(item.get("cantidad", 1))
-                        except:
-                            peso_total += 500 * int(item.get("cantidad", 1))
-
-                    orden_ca = {
-                        "sellerId": email_vendedor,
-                        "order": {
-                            "senderData": remitente_data,
-                            "shippingData": destinatario_data,
-                            "parcels": [{
-                                "dimensions": {"height": "10", "width": "15", "depth": "20"},
-                                "productWeight": str(peso_total),
-                                "declaredValue": str(total_final)
-                            }],
-                            "deliveryType": "homeDelivery",
-                            "saleDate": datetime.now().strftime("%Y-%m-%dT%H:%M:%S-03:00"),
-                            "serviceType": "CP"
-                        }
-                    }
+    El alta en Correo Argentino y el comprobante se encolan como trabajos aparte, con sus propios reintentos.
+    """
+    payment_id = datos["payment_id"]
+    detalle = consultar_pago_mp(payment_id)
+
+    external_ref = detalle.get("external_reference")
+    if not external_ref:
+        return
+
+    estado = detalle.get("status")
+
+    # Un registro por (pago, estado), escrito en el commit final: las notificaciones ya procesadas terminan acá.
+    # Si el worker muere a mitad de camino no queda registro y el reintento procesa todo de nuevo
+    # (el descuento de stock es idempotente por la marca de la orden).
+    evento_ref = db.collection("webhook_eventos").document(f"{payment_id}_{estado}")
+    evento = evento_ref.get()
+    if evento.exists and (evento.to_dict() or {}).get("procesado"):
+        return
+
+    doc_ref = db.collection("ordenes").document(external_ref)
+    doc = doc_ref.get()
+    
+    if not doc.exists:
+        raise LookupError(f"No existe la orden {external_ref}")
+    
+    orden_data = doc.to_dict()
+
+    todos_items = orden_data.get("carrito") or orden_data.get("items_mp") or orden_data.get("items") or []
+
+    if estado == "approved" and orden_data.get("email_vendedor"):
+        email_vendedor = orden_data["email_vendedor"]
+        lineas_stock = [
+            {
+                "producto_id": linea["id_base"],
+                "variante_key": linea.get("variante_key"),
+                "cantidad": linea["cantidad"],
+                "talle": linea["talle"],
+                "color": linea["color"],
+                "nombre": linea["nombre"]
+            }
+            for linea in orden_data.get("lineas") or []
+            if linea.get("id_base")
+        ]
+        # Órdenes viejas, sin líneas normalizadas: talle y color salen de los items o del título
+        items_legados = [] if orden_data.get("lineas") else todos_items
+        for item in items_legados:
+            try:
+                if not isinstance(item, dict):
+                    continue
                     
-                    success_ca, tn, msg_ca, _ = crear_orden(email_vendedor, db, orden_ca)
-                    if success_ca:
-                        doc_ref.update({
-                            "correo_argentino_tracking": tn,
-                            "correo_argentino_creado": True,
-                            "correo_argentino_respuesta": msg_ca
-                        })
-                    else:
-                        doc_ref.update({
-                            "correo_argentino_error": msg_ca,
-                            "correo_argentino_intento": firestore.SERVER_TIMESTAMP
-                        })
-                except Exception as e:
-                    doc_ref.update({
-                        "correo_argentino_error": str(e),
-                        "correo_argentino_intento": firestore.SERVER_TIMESTAMP
-                    })
-
-        update_data = {
-            "estado": estado,
-            "payment_id": payment_id,
-            "actualizado": firestore.SERVER_TIMESTAMP,
-            "webhook_processed": True,
-            "webhook_timestamp": firestore.SERVER_TIMESTAMP,
-            "stock_actualizado": estado == "approved",
-            "stock_actualizado_fecha": firestore.SERVER_TIMESTAMP if estado == "approved" else None
+                producto_id = item.get("id_base")
+                if not producto_id:
+                    continue
+                
+                cantidad = int(item.get("cantidad", 1))
+                talle = item.get("talle", "")
+                color = item.get("color", "")
+
+                if not talle and not color:
+                    title = item.get("title", "") or item.get("nombre", "") or ""
+                    import re
+                    talle_match = re.search(r"[Tt]alle[:\s]*([A-Za-z0-9]+)", title)
+                    color_match = re.search(r"[Cc]olor[:\s]*([A-Za-z\s]+)", title)
+                    if talle_match:
+                        talle = talle_match.group(1).strip()
+                    if color_match:
+                        color = color_match.group(1).strip()
+                    if not talle and not color:
+                        parts = title.split('-')
+                        if len(parts) >= 3:
+                            talle = parts[-2].strip()
+                            color = parts[-1].strip()
+                    if not talle:
+                        talle = item.get("metadata", {}).get("talle", "") or item.get("metadata", {}).get("size", "")
+                    if not color:
+                        color = item.get("metadata", {}).get("color", "") or item.get("metadata", {}).get("colour", "")
+                
+                talle = str(talle).strip()
+                color = str(color).strip()
+                
+                lineas_stock.append({
+                    "producto_id": producto_id,
+                    "cantidad": cantidad,
+                    "talle": talle,
+                    "color": color,
+                    "nombre": item.get("nombre") or item.get("title", "")
+                })
+            except Exception as e:
+                continue
+
+        # Todas las líneas en una transacción: sin lecturas repetidas ni descuentos perdidos.
+        # Los fragmentados no vuelven en productos_modificados: su venta no toca el snapshot del catálogo
+        productos_modificados = descontar_stock_orden(
+            db, email_vendedor, lineas_stock, external_ref, payment_id, orden_ref=doc_ref
+        )
+        if productos_modificados:
+            # Los productos que superan el umbral de escrituras pasan a stock fragmentado
+            try:
+                promotor_fragmentos.registrar(email_vendedor, productos_modificados)
+            except Exception as e:
+                pass
+            update_products_last_modified(email_vendedor, productos_modificados)
+        elif lineas_stock:
+            # Venta solo de fragmentados: el snapshot sigue igual, pero core.js lee primero la copia de R2
+            publicador_catalogo.programar(email_vendedor, demora=R2_CATALOGO_DEMORA_FRAGMENTOS_SEG)
+
+    update_data = {
+        "estado": estado,
+        "payment_id": payment_id,
+        "actualizado": firestore.SERVER_TIMESTAMP,
+        "webhook_processed": True,
+        "webhook_timestamp": firestore.SERVER_TIMESTAMP,
+        "stock_actualizado": estado == "approved",
+        "stock_actualizado_fecha": firestore.SERVER_TIMESTAMP if estado == "approved" else None
+    }
+    
+    if estado == "approved":
+        update_data["pago_aprobado_fecha"] = firestore.SERVER_TIMESTAMP
+        if len(todos_items) > 0:
+            update_data["items_procesados"] = True
+            update_data["items_procesados_fecha"] = firestore.SERVER_TIMESTAMP
+    
+    if estado in ("rejected", "cancelled") and orden_data.get("email_vendedor"):
+        # Pago caído: el stock reservado vuelve a estar disponible
+        liberar_reservas(db, orden_data["email_vendedor"], external_ref)
+
+    if estado == "approved" and orden_data.get("email_vendedor"):
+        if not orden_data.get("correo_argentino_creado"):
+            cola_webhooks.encolar("envio_correo_argentino", {"external_ref": external_ref},
+                                  clave=f"envio_correo_argentino:{external_ref}")
+        if not orden_data.get("comprobante_enviado", False):
+            cola_webhooks.encolar("comprobante", {"external_ref": external_ref},
+                                  clave=f"comprobante:{external_ref}")
+
+    # Estado de la orden, del pedido del vendedor (para /api/pedidos) y cierre del evento en un solo commit
+    batch = db.batch()
+    if estado == "approved" and orden_data.get("email_vendedor") and not orden_data.get("ventas_registradas"):
+        # Resúmenes diario y mensual en el mismo commit que la marca, así un reintento no suma dos veces
+        lineas_venta = orden_data.get("lineas") or [
+            {**linea, "id_base": linea["producto_id"]} for linea in lineas_stock
+        ]
+        registrar_venta(batch, db, orden_data["email_vendedor"], fecha_venta(detalle.get("date_approved")),
+                        orden_data.get("total", 0), lineas_venta)
+        update_data["ventas_registradas"] = True
+    batch.update(doc_ref, update_data)
+    if orden_data.get("email_vendedor"):
+        batch.set(db.collection("usuarios").document(orden_data["email_vendedor"])
+                  .collection("pedidos").document(external_ref), {
+                      "estado": estado,
+                      "payment_id": payment_id,
+                      "actualizado": firestore.SERVER_TIMESTAMP
+                  }, merge=True)
+    datos_evento = {
+        "payment_id": str(payment_id),
+        "estado": estado,
+        "external_reference": external_ref,
+        "procesado": firestore.SERVER_TIMESTAMP
+    }
+    if evento.exists:
+        # Registro viejo que quedó sin cerrar
+        batch.set(evento_ref, datos_evento, merge=True)
+    else:
+        batch.create(evento_ref, datos_evento)
+    try:
+        batch.commit()
+    except AlreadyExists:
+        # Otro worker cerró la misma notificación primero; su commit ya incluye todo lo de este
+        return
+
+
+def procesar_envio_correo_argentino(datos):
+    """Etapa 2 del webhook: alta del envío en Correo Argentino (se reintenta si la API falla)."""
+    external_ref = datos["external_ref"]
+    doc_ref = db.collection("ordenes").document(external_ref)
+    orden_data = doc_ref.get().to_dict() or {}
+    if orden_data.get("correo_argentino_creado"):
+        return
+
+    email_vendedor = orden_data.get("email_vendedor")
+    cliente_nombre = orden_data.get("cliente_nombre", "")
+    total_final = orden_data.get("total", 0)
+    cliente_direccion = orden_data.get("cliente_direccion", {})
+    todos_items = orden_data.get("carrito") or orden_data.get("items_mp") or orden_data.get("items") or []
+
+    try:
+        remitente_data = obtener_datos_remitente(email_vendedor, db)
+        destinatario_data = {
+            "name": cliente_nombre,
+            "address": {
+                "streetName": cliente_direccion.get("calle", ""),
+                "streetNumber": cliente_direccion.get("numero", ""),
+                "cityName": cliente_direccion.get("localidad", ""),
+                "state": cliente_direccion.get("provincia_codigo", ""),
+                "zipCode": cliente_direccion.get("codigo_postal", "")
+            }
         }
-        
-        if estado == "approved":
-            update_data["pago_aprobado_fecha"] = firestore.SERVER_TIMESTAMP
-            if len(todos_items) > 0:
-                update_data["items_procesados"] = True
-                update_data["items_procesados_fecha"] = firestore.SERVER_TIMESTAMP
-        
-        doc_ref.update(update_data)
-
-        if estado == "approved":
-            email_vendedor = orden_data.get("email_vendedor")
-            if email_vendedor and not orden_data.get("comprobante_enviado", False):
-                if enviar_comprobante(email_vendedor, external_ref):
-                    doc_ref.update({
-                        "comprobante_enviado": True,
-                        "comprobante_enviado_fecha": firestore.SERVER_TIMESTAMP
-                    })
-                else:
-                    pass
-        
-        return jsonify({"ok": True})
-        
+    
+        peso_total = 0
+        for item in todos_items:
+            peso_item = item.get("peso_gramos", 500)
+            try:
+                peso_total += int(peso_item) * int(item.get("cantidad", 1))
+            except:
+                peso_total += 500 * int(item.get("cantidad", 1))
+
+        orden_ca = {
+            "sellerId": email_vendedor,
+            "order": {
+                "senderData": remitente_data,
+                "shippingData": destinatario_data,
+                "parcels": [{
+                    "dimensions": {"height": "10", "width": "15", "depth": "20"},
+                    "productWeight": str(peso_total),
+                    "declaredValue": str(total_final)
+                }],
+                "deliveryType": "homeDelivery",
+                "saleDate": datetime.now().strftime("%Y-%m-%dT%H:%M:%S-03:00"),
+                "serviceType": "CP"
+            }
+        }
+    
+        success_ca, tn, msg_ca, _ = crear_orden(email_vendedor, db, orden_ca)
+        if success_ca:
+            doc_ref.update({
+                "correo_argentino_tracking": tn,
+                "correo_argentino_creado": True,
+                "correo_argentino_respuesta": msg_ca
+            })
+        else:
+            raise RuntimeError(msg_ca)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({"ok": False}), 500
+        doc_ref.update({
+            "correo_argentino_error": str(e),
+            "correo_argentino_intento": firestore.SERVER_TIMESTAMP
+        })
+        raise
+
+
+def procesar_comprobante(datos):
+    """Etapa 3 del webhook: envío del comprobante al vendedor y al cliente."""
+    external_ref = datos["external_ref"]
+    doc_ref = db.collection("ordenes").document(external_ref)
+    orden_data = doc_ref.get().to_dict() or {}
+    email_vendedor = orden_data.get("email_vendedor")
+    if not email_vendedor or orden_data.get("comprobante_enviado", False):
+        return
+
+    if not enviar_comprobante(email_vendedor, external_ref):
+        raise RuntimeError(f"No se pudo enviar el comprobante de {external_ref}")
+    doc_ref.update({
+        "comprobante_enviado": True,
+        "comprobante_enviado_fecha": firestore.SERVER_TIMESTAMP
+    })
 
 
 def obtener_datos_remitente(email, db):
@@ -2152,31 +2388,45 @@ def actualizar_stock_talle():
         
         if not producto.exists:
             return jsonify({'error': 'Producto no encontrado'}), 404
+
+        producto = preparar_edicion_stock(db, email, producto)
         
-        producto_data = producto.to_dict()
-        stock_por_talle = producto_data.get('stock_por_talle', {})
+        try:
+            nuevo_stock = max(0, int(nuevo_stock))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'stock debe ser un número'}), 400
+
+        canonico = asegurar_stock_canonico(producto.to_dict())
+        variantes = dict(canonico.get('variantes') or {})
+        claves_talle = [k for k, v in variantes.items() if v.get('talle') == talle]
+        if len(claves_talle) > 1:
+            return jsonify({'error': f'El talle {talle} tiene varios colores; actualizá el stock por variante'}), 400
+
+        if claves_talle:
+            variantes[claves_talle[0]] = {**variantes[claves_talle[0]], 'stock': nuevo_stock}
+        else:
+            variantes.pop('unico_unico', None)
+            key = f"{talle}_General".replace(" ", "_")
+            variantes[key] = {'talle': talle, 'color': 'General', 'stock': nuevo_stock, 'imagen_url': ''}
 
-        if not stock_por_talle and producto_data.get('talles'):
-            for t in producto_data.get('talles', []):
-                stock_por_talle[t] = 0
+        talles = list(canonico.get('talles') or [])
+        if talle not in talles:
+            talles = [t for t in talles if t != 'unico'] + [talle]
+        colores = sorted({v.get('color', '') for v in variantes.values() if v.get('color')})
 
-        stock_por_talle[talle] = nuevo_stock
-        stock_total = sum(stock_por_talle.values())
-        producto_ref.update({
-            'stock_por_talle': stock_por_talle,
-            'actualizado': firestore.SERVER_TIMESTAMP,
-            'tiene_stock_por_talle': True 
-        })
+        update_data = stock_canonico({'tiene_variantes': True, 'variantes': variantes, 'talles': talles, 'colores': colores})
+        update_data['actualizado'] = firestore.SERVER_TIMESTAMP
+        producto_ref.update(update_data)
 
-        update_products_last_modified(email)
+        update_products_last_modified(email, [id_base])
         
         return jsonify({
             'status': 'ok',
             'id_base': id_base,
             'talle': talle,
             'stock': nuevo_stock,
-            'stock_total': stock_total,
-            'stock_por_talle': stock_por_talle
+            'stock_total': update_data['stock'],
+            'stock_por_talle': update_data['stock_por_talle']
         })
         
     except Exception as e:
@@ -2217,8 +2467,8 @@ def guardar_talles_stock():
         
         if not producto.exists:
             return jsonify({'error': 'Producto no encontrado'}), 404
-        
-        producto_data = producto.to_dict()
+
+        producto = preparar_edicion_stock(db, email, producto)
         
         stock_total = 0
         stock_por_talle_validado = {}
@@ -2236,20 +2486,15 @@ def guardar_talles_stock():
                     pass
 
         talles_actualizados = list(stock_por_talle_validado.keys())
-        update_data = {
-            'stock_por_talle': stock_por_talle_validado,
-            'talles': talles_actualizados,
-            'actualizado': firestore.SERVER_TIMESTAMP,
-            'tiene_stock_por_talle': True 
-        }
-        
-        if producto_data.get('tiene_variantes'):
-            update_data['tiene_variantes'] = False
-            update_data['variantes'] = {}  
+        update_data = stock_canonico({
+            'tiene_stock_por_talle': True,
+            'stock_por_talle': stock_por_talle_validado
+        })
+        update_data['actualizado'] = firestore.SERVER_TIMESTAMP
 
         producto_ref.update(update_data)
 
-        update_products_last_modified(email)
+        update_products_last_modified(email, [id_base])
         
         return jsonify({
             'status': 'ok',
@@ -2282,7 +2527,6 @@ def pagar():
         cliente_telefono = data.get('cliente_telefono', '')
         cliente_direccion = data.get('cliente_direccion', {})  
         orden_id = data.get('orden_id')
-        total_recibido = data.get('total', 0)
         url_retorno = data.get('url_retorno')
         costo_envio = data.get('costo_envio', 0)  
 
@@ -2305,20 +2549,12 @@ def pagar():
         if not access_token or not isinstance(access_token, str):
             return jsonify({'error': 'Vendedor sin credenciales MP válidas'}), 400
         
-        sdk = mercadopago.SDK(access_token.strip())
+        sdk = clientes_mercadopago.sdk(access_token)
 
         if items_mp and len(items_mp) > 0:
-            items_para_mp = items_mp
+            # items_mp solo trae título/cantidad/precio: id_base, talle y color vienen del carrito
+            items_para_mp = completar_items_mp(items_mp, carrito)
             for item in items_para_mp:
-                if not item.get('id') and not item.get('id_base'):
-                    for item_carrito in carrito:
-                        nombre_carrito = item_carrito.get('nombre', '')
-                        titulo_item = item.get('title', '')
-                        if nombre_carrito and titulo_item and nombre_carrito in titulo_item:
-                            item['id'] = item_carrito.get('id_base', '')
-                            item['id_base'] = item_carrito.get('id_base', '')
-                            break
-                
                 if 'metadata' not in item and (item.get('talle') or item.get('color')):
                     metadata_item = {
                         "id_base": item.get('id_base', item.get('id', '')),
@@ -2385,20 +2621,58 @@ def pagar():
                 except Exception:
                     continue
         
-        items_sin_id = [item for item in items_para_mp if not item.get('id')]
-        if items_sin_id:
-            for i, item in enumerate(items_sin_id):
-                temp_id = f"temp_{external_ref}_{i}"
-                item['id'] = temp_id
-                item['id_base'] = temp_id
-                if 'metadata' in item:
-                    item['metadata']['id_base'] = temp_id
-        
         if not items_para_mp:
             return jsonify({'error': 'No se pudieron procesar los productos para el pago'}), 400
-        
-        total_calculado = sum(item.get('unit_price', 0) * item.get('quantity', 1) for item in items_para_mp)
-        total_final = max(total_calculado, float(total_recibido or 0))
+
+        try:
+            costo_envio = max(0.0, float(costo_envio or 0))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'costo_envio inválido'}), 400
+        
+        # Precios y stock con datos del servidor: una sola lectura (o el catálogo caliente) para toda la orden
+        productos_orden = cargar_productos(db, email_vendedor, [item.get('id_base') for item in items_para_mp],
+                                           catalogo_caliente)
+        cotizacion = cotizar_carrito(productos_orden, items_para_mp)
+
+        # Toda línea tiene que ser un producto del catálogo: el precio nunca sale del cliente
+        faltantes = [
+            {'id_base': linea['id_base'], 'nombre': linea['nombre'], 'error': 'Producto no encontrado'}
+            for linea in cotizacion['no_encontrados']
+        ]
+        faltantes.extend(cotizacion['faltantes'])
+        if faltantes:
+            return jsonify({'ok': False, 'error': 'Stock insuficiente', 'faltantes': faltantes}), 200
+
+        precios_servidor = {linea['id_base']: linea['precio_unitario'] for linea in cotizacion['lineas']}
+        for item in items_para_mp:
+            item['id_base'] = item.get('id_base') or (item.get('metadata') or {}).get('id_base')
+            item['unit_price'] = precios_servidor[item['id_base']]
+            if 'metadata' in item:
+                item['metadata']['precio'] = item['unit_price']
+        lineas = cotizacion['lineas']
+
+        # Lo que se guarda es exactamente lo que cobra MP: productos más envío
+        total_calculado = cotizacion['total']
+        total_final = total_calculado + costo_envio
+
+        # Reserva el stock mientras el comprador paga; el webhook la convierte en descuento
+        lineas_reserva = [
+            {
+                "producto_id": linea["id_base"],
+                "variante_key": linea["variante_key"],
+                "cantidad": linea["cantidad"],
+                "talle": linea["talle"],
+                "color": linea["color"]
+            }
+            for linea in lineas
+        ]
+        faltantes = reservar_stock(db, email_vendedor, external_ref, lineas_reserva, productos=productos_orden)
+        if faltantes:
+            return jsonify({
+                'ok': False,
+                'error': 'Stock insuficiente: otro comprador reservó las últimas unidades',
+                'faltantes': faltantes
+            }), 200
         
         base_url = "https://mpagina.onrender.com"
         url_retorno_encoded = quote(url_retorno or "", safe='')
@@ -2411,6 +2685,7 @@ def pagar():
                 "pending": f"{base_url}/pending?orden_id={external_ref}&retorno={url_retorno_encoded}&email={email_vendedor}"
             },
             "auto_return": "approved",
+            "shipments": {"mode": "not_specified", "cost": costo_envio},
             "external_reference": external_ref,
             "notification_url": f"{base_url}/webhook_mp",
             "metadata": {
@@ -2425,10 +2700,15 @@ def pagar():
             }
         }
         
-        preference_response = sdk.preference().create(preference_data)
-        preference = preference_response.get("response", {}) or {}
+        try:
+            preference_response = sdk.preference().create(preference_data)
+            preference = preference_response.get("response", {}) or {}
+        except Exception:
+            liberar_reservas(db, email_vendedor, external_ref)
+            raise
         
         if not preference.get("id"):
+            liberar_reservas(db, email_vendedor, external_ref)
             return jsonify({'error': 'No se pudo generar la preferencia de pago'}), 500
 
         orden_doc = {
@@ -2441,6 +2721,7 @@ def pagar():
             "carrito": carrito,
             "items_mp": items_para_mp,
             "items": items_para_mp,
+            "lineas": lineas,
             "total": total_final,
             "costo_envio": costo_envio, 
             "estado": "pendiente",
@@ -2461,8 +2742,6 @@ def pagar():
             }
         }
         
-        db.collection("ordenes").document(external_ref).set(orden_doc)
-        
         pedido_data = {
             "cliente_nombre": cliente_nombre,
             "cliente_email": cliente_email,
@@ -2470,6 +2749,7 @@ def pagar():
             "cliente_direccion": cliente_direccion,  
             "carrito": carrito,
             "items_mp": items_para_mp,
+            "lineas": lineas,
             "total": total_final,
             "costo_envio": costo_envio,
             "estado": "pendiente",
@@ -2477,11 +2757,16 @@ def pagar():
             "external_reference": external_ref,
             "fecha_creacion": firestore.SERVER_TIMESTAMP,
             "comprobante_enviado": False,
-            "url_retorno": url_retorno
+            "url_retorno": url_retorno,
+            **campos_busqueda_pedido(cliente_email, cliente_telefono)
         }
         
-        db.collection("usuarios").document(email_vendedor)\
-          .collection("pedidos").document(external_ref).set(pedido_data)
+        # Orden global y pedido del vendedor en un solo commit
+        batch = db.batch()
+        batch.set(db.collection("ordenes").document(external_ref), orden_doc)
+        batch.set(db.collection("usuarios").document(email_vendedor)
+                  .collection("pedidos").document(external_ref), pedido_data)
+        batch.commit()
         
         response_data = {
             "preference_id": preference.get("id"),
@@ -2561,6 +2846,23 @@ def debug_mp():
         return jsonify({'error': 'Error interno', 'message': str(e)}), 500
 
 
+@app.route('/debug/cache')
+def debug_cache():
+    if not session.get('email'):
+        return jsonify({'error': 'sin sesión'}), 400
+
+    return jsonify({
+        'catalogo': cache_catalogo.estadisticas(),
+        'producto': cache_producto.estadisticas(),
+        'singleflight': singleflight.estadisticas(),
+        'catalogo_caliente': catalogo_caliente.estadisticas(),
+        'publicador_r2': publicador_catalogo.estadisticas(),
+        'clientes_mp': clientes_mercadopago.estadisticas(),
+        'stock_fragmentado': promotor_fragmentos.estadisticas(),
+        'cola_webhooks': cola_webhooks.estadisticas()
+    })
+
+
 @app.route('/login-admin', methods=['POST'])
 def login_admin():
     data = request.get_json(silent=True) or {}
@@ -2662,6 +2964,7 @@ def guardar_producto():
                 resultado = subir_a_firestore(producto, email, es_edicion=True)
             else:
                 doc_ref = docs[0].reference
+                docs = [preparar_edicion_stock(db, email, docs[0])]
                 
                 datos_actualizar = {
                     'nombre': producto.get('nombre'),
@@ -2682,9 +2985,12 @@ def guardar_producto():
                     datos_actualizar['variantes'] = producto.get('variantes')
                 if 'stock' in producto:
                     datos_actualizar['stock'] = producto.get('stock')
+
+                datos_actualizar['tiene_stock_por_talle'] = bool(datos_actualizar['stock_por_talle']) and not datos_actualizar.get('tiene_variantes')
+                datos_actualizar.update(stock_canonico({**(docs[0].to_dict() or {}), **datos_actualizar}))
                 
                 doc_ref.update(datos_actualizar)
-                update_products_last_modified(email)
+                update_products_last_modified(email, [doc_ref.id])
                 resultado = {
                     'id_base': id_base,
                     'accion': 'actualizado',
@@ -2761,7 +3067,7 @@ def eliminar_producto():
 
         doc = query[0]
         doc.reference.delete()
-        update_products_last_modified(email)
+        update_products_last_modified(email, [doc.id])
         return jsonify({"status": "ok", "id_base": id_base})
 
     except Exception as e:
@@ -2991,24 +3297,19 @@ def step3():
             bloques.append(bloque)
 
         session['bloques'] = bloques
-        exitos = 0
-
-        def subir_con_resultado(producto):
-            try:
-                resultado = subir_a_firestore(producto, email)
-                if isinstance(resultado, dict):
-                    return resultado.get("status") == "ok" or resultado.get("ok") == True
-                else:
-                    return bool(resultado)
-            except Exception:
-                return False
 
-        bloques_por_lote = 10
-        for inicio in range(0, len(bloques), bloques_por_lote):
-            lote = bloques[inicio:inicio + bloques_por_lote]
-            with ThreadPoolExecutor(max_workers=3) as executor:
-                resultados = list(executor.map(subir_con_resultado, lote))
-            exitos += sum(1 for r in resultados if r)
+        # Los productos se confirman en WriteBatch de hasta 400 escrituras en vez de un RPC por producto.
+        # Un producto cuenta como guardado recién cuando su lote se confirmó (un lote fallido no suma)
+        escritor = EscritorLotes(db)
+        try:
+            with escritor:
+                for producto in bloques:
+                    subir_a_firestore(producto, email, escritor=escritor)
+        except Exception as e:
+            print(f"Error confirmando productos: {e}")
+        exitos = escritor.escrituras
+        if escritor.commits > 0:
+            update_products_last_modified(email)
 
         grupos_dict = {}
         for producto in bloques:
@@ -3129,6 +3430,10 @@ def step3():
     
 
 def get_mp_public_key(email: str):
+    return singleflight.hacer(("mp_public_key", email), lambda: _obtener_mp_public_key(email))
+
+
+def _obtener_mp_public_key(email: str):
     try:
         if email:
             doc_ref = db.collection("usuarios").document(email).collection("config").document("mercado_pago")
@@ -3358,6 +3663,17 @@ def api_mp_public_key():
 
     return jsonify({"public_key": public_key})
         
+def cargar_productos_preview(email):
+    productos = []
+    productos_ref = db.collection("usuarios").document(email).collection("productos")
+    for doc in productos_ref.stream():
+        data = asegurar_stock_canonico(doc.to_dict())
+        data['stock_total'] = data['stock']
+        productos.append(data)
+        
+    return sorted(productos, key=lambda p: p.get('orden', 0))
+
+
 @app.route('/preview', methods=["GET"])
 def preview():
     email = request.args.get('email') or session.get("email")
@@ -3375,26 +3691,7 @@ def preview():
 
     productos = []
     try:
-        productos_ref = db.collection("usuarios").document(email).collection("productos")
-        for doc in productos_ref.stream():
-            data = doc.to_dict()
-
-            tiene_variantes = data.get('tiene_variantes', False)
-            variantes = data.get('variantes', {})
-            
-            if tiene_variantes and variantes:
-                stock_total = sum(v.get('stock', 0) for v in variantes.values())
-                disponible = stock_total > 0
-            else:
-                stock_total = data.get('stock', 0)
-                disponible = stock_total > 0
-            
-            data['stock_total'] = stock_total
-            data['disponible'] = disponible
-            
-            productos.append(data)
-            
-        productos = sorted(productos, key=lambda p: p.get('orden', 0))
+        productos = singleflight.hacer(("preview", email), lambda: cargar_productos_preview(email))
     except Exception as e:
         pass
 
@@ -3520,6 +3817,46 @@ def cache(response):
         response.headers["Cache-Control"] = "public, max-age=31536000"
     return response
 
+@app.cli.command("migrar-stock")
+@click.option("--email", default=None, help="Migrar solo este vendedor (por defecto, todos)")
+def migrar_stock(email):
+    """Reescribe los productos al modelo de stock unificado por variantes."""
+    if not db:
+        raise click.ClickException("Firestore no inicializado")
+    migrados = migrar_stock_canonico(db, email)
+    click.echo(f"Productos migrados: {migrados}")
+
+
+@app.cli.command("migrar-pedidos")
+@click.option("--email", default=None, help="Migrar solo este vendedor (por defecto, todos)")
+def migrar_pedidos_cli(email):
+    """Completa los pedidos viejos con los campos que usa /api/pedidos (búsqueda por cliente y estado)."""
+    if not db:
+        raise click.ClickException("Firestore no inicializado")
+    click.echo(f"Pedidos migrados: {migrar_pedidos(db, email)}")
+
+
+@app.cli.command("worker-webhooks")
+def worker_webhooks():
+    """Procesa la cola del webhook de MP: pagos, envíos a Correo Argentino y comprobantes."""
+    if not db:
+        raise click.ClickException("Firestore no inicializado")
+    click.echo(f"Worker de webhooks escuchando {cola_webhooks.ruta}")
+    ejecutar_worker(cola_webhooks, {
+        "pago_mp": procesar_pago_mp,
+        "envio_correo_argentino": procesar_envio_correo_argentino,
+        "comprobante": procesar_comprobante
+    })
+
+
+@app.cli.command("liberar-reservas")
+def liberar_reservas_cli():
+    """Borra las reservas de stock vencidas de todos los vendedores."""
+    if not db:
+        raise click.ClickException("Firestore no inicializado")
+    click.echo(f"Reservas liberadas: {liberar_reservas_vencidas(db)}")
+
+
 if __name__ == '__main__':
     limpiar_imagenes_usuario()
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,192 @@
+import os
+import re
+import math
+import time
+import bisect
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from catalogo import leer_catalogo, leer_cambios_catalogo
+from stock_fragmentado import con_stock_fragmentado
+
+BUSQUEDA_MAX_VENDEDORES = int(os.getenv("BUSQUEDA_MAX_VENDEDORES", "50"))
+# Cada cuánto un worker trae del snapshot los cambios hechos por otros workers
+BUSQUEDA_SYNC_SEG = float(os.getenv("BUSQUEDA_SYNC_SEG", "10"))
+
+# Peso de cada campo en el puntaje de un término
+CAMPOS_BUSQUEDA = {"nombre": 3.0, "grupo": 2.0, "subgrupo": 2.0, "descripcion": 1.0}
+
+STOPWORDS = {
+    "a", "al", "con", "de", "del", "el", "en", "la", "las", "lo", "los", "o", "para",
+    "por", "que", "se", "sin", "su", "sus", "un", "una", "unas", "unos", "y"
+}
+
+_PALABRA = re.compile(r"[a-z0-9]+")
+
+
+def plegar(texto):
+    """Minúsculas y sin tildes ni diéresis ("Camión Ñandú" -> "camion nandu")."""
+    descompuesto = unicodedata.normalize("NFKD", str(texto or "").lower())
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+
+def raiz(palabra):
+    """Stemming liviano para español: quita el plural (remeras -> remera, pantalones -> pantalon)."""
+    if len(palabra) > 4 and palabra.endswith("es") and palabra[-3] not in "aeiou":
+        return palabra[:-2]
+    if len(palabra) > 3 and palabra.endswith("s") and not palabra.endswith("ss"):
+        return palabra[:-1]
+    return palabra
+
+
+def tokenizar(texto):
+    return [raiz(p) for p in _PALABRA.findall(plegar(texto)) if p not in STOPWORDS]
+
+
+class IndiceBusqueda:
+    """Índice invertido de los productos de un vendedor: término -> {id: peso}."""
+
+    def __init__(self):
+        self.terminos = {}
+        self.ordenados = []
+        self.por_producto = {}
+        self.productos = {}
+        self.version = 0
+        self.sincronizado = 0.0
+        self.lock = threading.Lock()
+
+    def indexar(self, producto):
+        pid = producto["id"]
+        self.quitar(pid)
+        pesos = {}
+        for campo, peso in CAMPOS_BUSQUEDA.items():
+            for termino in tokenizar(producto.get(campo)):
+                pesos[termino] = pesos.get(termino, 0.0) + peso
+        for termino, peso in pesos.items():
+            if termino not in self.terminos:
+                self.terminos[termino] = {}
+                bisect.insort(self.ordenados, termino)
+            self.terminos[termino][pid] = peso
+        self.por_producto[pid] = set(pesos)
+        self.productos[pid] = producto
+
+    def quitar(self, pid):
+        for termino in self.por_producto.pop(pid, ()):
+            postings = self.terminos.get(termino)
+            if postings is None:
+                continue
+            postings.pop(pid, None)
+            if not postings:
+                del self.terminos[termino]
+                i = bisect.bisect_left(self.ordenados, termino)
+                if i < len(self.ordenados) and self.ordenados[i] == termino:
+                    del self.ordenados[i]
+        self.productos.pop(pid, None)
+
+    def _postings_prefijo(self, prefijo):
+        """Une los postings de todos los términos que empiezan con `prefijo` (búsqueda mientras se escribe)."""
+        unidos = {}
+        i = bisect.bisect_left(self.ordenados, prefijo)
+        while i < len(self.ordenados) and self.ordenados[i].startswith(prefijo):
+            for pid, peso in self.terminos[self.ordenados[i]].items():
+                unidos[pid] = max(unidos.get(pid, 0.0), peso)
+            i += 1
+        return unidos
+
+    def buscar(self, consulta, limite):
+        """Productos que contienen todos los términos (el último como prefijo), ordenados por relevancia.
+
+        Devuelve (productos, total_coincidencias).
+        """
+        palabras = [p for p in _PALABRA.findall(plegar(consulta)) if p not in STOPWORDS]
+        if not palabras:
+            return [], 0
+        listas = [self.terminos.get(raiz(p), {}) for p in palabras[:-1]]
+        listas.append(self._postings_prefijo(raiz(palabras[-1])))
+
+        total_docs = len(self.productos) or 1
+        puntajes = None
+        for postings in sorted(listas, key=len):
+            idf = math.log(1 + total_docs / (len(postings) or 1))
+            if puntajes is None:
+                puntajes = {pid: peso * idf for pid, peso in postings.items()}
+            else:
+                puntajes = {pid: p + postings[pid] * idf for pid, p in puntajes.items() if pid in postings}
+            if not puntajes:
+                return [], 0
+
+        mejores = sorted(
+            puntajes,
+            key=lambda pid: (-puntajes[pid], self.productos[pid].get("orden") or 0)
+        )[:limite]
+        return [self.productos[pid] for pid in mejores], len(puntajes)
+
+
+class IndicesBusqueda:
+    """Índices por vendedor en memoria (LRU), mantenidos al día con el feed de cambios del catálogo.
+
+    `crear` construye el índice vacío de un vendedor; debe exponer indexar(producto), quitar(id),
+    `productos`, `version`, `sincronizado` y `lock` como IndiceBusqueda.
+    """
+
+    def __init__(self, db, crear=IndiceBusqueda, max_vendedores=BUSQUEDA_MAX_VENDEDORES,
+                 intervalo=BUSQUEDA_SYNC_SEG):
+        self.db = db
+        self.crear = crear
+        self.max_vendedores = max_vendedores
+        self.intervalo = intervalo
+        self._indices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _indice(self, email):
+        with self._lock:
+            indice = self._indices.get(email)
+            if indice is None:
+                indice = self.crear()
+                self._indices[email] = indice
+                while len(self._indices) > self.max_vendedores:
+                    self._indices.popitem(last=False)
+            self._indices.move_to_end(email)
+        return indice
+
+    def _sincronizar(self, email, indice, forzar=False):
+        with indice.lock:
+            if not forzar and indice.sincronizado and time.monotonic() - indice.sincronizado < self.intervalo:
+                return
+            if not indice.sincronizado:
+                productos, version = leer_catalogo(self.db, email)
+                for producto in con_stock_fragmentado(self.db, email, productos):
+                    indice.indexar(producto)
+            else:
+                cambios = leer_cambios_catalogo(self.db, email, indice.version)
+                if cambios["completo"]:
+                    for pid in list(indice.productos):
+                        indice.quitar(pid)
+                for pid in cambios["eliminados"]:
+                    indice.quitar(pid)
+                for producto in cambios["productos"]:
+                    indice.indexar(producto)
+                version = cambios["version"]
+            indice.version = version
+            indice.sincronizado = time.monotonic()
+
+    def consultar(self, email, fn, version=None):
+        """Ejecuta `fn(indice)` sobre el índice sincronizado del vendedor.
+
+        Con `version` (la del snapshot), un índice que quedó atrás se sincroniza en el acto.
+        """
+        indice = self._indice(email)
+        self._sincronizar(email, indice, forzar=version is not None and indice.sincronizado and version != indice.version)
+        with indice.lock:
+            return fn(indice)
+
+    def buscar(self, email, consulta, limite=20, version=None):
+        return self.consultar(email, lambda indice: indice.buscar(consulta, limite), version)
+
+    def actualizar(self, email):
+        """Aplica los cambios recién escritos si el vendedor ya tiene índice en este worker."""
+        with self._lock:
+            indice = self._indices.get(email)
+        if indice is not None and indice.sincronizado:
+            self._sincronizar(email, indice, forzar=True)
@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheLRU:
+    """LRU en memoria acotada por bytes totales, con stale-while-revalidate.
+
+    Dentro de `ttl` segundos una entrada se sirve tal cual; hasta `ttl + stale_ttl`
+    se sirve vencida mientras un único hilo en segundo plano la recarga.
+    """
+
+    def __init__(self, max_bytes, ttl, stale_ttl=0, medir=len):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.medir = medir
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._refrescando = set()
+        self._invalidaciones = {}
+        self._lock = threading.Lock()
+        self._contadores = {"hits": 0, "stale": 0, "misses": 0, "evictions": 0, "refrescos": 0, "errores_refresco": 0}
+
+    def obtener(self, clave, cargar):
+        """Devuelve el valor cacheado o lo carga con `cargar()`."""
+        ahora = time.monotonic()
+        refrescar = False
+        with self._lock:
+            generacion = self._invalidaciones.get(clave, 0)
+            entrada = self._entradas.get(clave)
+            if entrada is not None:
+                valor, _, creado = entrada
+                edad = ahora - creado
+                if edad < self.ttl:
+                    self._entradas.move_to_end(clave)
+                    self._contadores["hits"] += 1
+                    return valor
+                if edad < self.ttl + self.stale_ttl:
+                    self._entradas.move_to_end(clave)
+                    self._contadores["stale"] += 1
+                    if clave not in self._refrescando:
+                        self._refrescando.add(clave)
+                        refrescar = True
+                else:
+                    self._quitar(clave)
+                    entrada = None
+            if entrada is None:
+                self._contadores["misses"] += 1
+
+        if entrada is not None:
+            if refrescar:
+                threading.Thread(target=self._refrescar, args=(clave, cargar, generacion), daemon=True).start()
+            return entrada[0]
+
+        valor = cargar()
+        self.guardar(clave, valor, generacion)
+        return valor
+
+    def _refrescar(self, clave, cargar, generacion):
+        try:
+            self.guardar(clave, cargar(), generacion)
+            with self._lock:
+                self._contadores["refrescos"] += 1
+        except Exception:
+            with self._lock:
+                self._contadores["errores_refresco"] += 1
+        finally:
+            with self._lock:
+                self._refrescando.discard(clave)
+
+    def guardar(self, clave, valor, generacion=None):
+        tamaño = self.medir(valor)
+        with self._lock:
+            # Una carga iniciada antes de invalidar() no debe pisar el dato nuevo
+            if generacion is not None and generacion != self._invalidaciones.get(clave, 0):
+                return
+            self._quitar(clave)
+            if tamaño > self.max_bytes:
+                return
+            self._entradas[clave] = (valor, tamaño, time.monotonic())
+            self._bytes += tamaño
+            while self._bytes > self.max_bytes:
+                _, (_, tamaño_viejo, _) = self._entradas.popitem(last=False)
+                self._bytes -= tamaño_viejo
+                self._contadores["evictions"] += 1
+
+    def _quitar(self, clave):
+        entrada = self._entradas.pop(clave, None)
+        if entrada is not None:
+            self._bytes -= entrada[1]
+
+    def invalidar(self, clave):
+        with self._lock:
+            self._invalidaciones[clave] = self._invalidaciones.get(clave, 0) + 1
+            self._quitar(clave)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                **self._contadores,
+                "entradas": len(self._entradas),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+class _Llamada:
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.error = None
+
+
+class SingleFlight:
+    """Agrupa llamadas concurrentes con la misma clave: una sola ejecuta `fn`, el resto espera su resultado."""
+
+    def __init__(self):
+        self._en_curso = {}
+        self._lock = threading.Lock()
+        self._contadores = {"ejecuciones": 0, "compartidas": 0}
+
+    def hacer(self, clave, fn):
+        with self._lock:
+            llamada = self._en_curso.get(clave)
+            lider = llamada is None
+            if lider:
+                llamada = _Llamada()
+                self._en_curso[clave] = llamada
+                self._contadores["ejecuciones"] += 1
+            else:
+                self._contadores["compartidas"] += 1
+
+        if not lider:
+            llamada.evento.wait()
+            if llamada.error is not None:
+                raise llamada.error
+            return llamada.resultado
+
+        try:
+            llamada.resultado = fn()
+            return llamada.resultado
+        except Exception as e:
+            llamada.error = e
+            raise
+        finally:
+            with self._lock:
+                self._en_curso.pop(clave, None)
+            llamada.evento.set()
+
+    def estadisticas(self):
+        with self._lock:
+            return {**self._contadores, "en_curso": len(self._en_curso)}
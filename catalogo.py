@@ -0,0 +1,463 @@
+import os
+import json
+import math
+import zlib
+import base64
+from google.api_core.exceptions import InvalidArgument, NotFound
+from google.cloud.firestore import SERVER_TIMESTAMP, DELETE_FIELD, FieldPath, transactional
+
+# Snapshot del catálogo normalizado por vendedor:
+#   usuarios/{email}/metadata/catalogo      -> shard 0 + cabecera (version, shards)
+#   usuarios/{email}/metadata/catalogo_{i}  -> shards adicionales (i >= 1)
+# Firestore limita los documentos a 1 MiB, por eso los catálogos grandes se reparten.
+CATALOGO_DOC = "catalogo"
+CATALOGO_SHARD_BYTES = int(os.getenv("CATALOGO_SHARD_BYTES", str(700 * 1024)))
+# Bajas recordadas para la sincronización incremental (?since=); más antiguas => catálogo completo
+CATALOGO_MAX_TOMBSTONES = int(os.getenv("CATALOGO_MAX_TOMBSTONES", "500"))
+
+SISTEMA_STOCK = "variantes_unificado"
+
+# Campos del esquema normalizado que se derivan de los campos de stock del documento
+CAMPOS_STOCK = {"stock", "stock_por_talle", "disponible", "variantes", "talles", "colores", "tiene_variantes"}
+CAMPOS_FUENTE_STOCK = CAMPOS_STOCK | {"tiene_stock_por_talle", "sistema_stock", "stock_fragmentado"}
+
+
+def _lista(valor):
+    if isinstance(valor, str):
+        return [v.strip() for v in valor.split(",") if v.strip()]
+    return list(valor) if isinstance(valor, list) else []
+
+
+def _entero(valor):
+    try:
+        return int(valor or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def stock_canonico(data):
+    """Campos de stock en la representación canónica a partir de cualquiera de los tres esquemas.
+
+    Todo producto queda expresado como `variantes` (talle x color), con el total y las sumas
+    por talle ya calculadas.
+    """
+    if data.get("tiene_variantes", False):
+        variantes = {
+            clave: {
+                "talle": var.get("talle", ""),
+                "color": var.get("color", ""),
+                "stock": _entero(var.get("stock")),
+                "imagen_url": var.get("imagen_url", "")
+            }
+            for clave, var in (data.get("variantes") or {}).items()
+        }
+        talles = _lista(data.get("talles"))
+        colores = _lista(data.get("colores"))
+    elif data.get("tiene_stock_por_talle", False):
+        stock_pt = data.get("stock_por_talle") or {}
+        if "unico" in stock_pt:
+            variantes = {"unico_unico": {"talle": "unico", "color": "unico", "stock": _entero(stock_pt["unico"]), "imagen_url": ""}}
+            talles = ["unico"]
+            colores = ["unico"]
+        else:
+            variantes = {}
+            for talle, stock in stock_pt.items():
+                key = f"{talle}_General".replace(" ", "_")
+                variantes[key] = {"talle": talle, "color": "General", "stock": _entero(stock), "imagen_url": ""}
+            talles = list(stock_pt.keys())
+            colores = ["General"]
+    else:
+        variantes = {"unico_unico": {"talle": "unico", "color": "unico", "stock": _entero(data.get("stock")), "imagen_url": ""}}
+        talles = ["unico"]
+        colores = ["unico"]
+
+    stock_por_talle = {}
+    stock_total = 0
+    for var in variantes.values():
+        talle = var.get("talle")
+        if talle:
+            stock_por_talle[talle] = stock_por_talle.get(talle, 0) + var["stock"]
+        stock_total += var["stock"]
+    if not stock_por_talle:
+        stock_por_talle = {"unico": 0}
+        stock_total = 0
+
+    return {
+        "tiene_variantes": True,
+        "variantes": variantes,
+        "talles": talles,
+        "colores": colores,
+        "stock": stock_total,
+        "stock_por_talle": stock_por_talle,
+        "disponible": stock_total > 0,
+        "tiene_stock_por_talle": False,
+        "sistema_stock": SISTEMA_STOCK
+    }
+
+
+def asegurar_stock_canonico(data):
+    """Devuelve el documento con stock canónico; los ya migrados pasan sin recalcular."""
+    data = data or {}
+    if data.get("sistema_stock") == SISTEMA_STOCK:
+        return data
+    return {**data, **stock_canonico(data)}
+
+
+def buscar_variante(variantes, talle, color=None):
+    """Clave de la variante que corresponde a talle/color, o None si es ambigua o no existe."""
+    talle = str(talle or "").strip()
+    color = str(color or "").strip()
+    if talle and color:
+        clave = f"{talle}_{color}".replace(" ", "_")
+        if clave in variantes:
+            return clave
+        for clave, var in variantes.items():
+            if (str(var.get("talle", "")).strip().lower() == talle.lower() and
+                    str(var.get("color", "")).strip().lower() == color.lower()):
+                return clave
+    candidatas = [
+        clave for clave, var in variantes.items()
+        if not talle or str(var.get("talle", "")).strip().lower() == talle.lower()
+    ]
+    if len(candidatas) == 1:
+        return candidatas[0]
+    if len(variantes) == 1:
+        return next(iter(variantes))
+    return None
+
+
+def stock_disponible(data, talle, color=None):
+    """Stock vendible de un producto (canónico) para el talle/color pedido."""
+    stock_por_talle = data.get("stock_por_talle") or {}
+    if set(stock_por_talle) == {"unico"}:
+        return _entero(data.get("stock"))
+    if color:
+        clave = buscar_variante(data.get("variantes") or {}, talle, color)
+        if clave:
+            return _entero(data["variantes"][clave].get("stock"))
+    return _entero(stock_por_talle.get(talle, 0))
+
+
+def normalizar_producto(doc_id, data):
+    """Convierte un documento de producto al esquema 'variantes_unificado' que consume el front."""
+    data = asegurar_stock_canonico(data)
+
+    fotos_adicionales = data.get("fotos_adicionales", [])
+    if not isinstance(fotos_adicionales, list):
+        fotos_adicionales = []
+
+    return {
+        "id": doc_id,
+        "id_base": data.get("id_base"),
+        "nombre": data.get("nombre"),
+        "precio": data.get("precio"),
+        "stock": data.get("stock", 0),
+        "stock_por_talle": data.get("stock_por_talle") or {"unico": 0},
+        "disponible": data.get("disponible", False),
+        "grupo": data.get("grupo"),
+        "subgrupo": data.get("subgrupo"),
+        "descripcion": data.get("descripcion"),
+        "imagen_url": data.get("imagen_url"),
+        "fotos_adicionales": fotos_adicionales,
+        "precio_anterior": data.get("precio_anterior", 0),
+        "orden": data.get("orden"),
+        "talles": _lista(data.get("talles")),
+        "colores": _lista(data.get("colores")),
+        "variantes": data.get("variantes") or {},
+        "tiene_variantes": True,
+        "tiene_stock_por_talle": False,
+        "sistema_stock": SISTEMA_STOCK,
+        "stock_fragmentado": data.get("stock_fragmentado", 0),
+        "timestamp": str(data.get("timestamp")) if data.get("timestamp") else None
+    }
+
+
+def ordenar_productos(productos):
+    """Orden de presentación del catálogo (campo 'orden')."""
+    return sorted(productos, key=lambda p: p.get("orden") or 0)
+
+
+def _con_fragmentos(db, email, productos):
+    # stock_fragmentado importa este módulo: se importa recién al usarlo
+    from stock_fragmentado import con_stock_fragmentado
+    return con_stock_fragmentado(db, email, productos)
+
+
+def _productos_ref(db, email):
+    return db.collection("usuarios").document(email).collection("productos")
+
+
+def _shard_ref(db, email, indice):
+    nombre = CATALOGO_DOC if indice == 0 else f"{CATALOGO_DOC}_{indice}"
+    return db.collection("usuarios").document(email).collection("metadata").document(nombre)
+
+
+def _shard_de(producto_id, shards):
+    return zlib.crc32(producto_id.encode("utf-8")) % shards if shards > 1 else 0
+
+
+@transactional
+def _reconstruir_en_transaccion(transaccion, db, email):
+    # Cabecera y productos se leen en la misma transacción que escribe el snapshot: un parche
+    # concurrente (_parchear_catalogo) hace que una de las dos se reintente en vez de pisarse
+    cabecera = _shard_ref(db, email, 0).get(transaction=transaccion)
+    datos_cabecera = cabecera.to_dict() if cabecera.exists else {}
+    version = int(datos_cabecera.get("version", 0)) + 1
+    shards_anteriores = int(datos_cabecera.get("shards", 1))
+
+    normalizados = {}
+    total_bytes = 0
+    for doc in _productos_ref(db, email).get(transaction=transaccion):
+        producto = normalizar_producto(doc.id, doc.to_dict())
+        normalizados[doc.id] = producto
+        total_bytes += len(json.dumps(producto, default=str))
+
+    shards = max(1, math.ceil(total_bytes / CATALOGO_SHARD_BYTES))
+    contenido = [{} for _ in range(shards)]
+    for producto_id, producto in normalizados.items():
+        contenido[_shard_de(producto_id, shards)][producto_id] = producto
+
+    # Sin historial previo confiable: cualquier cliente con una versión anterior recibe el catálogo completo
+    transaccion.set(_shard_ref(db, email, 0), {
+        "productos": contenido[0],
+        "versiones": {producto_id: version for producto_id in contenido[0]},
+        "shards": shards,
+        "version": version,
+        "tombstones": {},
+        "tombstones_desde": version,
+        # Su stock vive en los fragmentos: el feed de cambios los incluye siempre
+        "fragmentados": sorted(pid for pid, producto in normalizados.items() if producto.get("stock_fragmentado")),
+        "actualizado": SERVER_TIMESTAMP
+    })
+    for indice in range(1, shards):
+        transaccion.set(_shard_ref(db, email, indice), {
+            "productos": contenido[indice],
+            "versiones": {producto_id: version for producto_id in contenido[indice]}
+        })
+    for indice in range(shards, shards_anteriores):
+        transaccion.delete(_shard_ref(db, email, indice))
+
+    return ordenar_productos(normalizados.values()), version
+
+
+def reconstruir_catalogo(db, email):
+    """Recorre la colección de productos y reescribe el snapshot completo. Retorna (productos, version)."""
+    return _reconstruir_en_transaccion(db.transaction(), db, email)
+
+
+@transactional
+def _parchear_catalogo(transaccion, db, email, ids):
+    cabecera = _shard_ref(db, email, 0).get(transaction=transaccion)
+    if not cabecera.exists:
+        return False
+
+    datos = cabecera.to_dict() or {}
+    shards = int(datos.get("shards", 1))
+    version = int(datos.get("version", 0)) + 1
+    tombstones = dict(datos.get("tombstones") or {})
+    tombstones_desde = int(datos.get("tombstones_desde", 0))
+    fragmentados = set(datos.get("fragmentados") or [])
+
+    refs = [_productos_ref(db, email).document(producto_id) for producto_id in ids]
+    cambios = [{} for _ in range(shards)]
+    for snap in transaccion.get_all(refs):
+        campos = cambios[_shard_de(snap.id, shards)]
+        ruta_producto = FieldPath("productos", snap.id).to_api_repr()
+        ruta_version = FieldPath("versiones", snap.id).to_api_repr()
+        if snap.exists:
+            campos[ruta_producto] = normalizar_producto(snap.id, snap.to_dict())
+            campos[ruta_version] = version
+            tombstones.pop(snap.id, None)
+            if campos[ruta_producto]["stock_fragmentado"]:
+                fragmentados.add(snap.id)
+            else:
+                fragmentados.discard(snap.id)
+        else:
+            fragmentados.discard(snap.id)
+            campos[ruta_producto] = DELETE_FIELD
+            campos[ruta_version] = DELETE_FIELD
+            tombstones[snap.id] = version
+
+    if len(tombstones) > CATALOGO_MAX_TOMBSTONES:
+        ordenados = sorted(tombstones.items(), key=lambda item: item[1])
+        descartados = ordenados[:len(ordenados) - CATALOGO_MAX_TOMBSTONES]
+        tombstones_desde = max(tombstones_desde, descartados[-1][1])
+        tombstones = dict(ordenados[len(descartados):])
+
+    cambios[0].update({
+        "version": version,
+        "tombstones": tombstones,
+        "tombstones_desde": tombstones_desde,
+        "fragmentados": sorted(fragmentados),
+        "actualizado": SERVER_TIMESTAMP
+    })
+    for indice, campos in enumerate(cambios):
+        if campos:
+            transaccion.update(_shard_ref(db, email, indice), campos)
+    return True
+
+
+def actualizar_productos_catalogo(db, email, ids):
+    """Aplica al snapshot el estado actual de los productos indicados (alta, edición o baja).
+
+    Cada llamada incrementa la versión del catálogo dentro de una transacción, de modo que la
+    secuencia de cambios del vendedor es monótona y sirve para la sincronización incremental.
+    """
+    try:
+        parcheado = _parchear_catalogo(db.transaction(), db, email, sorted(set(ids)))
+    except (NotFound, InvalidArgument):
+        # Shard inexistente o que supera el límite de tamaño: se vuelve a repartir desde cero.
+        # La contención (Aborted) ya la reintenta la transacción; si se agota, que llegue al llamador.
+        parcheado = False
+    if not parcheado:
+        return reconstruir_catalogo(db, email)
+    return None
+
+
+def _leer_shards(db, email, cabecera):
+    datos = cabecera.to_dict() or {}
+    productos = dict(datos.get("productos") or {})
+    versiones = dict(datos.get("versiones") or {})
+    shards = int(datos.get("shards", 1))
+    if shards > 1:
+        refs = [_shard_ref(db, email, indice) for indice in range(1, shards)]
+        for snap in db.get_all(refs):
+            if snap.exists:
+                datos_shard = snap.to_dict() or {}
+                productos.update(datos_shard.get("productos") or {})
+                versiones.update(datos_shard.get("versiones") or {})
+    return datos, productos, versiones
+
+
+def leer_catalogo(db, email):
+    """Lee el snapshot del vendedor (una lectura si entra en un solo shard). Retorna (productos, version)."""
+    cabecera = _shard_ref(db, email, 0).get()
+    if not cabecera.exists:
+        return reconstruir_catalogo(db, email)
+
+    datos, productos, _ = _leer_shards(db, email, cabecera)
+    return ordenar_productos(productos.values()), int(datos.get("version", 0))
+
+
+def version_catalogo(db, email):
+    """Versión actual del snapshot del vendedor (lee solo ese campo de la cabecera)."""
+    cabecera = _shard_ref(db, email, 0).get(field_paths=["version"])
+    return int((cabecera.to_dict() or {}).get("version", 0)) if cabecera.exists else 0
+
+
+def leer_cambios_catalogo(db, email, desde):
+    """Productos creados o modificados después de la versión `desde`, más los ids eliminados.
+
+    Si `desde` es anterior al historial de bajas conservado, responde el catálogo completo. Los productos
+    con stock fragmentado van siempre, con el stock sumado de sus fragmentos: las ventas no cambian la versión.
+    """
+    cabecera = _shard_ref(db, email, 0).get()
+    if not cabecera.exists:
+        productos, version = reconstruir_catalogo(db, email)
+        return {"version": version, "completo": True, "productos": _con_fragmentos(db, email, productos), "eliminados": []}
+
+    datos_cabecera = cabecera.to_dict() or {}
+    version = int(datos_cabecera.get("version", 0))
+    fragmentados = set(datos_cabecera.get("fragmentados") or [])
+    if desde == version and not fragmentados:
+        return {"version": version, "completo": False, "productos": [], "eliminados": []}
+
+    datos, productos, versiones = _leer_shards(db, email, cabecera)
+    if desde <= 0 or desde > version or desde < int(datos.get("tombstones_desde", 0)):
+        return {
+            "version": version,
+            "completo": True,
+            "productos": _con_fragmentos(db, email, ordenar_productos(productos.values())),
+            "eliminados": []
+        }
+
+    return {
+        "version": version,
+        "completo": False,
+        "productos": _con_fragmentos(db, email, ordenar_productos(
+            producto for producto_id, producto in productos.items()
+            if producto_id in fragmentados or versiones.get(producto_id, version) > desde
+        )),
+        "eliminados": [producto_id for producto_id, v in (datos.get("tombstones") or {}).items() if v > desde]
+    }
+
+
+def _codificar_cursor(orden, producto_id):
+    crudo = json.dumps([orden, producto_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(crudo).decode("ascii")
+
+
+def _decodificar_cursor(cursor):
+    orden, producto_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return orden, producto_id
+
+
+def listar_productos(db, email, limite, cursor=None, grupo=None, subgrupo=None, campos=None):
+    """Página de productos ordenada por 'orden', con filtros de grupo/subgrupo y proyección de campos.
+
+    Los filtros y el select() se resuelven en Firestore. Retorna (productos, cursor_siguiente).
+    """
+    productos_ref = _productos_ref(db, email)
+    query = productos_ref
+    if grupo:
+        query = query.where("grupo", "==", grupo)
+    if subgrupo:
+        query = query.where("subgrupo", "==", subgrupo)
+    query = query.order_by("orden").order_by(FieldPath.document_id())
+
+    if campos:
+        campos = set(campos) | {"id"}
+        fuente = (campos - {"id"}) | {"orden"}
+        if fuente & CAMPOS_STOCK:
+            fuente |= CAMPOS_FUENTE_STOCK
+        query = query.select(sorted(fuente))
+
+    if cursor:
+        orden, producto_id = _decodificar_cursor(cursor)
+        query = query.start_after([orden, productos_ref.document(producto_id)])
+
+    docs = list(query.limit(limite + 1).stream())
+    siguiente = None
+    if len(docs) > limite:
+        docs = docs[:limite]
+        ultimo = docs[-1]
+        siguiente = _codificar_cursor((ultimo.to_dict() or {}).get("orden"), ultimo.id)
+
+    productos = [normalizar_producto(doc.id, doc.to_dict()) for doc in docs]
+    if not campos or campos & CAMPOS_STOCK:
+        productos = _con_fragmentos(db, email, productos)
+    if campos:
+        productos = [{campo: valor for campo, valor in producto.items() if campo in campos} for producto in productos]
+    return productos, siguiente
+
+
+def migrar_stock_canonico(db, email=None, tamaño_lote=400):
+    """Reescribe en lotes los productos que todavía no tienen el stock canónico. Retorna la cantidad migrada."""
+    if email:
+        vendedores = [email]
+    else:
+        vendedores = [doc.id for doc in db.collection("usuarios").select([]).stream()]
+
+    migrados = 0
+    for vendedor in vendedores:
+        batch = db.batch()
+        pendientes = 0
+        migrados_vendedor = 0
+        for doc in _productos_ref(db, vendedor).stream():
+            data = doc.to_dict() or {}
+            if data.get("sistema_stock") == SISTEMA_STOCK:
+                continue
+            batch.update(doc.reference, stock_canonico(data))
+            pendientes += 1
+            if pendientes >= tamaño_lote:
+                batch.commit()
+                batch = db.batch()
+                migrados_vendedor += pendientes
+                pendientes = 0
+        if pendientes:
+            batch.commit()
+            migrados_vendedor += pendientes
+        if migrados_vendedor:
+            reconstruir_catalogo(db, vendedor)
+        migrados += migrados_vendedor
+    return migrados
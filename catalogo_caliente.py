@@ -0,0 +1,189 @@
+import os
+import math
+import threading
+import time
+
+from catalogo import normalizar_producto, ordenar_productos
+
+HOT_CATALOGO_MAX_LISTENERS = int(os.getenv("HOT_CATALOGO_MAX_LISTENERS", "20"))
+HOT_CATALOGO_UMBRAL_RPM = float(os.getenv("HOT_CATALOGO_UMBRAL_RPM", "60"))
+HOT_CATALOGO_REVISION_SEG = 30
+# Un listener sin snapshots en este plazo se vuelve a abrir: acota lo viejo que puede estar el catálogo en memoria
+HOT_CATALOGO_MAX_EDAD_SEG = float(os.getenv("HOT_CATALOGO_MAX_EDAD_SEG", "300"))
+# Constante de tiempo del promedio exponencial de peticiones (segundos)
+_TAU = 60.0
+
+
+class _Tasa:
+    """Peticiones por minuto con decaimiento exponencial (sin guardar timestamps)."""
+
+    def __init__(self):
+        self.valor = 0.0
+        self.instante = time.monotonic()
+
+    def actual(self, ahora):
+        return self.valor * math.exp(-(ahora - self.instante) / _TAU)
+
+    def sumar(self, ahora):
+        self.valor = self.actual(ahora) + 60.0 / _TAU
+        self.instante = ahora
+        return self.valor
+
+
+class _Suscripcion:
+    def __init__(self):
+        self.productos = {}
+        self.version = 0
+        self.listo = False
+        self.watch = None
+        self.actualizado = time.monotonic()
+
+
+class CatalogoCaliente:
+    """Catálogo normalizado en memoria, mantenido con listeners on_snapshot para los vendedores más visitados.
+
+    Un vendedor entra al conjunto cuando su tasa de peticiones supera `umbral_rpm` y sale cuando baja
+    de la mitad; nunca hay más de `max_listeners` listeners abiertos por worker. Si el listener se cae
+    o pasa `max_edad` segundos sin snapshots, la suscripción se descarta y se vuelve a abrir con la
+    próxima petición.
+    """
+
+    def __init__(self, db, al_cambiar=None, max_listeners=HOT_CATALOGO_MAX_LISTENERS,
+                 umbral_rpm=HOT_CATALOGO_UMBRAL_RPM, max_edad=HOT_CATALOGO_MAX_EDAD_SEG):
+        self.db = db
+        self.al_cambiar = al_cambiar
+        self.max_listeners = max_listeners
+        self.umbral_rpm = umbral_rpm
+        self.max_edad = max_edad
+        self._tasas = {}
+        self._suscripciones = {}
+        self._ultima_revision = time.monotonic()
+        self._lock = threading.Lock()
+
+    def registrar_peticion(self, email):
+        """Cuenta una petición al catálogo y promueve o degrada vendedores según su tasa."""
+        if not self.db or self.max_listeners <= 0:
+            return
+        ahora = time.monotonic()
+        promover = None
+        degradar = []
+        with self._lock:
+            tasa = self._tasas.setdefault(email, _Tasa()).sumar(ahora)
+            if email not in self._suscripciones and tasa >= self.umbral_rpm:
+                if len(self._suscripciones) < self.max_listeners:
+                    promover = email
+                else:
+                    mas_fria = min(self._suscripciones, key=lambda e: self._tasas[e].actual(ahora))
+                    if self._tasas[mas_fria].actual(ahora) < tasa:
+                        degradar.append(mas_fria)
+                        promover = email
+            if ahora - self._ultima_revision >= HOT_CATALOGO_REVISION_SEG:
+                self._ultima_revision = ahora
+                degradar.extend(self._revisar(ahora))
+            cerradas = [self._suscripciones.pop(vendedor, None) for vendedor in degradar]
+            if promover:
+                self._suscripciones[promover] = _Suscripcion()
+
+        for suscripcion in cerradas:
+            self._cerrar(suscripcion)
+        if promover:
+            self._abrir(promover)
+
+    def _revisar(self, ahora):
+        degradar = [e for e in self._suscripciones if self._tasas[e].actual(ahora) < self.umbral_rpm / 2]
+        for email in list(self._tasas):
+            if email not in self._suscripciones and self._tasas[email].actual(ahora) < 1:
+                del self._tasas[email]
+        return degradar
+
+    def _abrir(self, email):
+        suscripcion = self._suscripciones.get(email)
+        if suscripcion is None:
+            return
+        try:
+            productos_ref = self.db.collection("usuarios").document(email).collection("productos")
+            suscripcion.watch = productos_ref.on_snapshot(
+                lambda docs, cambios, read_time: self._aplicar(email, suscripcion, cambios)
+            )
+        except Exception:
+            with self._lock:
+                self._suscripciones.pop(email, None)
+
+    def _cerrar(self, suscripcion):
+        try:
+            if suscripcion and suscripcion.watch:
+                suscripcion.watch.unsubscribe()
+        except Exception:
+            pass
+
+    def _aplicar(self, email, suscripcion, cambios):
+        try:
+            with self._lock:
+                for cambio in cambios:
+                    doc = cambio.document
+                    if cambio.type.name == "REMOVED":
+                        suscripcion.productos.pop(doc.id, None)
+                    else:
+                        suscripcion.productos[doc.id] = normalizar_producto(doc.id, doc.to_dict())
+                suscripcion.version += 1
+                suscripcion.listo = True
+                suscripcion.actualizado = time.monotonic()
+        except Exception:
+            # Un snapshot que no se pudo aplicar deja la copia incompleta: se deja de usar
+            self._descartar(email, suscripcion)
+            return
+        if self.al_cambiar:
+            self.al_cambiar(email)
+
+    def _descartar(self, email, suscripcion):
+        with self._lock:
+            if self._suscripciones.get(email) is suscripcion:
+                del self._suscripciones[email]
+        self._cerrar(suscripcion)
+
+    def _vigente(self, email):
+        """Suscripción lista del vendedor, o None. Llamar con el lock tomado.
+
+        Devuelve además la suscripción descartada (listener caído o sin snapshots hace más de
+        `max_edad` segundos), que el llamador cierra fuera del lock.
+        """
+        suscripcion = self._suscripciones.get(email)
+        if suscripcion is None or not suscripcion.listo:
+            return None, None
+        caido = suscripcion.watch is not None and not getattr(suscripcion.watch, "is_active", True)
+        if caido or time.monotonic() - suscripcion.actualizado > self.max_edad:
+            del self._suscripciones[email]
+            return None, suscripcion
+        return suscripcion, None
+
+    def obtener(self, email):
+        """Productos ordenados del vendedor si está en el conjunto caliente y sincronizado; si no, None."""
+        with self._lock:
+            suscripcion, descartada = self._vigente(email)
+            productos = ordenar_productos(suscripcion.productos.values()) if suscripcion else None
+        if descartada:
+            self._cerrar(descartada)
+        return productos
+
+    def productos_por_id(self, email):
+        """{id: producto} del vendedor si está en el conjunto caliente y sincronizado; si no, None."""
+        with self._lock:
+            suscripcion, descartada = self._vigente(email)
+            productos = dict(suscripcion.productos) if suscripcion else None
+        if descartada:
+            self._cerrar(descartada)
+        return productos
+
+    def estadisticas(self):
+        ahora = time.monotonic()
+        with self._lock:
+            # Solo agregados: /debug/cache lo ve cualquier vendedor con sesión
+            return {
+                "listeners": len(self._suscripciones),
+                "max_listeners": self.max_listeners,
+                "listos": sum(1 for s in self._suscripciones.values() if s.listo),
+                "productos": sum(len(s.productos) for s in self._suscripciones.values()),
+                "rpm_minimo": round(min(
+                    (self._tasas[email].actual(ahora) for email in self._suscripciones), default=0
+                ), 1)
+            }
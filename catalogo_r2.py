@@ -0,0 +1,110 @@
+import os
+import gzip
+import json
+import hashlib
+import threading
+import time
+
+from catalogo import leer_catalogo
+from compresion import serializar_json
+from stock_fragmentado import con_stock_fragmentado
+
+R2_CATALOGO_PREFIJO = os.getenv("R2_CATALOGO_PREFIJO", "catalogos")
+# Espera antes de publicar, para agrupar ráfagas de escrituras (p. ej. el alta masiva de step3)
+R2_CATALOGO_DEMORA_SEG = float(os.getenv("R2_CATALOGO_DEMORA_SEG", "2"))
+# Ventas que solo tocan stock fragmentado: el snapshot no cambia, la copia de R2 se refresca con esta cadencia
+R2_CATALOGO_DEMORA_FRAGMENTOS_SEG = float(os.getenv("R2_CATALOGO_DEMORA_FRAGMENTOS_SEG", "30"))
+
+
+def carpeta_catalogo(email):
+    email_safe = email.replace('@', '_at_').replace('.', '_dot_')
+    return f"{R2_CATALOGO_PREFIJO}/{email_safe}"
+
+
+def publicar_catalogo(s3_client, bucket, email, productos, version):
+    """Sube el catálogo como objeto inmutable direccionado por contenido y actualiza el puntero `actual.json`.
+
+    Devuelve el puntero publicado, o None si en R2 ya hay una versión más nueva.
+    """
+    carpeta = carpeta_catalogo(email)
+    cuerpo = serializar_json({"version": version, "productos": productos})
+    hash_contenido = hashlib.sha1(cuerpo).hexdigest()[:20]
+    clave = f"{carpeta}/{hash_contenido}.json"
+    clave_puntero = f"{carpeta}/actual.json"
+
+    try:
+        actual = json.loads(s3_client.get_object(Bucket=bucket, Key=clave_puntero)["Body"].read())
+        if int(actual.get("version", 0)) > version:
+            return None
+        if actual.get("version") == version and actual.get("hash") == hash_contenido:
+            return actual
+    except Exception:
+        pass
+
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=clave,
+        Body=gzip.compress(cuerpo, mtime=0),
+        ContentType='application/json',
+        ContentEncoding='gzip',
+        CacheControl='public, max-age=31536000, immutable'
+    )
+
+    puntero = {"version": version, "hash": hash_contenido, "objeto": clave}
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=clave_puntero,
+        Body=json.dumps(puntero).encode("utf-8"),
+        ContentType='application/json',
+        CacheControl='public, max-age=5, must-revalidate'
+    )
+    return puntero
+
+
+class PublicadorCatalogo:
+    """Publica en R2 el catálogo de cada vendedor unos segundos después de su última escritura."""
+
+    def __init__(self, db, s3_client, bucket, demora=R2_CATALOGO_DEMORA_SEG):
+        self.db = db
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.demora = demora
+        self._timers = {}
+        self._lock = threading.Lock()
+        self._contadores = {"publicados": 0, "obsoletos": 0, "errores": 0}
+
+    def programar(self, email, demora=None):
+        if not self.db or not self.bucket:
+            return
+        demora = self.demora if demora is None else demora
+        vence = time.monotonic() + demora
+        with self._lock:
+            pendiente = self._timers.get(email)
+            if pendiente is not None:
+                if pendiente[1] <= vence:
+                    return
+                # Una escritura del catálogo no espera a la publicación más lenta de una venta fragmentada
+                pendiente[0].cancel()
+            timer = threading.Timer(demora, self._publicar, args=(email,))
+            timer.daemon = True
+            self._timers[email] = (timer, vence)
+        timer.start()
+
+    def _publicar(self, email):
+        with self._lock:
+            # Un timer cancelado que ya había arrancado no se lleva el que lo reemplazó
+            if self._timers.get(email, (None,))[0] is threading.current_thread():
+                del self._timers[email]
+        try:
+            productos, version = leer_catalogo(self.db, email)
+            productos = con_stock_fragmentado(self.db, email, productos)
+            puntero = publicar_catalogo(self.s3_client, self.bucket, email, productos, version)
+            clave = "publicados" if puntero else "obsoletos"
+        except Exception:
+            clave = "errores"
+        with self._lock:
+            self._contadores[clave] += 1
+
+    def estadisticas(self):
+        with self._lock:
+            return {**self._contadores, "pendientes": len(self._timers)}
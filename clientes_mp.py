@@ -0,0 +1,61 @@
+import os
+import threading
+from collections import OrderedDict
+
+import mercadopago
+import requests
+from mercadopago.http import HttpClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MP_MAX_CLIENTES = int(os.getenv("MP_MAX_CLIENTES", "200"))
+MP_POOL_CONEXIONES = int(os.getenv("MP_POOL_CONEXIONES", "20"))
+
+
+class HttpClientPersistente(HttpClient):
+    """HttpClient del SDK de MP que reutiliza una sesión de requests.
+
+    El HttpClient original abre una sesión nueva por request (handshake TLS cada vez); esta mantiene
+    las conexiones a api.mercadopago.com abiertas y las comparte entre todos los vendedores.
+    """
+
+    def __init__(self):
+        self.sesion = requests.Session()
+        # Reintenta solo errores transitorios; los POST no se repiten (Retry excluye métodos no idempotentes)
+        reintentos = Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+        self.sesion.mount("https://", HTTPAdapter(
+            pool_connections=4, pool_maxsize=MP_POOL_CONEXIONES, max_retries=reintentos
+        ))
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        respuesta = self.sesion.request(method, url, **kwargs)
+        return {"status": respuesta.status_code, "response": respuesta.json()}
+
+
+class ClientesMP:
+    """SDKs de Mercado Pago por access token (LRU), todos sobre el mismo HttpClientPersistente."""
+
+    def __init__(self, max_clientes=MP_MAX_CLIENTES):
+        self.max_clientes = max_clientes
+        self.http = HttpClientPersistente()
+        self._sdks = OrderedDict()
+        self._lock = threading.Lock()
+        self.creados = 0
+
+    def sdk(self, access_token):
+        access_token = access_token.strip()
+        with self._lock:
+            sdk = self._sdks.get(access_token)
+            if sdk is None:
+                sdk = mercadopago.SDK(access_token, http_client=self.http)
+                self._sdks[access_token] = sdk
+                self.creados += 1
+                # Un token renovado crea otro SDK; el viejo sale por LRU
+                while len(self._sdks) > self.max_clientes:
+                    self._sdks.popitem(last=False)
+            self._sdks.move_to_end(access_token)
+        return sdk
+
+    def estadisticas(self):
+        with self._lock:
+            return {"sdks": len(self._sdks), "creados": self.creados}
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import traceback
+
+COLA_DB = os.getenv("COLA_DB", "cola_trabajos.sqlite3")
+COLA_MAX_INTENTOS = int(os.getenv("COLA_MAX_INTENTOS", "8"))
+COLA_BACKOFF_BASE_SEG = float(os.getenv("COLA_BACKOFF_BASE_SEG", "5"))
+COLA_BACKOFF_MAX_SEG = float(os.getenv("COLA_BACKOFF_MAX_SEG", "1800"))
+# Un trabajo tomado por un worker que murió vuelve a estar disponible pasado este plazo
+COLA_BLOQUEO_SEG = float(os.getenv("COLA_BLOQUEO_SEG", "300"))
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS trabajos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tipo TEXT NOT NULL,
+    datos TEXT NOT NULL,
+    clave TEXT,
+    estado TEXT NOT NULL DEFAULT 'pendiente',
+    intentos INTEGER NOT NULL DEFAULT 0,
+    disponible_en REAL NOT NULL,
+    bloqueado_hasta REAL,
+    error TEXT,
+    creado REAL NOT NULL,
+    actualizado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trabajos_disponibles ON trabajos (estado, disponible_en);
+CREATE UNIQUE INDEX IF NOT EXISTS trabajos_clave_pendiente ON trabajos (clave) WHERE estado = 'pendiente';
+"""
+
+
+class ColaSQLite:
+    """Cola de trabajos durable en un archivo SQLite, compartida entre el proceso web y los workers.
+
+    Cada trabajo tiene un tipo y datos JSON. Un trabajo fallido se reintenta con backoff exponencial
+    hasta `max_intentos`; después queda en estado 'fallido' para revisión manual.
+    """
+
+    def __init__(self, ruta=COLA_DB, max_intentos=COLA_MAX_INTENTOS):
+        self.ruta = ruta
+        self.max_intentos = max_intentos
+        self._local = threading.local()
+        self._conectar().executescript(_ESQUEMA)
+
+    def _conectar(self):
+        # Una conexión por hilo; sqlite3 no permite compartirlas
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    def _conexion(self):
+        return _Transaccion(self._conectar())
+
+    def encolar(self, tipo, datos, clave=None, demora=0):
+        """Agrega un trabajo. Si ya hay uno pendiente con la misma `clave`, no se duplica."""
+        ahora = time.time()
+        with self._conexion() as conexion:
+            conexion.execute(
+                "INSERT OR IGNORE INTO trabajos (tipo, datos, clave, disponible_en, creado, actualizado) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (tipo, json.dumps(datos), clave, ahora + demora, ahora, ahora)
+            )
+
+    def tomar(self, bloqueo=COLA_BLOQUEO_SEG):
+        """Reserva el próximo trabajo disponible para este worker. Devuelve (id, tipo, datos, intentos) o None."""
+        ahora = time.time()
+        with self._conexion() as conexion:
+            fila = conexion.execute(
+                "SELECT id, tipo, datos, intentos FROM trabajos "
+                "WHERE (estado = 'pendiente' AND disponible_en <= ?) "
+                "   OR (estado = 'procesando' AND bloqueado_hasta <= ?) "
+                "ORDER BY disponible_en LIMIT 1",
+                (ahora, ahora)
+            ).fetchone()
+            if fila is None:
+                return None
+            conexion.execute(
+                "UPDATE trabajos SET estado = 'procesando', bloqueado_hasta = ?, intentos = intentos + 1, "
+                "actualizado = ? WHERE id = ?",
+                (ahora + bloqueo, ahora, fila[0])
+            )
+        return fila[0], fila[1], json.loads(fila[2]), fila[3] + 1
+
+    def completar(self, trabajo_id):
+        with self._conexion() as conexion:
+            conexion.execute(
+                "UPDATE trabajos SET estado = 'hecho', error = NULL, actualizado = ? WHERE id = ?",
+                (time.time(), trabajo_id)
+            )
+
+    def fallar(self, trabajo_id, intentos, error):
+        """Programa el reintento con backoff exponencial, o marca el trabajo como fallido."""
+        ahora = time.time()
+        with self._conexion() as conexion:
+            if intentos >= self.max_intentos:
+                conexion.execute(
+                    "UPDATE trabajos SET estado = 'fallido', error = ?, actualizado = ? WHERE id = ?",
+                    (error, ahora, trabajo_id)
+                )
+            else:
+                espera = min(COLA_BACKOFF_BASE_SEG * 2 ** (intentos - 1), COLA_BACKOFF_MAX_SEG)
+                # Si mientras tanto se encoló otro pendiente con la misma clave, queda uno solo
+                conexion.execute(
+                    "UPDATE OR REPLACE trabajos SET estado = 'pendiente', disponible_en = ?, error = ?, "
+                    "actualizado = ? WHERE id = ?",
+                    (ahora + espera, error, ahora, trabajo_id)
+                )
+
+    def limpiar(self, dias=7):
+        """Borra los trabajos terminados hace más de `dias` días."""
+        with self._conexion() as conexion:
+            conexion.execute(
+                "DELETE FROM trabajos WHERE estado = 'hecho' AND actualizado < ?",
+                (time.time() - dias * 86400,)
+            )
+
+    def estadisticas(self):
+        with self._conexion() as conexion:
+            filas = conexion.execute("SELECT estado, COUNT(*) FROM trabajos GROUP BY estado").fetchall()
+        return dict(filas)
+
+
+class _Transaccion:
+    """BEGIN IMMEDIATE ... COMMIT: toma el lock de escritura al empezar, así dos workers no toman el mismo trabajo."""
+
+    def __init__(self, conexion):
+        self.conexion = conexion
+
+    def __enter__(self):
+        self.conexion.execute("BEGIN IMMEDIATE")
+        return self.conexion
+
+    def __exit__(self, tipo, valor, tb):
+        self.conexion.execute("COMMIT" if tipo is None else "ROLLBACK")
+        return False
+
+
+def ejecutar_worker(cola, manejadores, espera=1.0, detener=None):
+    """Bucle del worker: toma trabajos y ejecuta `manejadores[tipo](datos)`.
+
+    Un manejador que lanza una excepción deja el trabajo para reintentar más tarde.
+    """
+    ultima_limpieza = 0.0
+    while detener is None or not detener.is_set():
+        trabajo = cola.tomar()
+        if trabajo is None:
+            if time.time() - ultima_limpieza > 3600:
+                cola.limpiar()
+                ultima_limpieza = time.time()
+            time.sleep(espera)
+            continue
+
+        trabajo_id, tipo, datos, intentos = trabajo
+        manejador = manejadores.get(tipo)
+        try:
+            if manejador is None:
+                raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+            manejador(datos)
+            cola.completar(trabajo_id)
+        except Exception as e:
+            traceback.print_exc()
+            cola.fallar(trabajo_id, intentos, f"{type(e).__name__}: {e}")
@@ -0,0 +1,65 @@
+import os
+import gzip
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESION_MIN_BYTES = int(os.getenv("COMPRESION_MIN_BYTES", "1024"))
+GZIP_NIVEL = int(os.getenv("GZIP_NIVEL", "9"))
+BROTLI_CALIDAD = int(os.getenv("BROTLI_CALIDAD", "9"))
+
+
+def serializar_json(datos):
+    """JSON compacto en bytes UTF-8; usa orjson si está instalado."""
+    if orjson is not None:
+        return orjson.dumps(datos)
+    return json.dumps(datos, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def precomprimir(cuerpo):
+    """Devuelve {codificación: bytes} con el cuerpo original y sus variantes comprimidas.
+
+    Se calcula una sola vez por versión del catálogo; los cuerpos chicos no se comprimen.
+    """
+    variantes = {"identity": cuerpo}
+    if len(cuerpo) < COMPRESION_MIN_BYTES:
+        return variantes
+    # mtime=0 para que el mismo contenido produzca siempre los mismos bytes
+    variantes["gzip"] = gzip.compress(cuerpo, compresslevel=GZIP_NIVEL, mtime=0)
+    if brotli is not None:
+        variantes["br"] = brotli.compress(cuerpo, quality=BROTLI_CALIDAD)
+    return variantes
+
+
+def elegir_codificacion(accept_encoding, disponibles):
+    """Mejor codificación de `disponibles` aceptada por el cliente (prefiere br sobre gzip)."""
+    aceptadas = {}
+    for parte in (accept_encoding or "").split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        nombre = nombre.strip().lower()
+        if not nombre:
+            continue
+        calidad = 1.0
+        parametros = parametros.strip()
+        if parametros.startswith("q="):
+            try:
+                calidad = float(parametros[2:])
+            except ValueError:
+                calidad = 0.0
+        aceptadas[nombre] = calidad
+
+    for codificacion in ("br", "gzip"):
+        if codificacion not in disponibles:
+            continue
+        calidad = aceptadas.get(codificacion, aceptadas.get("*", 0.0))
+        if calidad > 0:
+            return codificacion
+    return "identity"
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+
+# Firestore admite hasta 500 operaciones por WriteBatch
+LOTE_MAX_OPERACIONES = int(os.getenv("LOTE_MAX_OPERACIONES", "400"))
+LOTE_MAX_SEG = float(os.getenv("LOTE_MAX_SEG", "1.0"))
+
+
+class EscritorLotes:
+    """Agrupa escrituras de Firestore en WriteBatch y las confirma por tamaño o por tiempo.
+
+    Se hace commit cuando el lote llega a `max_operaciones` o cuando la primera escritura pendiente
+    tiene más de `max_seg` segundos (un timer cubre el caso en que no llegan más escrituras).
+    Usar como context manager, o llamar a cerrar() al terminar.
+    """
+
+    def __init__(self, db, max_operaciones=LOTE_MAX_OPERACIONES, max_seg=LOTE_MAX_SEG):
+        self.db = db
+        self.max_operaciones = max_operaciones
+        self.max_seg = max_seg
+        self._batch = None
+        self._pendientes = 0
+        self._desde = None
+        self._timer = None
+        self._error = None
+        self._lock = threading.RLock()
+        self.commits = 0
+        self.escrituras = 0
+
+    def set(self, ref, datos, merge=False):
+        self._agregar(lambda batch: batch.set(ref, datos, merge=merge))
+
+    def update(self, ref, datos):
+        self._agregar(lambda batch: batch.update(ref, datos))
+
+    def delete(self, ref):
+        self._agregar(lambda batch: batch.delete(ref))
+
+    def _agregar(self, operacion):
+        with self._lock:
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            if self._batch is None:
+                self._batch = self.db.batch()
+                self._desde = time.monotonic()
+                if self.max_seg > 0:
+                    self._timer = threading.Timer(self.max_seg, self._flush_por_tiempo)
+                    self._timer.daemon = True
+                    self._timer.start()
+            operacion(self._batch)
+            self._pendientes += 1
+            if self._pendientes >= self.max_operaciones or time.monotonic() - self._desde >= self.max_seg:
+                self.flush()
+
+    def _flush_por_tiempo(self):
+        try:
+            self.flush()
+        except Exception as e:
+            # Se informa en la próxima escritura o al cerrar
+            self._error = e
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, pendientes = self._batch, self._pendientes
+            self._batch, self._pendientes, self._desde = None, 0, None
+            if batch is None or not pendientes:
+                return
+            batch.commit()
+            self.commits += 1
+            self.escrituras += pendientes
+
+    def cerrar(self):
+        self.flush()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, tb):
+        if tipo is None:
+            self.cerrar()
+        else:
+            # Lo ya agregado se confirma igual, como si se hubiera escrito de a uno
+            try:
+                self.flush()
+            except Exception:
+                pass
+        return False
@@ -0,0 +1,143 @@
+import bisect
+import threading
+
+from precios import precio_numerico
+
+# Facetas discretas: nombre -> función que devuelve los valores del producto.
+# Talle y color cuentan solo variantes con stock, que es lo que el comprador filtra.
+FACETAS = {
+    "talle": lambda p: {v.get("talle") for v in (p.get("variantes") or {}).values() if _stock(v) > 0},
+    "color": lambda p: {v.get("color") for v in (p.get("variantes") or {}).values() if _stock(v) > 0},
+    "grupo": lambda p: {p.get("grupo")},
+    "subgrupo": lambda p: {p.get("subgrupo")},
+    "disponible": lambda p: {"si" if p.get("disponible") else "no"},
+}
+
+
+def _stock(variante):
+    try:
+        return int(variante.get("stock", 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _contar(mascara):
+    return bin(mascara).count("1")
+
+
+class IndiceFacetas:
+    """Facetas de los productos de un vendedor como bitsets (un bit por producto) y precios ordenados."""
+
+    def __init__(self):
+        self.productos = {}
+        self.version = 0
+        self.sincronizado = 0.0
+        self.lock = threading.Lock()
+        self._slots = {}
+        self._ids = []
+        self._libres = []
+        self._todos = 0
+        self._valores = {faceta: {} for faceta in FACETAS}
+        self._por_producto = {}
+        self._precios = []
+
+    def indexar(self, producto):
+        pid = producto["id"]
+        self.quitar(pid)
+        if self._libres:
+            slot = self._libres.pop()
+            self._ids[slot] = pid
+        else:
+            slot = len(self._ids)
+            self._ids.append(pid)
+        bit = 1 << slot
+
+        valores = {}
+        for faceta, extraer in FACETAS.items():
+            valores[faceta] = {v for v in extraer(producto) if v not in (None, "")}
+            for valor in valores[faceta]:
+                self._valores[faceta][valor] = self._valores[faceta].get(valor, 0) | bit
+        precio = precio_numerico(producto.get("precio"))
+        bisect.insort(self._precios, (precio, slot))
+
+        self._slots[pid] = slot
+        self._por_producto[pid] = (valores, precio)
+        self._todos |= bit
+        self.productos[pid] = producto
+
+    def quitar(self, pid):
+        slot = self._slots.pop(pid, None)
+        if slot is None:
+            return
+        bit = 1 << slot
+        valores, precio = self._por_producto.pop(pid)
+        for faceta, conjunto in valores.items():
+            for valor in conjunto:
+                restante = self._valores[faceta][valor] & ~bit
+                if restante:
+                    self._valores[faceta][valor] = restante
+                else:
+                    del self._valores[faceta][valor]
+        i = bisect.bisect_left(self._precios, (precio, slot))
+        if i < len(self._precios) and self._precios[i] == (precio, slot):
+            del self._precios[i]
+        self._todos &= ~bit
+        self._ids[slot] = None
+        self._libres.append(slot)
+        self.productos.pop(pid, None)
+
+    def _mascara_precio(self, minimo, maximo):
+        if minimo is None and maximo is None:
+            return self._todos
+        desde = 0 if minimo is None else bisect.bisect_left(self._precios, (minimo, -1))
+        hasta = len(self._precios) if maximo is None else bisect.bisect_right(self._precios, (maximo, len(self._ids)))
+        mascara = 0
+        for _, slot in self._precios[desde:hasta]:
+            mascara |= 1 << slot
+        return mascara
+
+    def filtrar(self, filtros, precio_min=None, precio_max=None):
+        """Ids que cumplen los filtros y conteos por faceta.
+
+        `filtros` es {faceta: [valores]}: OR dentro de una faceta, AND entre facetas. El conteo de
+        cada faceta aplica los filtros de las demás, para poder mostrar cuántos quedarían al elegir otro valor.
+        """
+        mascaras = {}
+        for faceta, valores in filtros.items():
+            if faceta in FACETAS and valores:
+                mascara = 0
+                for valor in valores:
+                    mascara |= self._valores[faceta].get(valor, 0)
+                mascaras[faceta] = mascara
+        base = self._mascara_precio(precio_min, precio_max)
+
+        resultado = base
+        for mascara in mascaras.values():
+            resultado &= mascara
+
+        conteos = {}
+        for faceta, por_valor in self._valores.items():
+            sin_esta = base
+            for otra, mascara in mascaras.items():
+                if otra != faceta:
+                    sin_esta &= mascara
+            conteos[faceta] = {
+                valor: n for valor, n in
+                ((valor, _contar(mascara & sin_esta)) for valor, mascara in por_valor.items()) if n
+            }
+
+        ids = []
+        restante = resultado
+        while restante:
+            bajo = restante & -restante
+            ids.append(self._ids[bajo.bit_length() - 1])
+            restante ^= bajo
+        ids.sort(key=lambda pid: self.productos[pid].get("orden") or 0)
+
+        precios = [self._por_producto[pid][1] for pid in ids]
+        return {
+            "ids": ids,
+            "total": len(ids),
+            "facetas": conteos,
+            "precio": {"min": min(precios), "max": max(precios)} if precios else None
+        }
@@ -1,3 +1,57 @@
+const URL_R2 = "https://pub-715efd970fe0495b9f12469499d2ce20.r2.dev";
+
+// Versión publicada del catálogo del vendedor (puntero en R2, cacheado unos segundos en el edge)
+async function versionCatalogo(email) {
+  try {
+    const carpeta = email.replace('@', '_at_').replace(/\./g, '_dot_');
+    const r = await fetch(`${URL_R2}/catalogos/${carpeta}/actual.json`, {
+      cf: { cacheTtl: 5, cacheEverything: true }
+    });
+    if (!r.ok) return null;
+    const puntero = await r.json();
+    return puntero.version;
+  } catch (e) {
+    return null;
+  }
+}
+
+function codificacionAceptada(request) {
+  const aceptadas = request.headers.get('Accept-Encoding') || '';
+  if (aceptadas.includes('br')) return 'br';
+  if (aceptadas.includes('gzip')) return 'gzip';
+  return 'identity';
+}
+
+// Catálogo cacheado en el edge por vendedor y versión: un solo pedido a Render por versión y PoP
+async function productosConCache(context, url, backendUrl) {
+  const request = context.request;
+  const email = request.headers.get('X-Vendor-Email');
+  if (request.method !== 'GET' || !email) {
+    return fetch(backendUrl, request);
+  }
+
+  const version = await versionCatalogo(email);
+  if (version === null) {
+    return fetch(backendUrl, request);
+  }
+
+  const cache = caches.default;
+  const clave = new Request(
+    `${url.origin}/__edge/productos/${encodeURIComponent(email)}/v${version}` +
+    `/${codificacionAceptada(request)}${url.pathname}${url.search}`
+  );
+
+  const cacheada = await cache.match(clave);
+  if (cacheada) return cacheada;
+
+  const respuesta = await fetch(backendUrl, request);
+  const cacheControl = respuesta.headers.get('Cache-Control') || '';
+  if (respuesta.status === 200 && cacheControl.includes('s-maxage')) {
+    context.waitUntil(cache.put(clave, respuesta.clone()));
+  }
+  return respuesta;
+}
+
 export async function onRequest(context) {
   const url = new URL(context.request.url);
   const path = url.pathname;
@@ -24,6 +78,9 @@ export async function onRequest(context) {
 
   if (shouldGoToBackend) {
     const backendUrl = `https://mpagina.onrender.com${path}${url.search}`;
+    if (path === '/api/productos') {
+      return productosConCache(context, url, backendUrl);
+    }
     return fetch(backendUrl, context.request);
   }
 
@@ -0,0 +1,116 @@
+import re
+
+from catalogo import buscar_variante
+
+# Títulos que arman los fronts: "Remera (M)" (mercadopago.js) o "Remera (Talle: M, Color: Rojo)" (/pagar sin items_mp)
+_TALLE_TITULO = re.compile(r"[Tt]alle:\s*([^,)]+)")
+_COLOR_TITULO = re.compile(r"[Cc]olor:\s*([^,)]+)")
+_PARENTESIS_FINAL = re.compile(r"\(([^():,]+)\)\s*$")
+
+
+def miniatura(imagen_url):
+    """URL de la imagen en tamaño miniatura para comprobantes (Cloudinary redimensiona en el CDN)."""
+    if not imagen_url:
+        return ""
+    if "res.cloudinary.com" in imagen_url and "/image/upload/" in imagen_url:
+        base, resto = imagen_url.split("/image/upload/", 1)
+        if not resto.startswith("w_300,h_180,c_fill/"):
+            return f"{base}/image/upload/w_300,h_180,c_fill/{resto}"
+    elif "firebasestorage.googleapis.com" in imagen_url and "alt=media" not in imagen_url:
+        return f"{imagen_url}{'&' if '?' in imagen_url else '?'}alt=media"
+    return imagen_url
+
+
+def _talle_color_de_titulo(titulo):
+    titulo = str(titulo or "")
+    talle = _TALLE_TITULO.search(titulo)
+    color = _COLOR_TITULO.search(titulo)
+    if talle or color:
+        return (talle.group(1).strip() if talle else ""), (color.group(1).strip() if color else "")
+    final = _PARENTESIS_FINAL.search(titulo)
+    return (final.group(1).strip() if final else ""), ""
+
+
+def completar_items_mp(items_mp, carrito):
+    """Copia a cada item de MP el id_base, talle y color de su línea del carrito.
+
+    mercadopago.js arma items_mp ({title, quantity, unit_price, currency_id}) y carrito en el mismo
+    recorrido, así que con el mismo largo se emparejan por posición; si no, por nombre y talle en el título.
+    """
+    items_mp = [dict(item) for item in items_mp]
+    carrito = [linea for linea in carrito or [] if isinstance(linea, dict)]
+    if len(carrito) == len(items_mp):
+        pares = list(zip(items_mp, carrito))
+    else:
+        libres = list(carrito)
+        pares = []
+        for item in items_mp:
+            titulo = str(item.get("title") or "")
+            for linea in libres:
+                nombre = str(linea.get("nombre") or "")
+                talle = str(linea.get("talle") or "")
+                if nombre and nombre in titulo and (not talle or talle in titulo):
+                    libres.remove(linea)
+                    pares.append((item, linea))
+                    break
+    for item, linea in pares:
+        for campo in ("id_base", "talle", "color"):
+            if not item.get(campo) and linea.get(campo):
+                item[campo] = linea[campo]
+        if not item.get("id") and item.get("id_base"):
+            item["id"] = item["id_base"]
+    return items_mp
+
+
+def _resolver_variante(variantes, talle, color):
+    variante_key = buscar_variante(variantes, talle, color or None)
+    if variante_key or not talle or color:
+        return variante_key
+    # Sin color (carritos de versiones viejas del front): la variante de ese talle con más stock
+    del_talle = [
+        (int((var.get("stock") or 0)), clave) for clave, var in sorted(variantes.items())
+        if str(var.get("talle", "")).strip().lower() == talle.lower()
+    ]
+    return max(del_talle, key=lambda par: par[0])[1] if del_talle else None
+
+
+def armar_lineas_orden(items, productos):
+    """Líneas normalizadas de una orden a partir de los items enviados a MP (o de los del carrito).
+
+    `productos` es {id_base: datos canónicos} leídos en /pagar. Cada línea queda como
+    {id_base, variante_key, nombre, precio_unitario, cantidad, talle, color, imagen_url};
+    comprobante, email y webhook las leen tal cual, sin volver a parsear ni consultar productos.
+    """
+    lineas = []
+    for item in items:
+        metadata_item = item.get("metadata") or {}
+        id_base = item.get("id_base") or metadata_item.get("id_base") or ""
+        data = productos.get(id_base) or {}
+        talle = str(metadata_item.get("talle") or item.get("talle") or "").strip()
+        color = str(metadata_item.get("color") or item.get("color") or "").strip()
+        if not talle and not color:
+            talle, color = _talle_color_de_titulo(item.get("title"))
+        try:
+            precio = float(item.get("unit_price") or item.get("precio") or 0)
+        except (TypeError, ValueError):
+            precio = 0.0
+        try:
+            cantidad = int(item.get("quantity") or item.get("cantidad") or metadata_item.get("cantidad") or 1)
+        except (TypeError, ValueError):
+            cantidad = 1
+        variantes = data.get("variantes") or {}
+        variante_key = _resolver_variante(variantes, talle, color) if variantes else None
+        imagen_url = ((variantes.get(variante_key) or {}).get("imagen_url") or data.get("imagen_url")
+                      or item.get("imagen_url") or metadata_item.get("imagen_url") or "")
+        lineas.append({
+            "id_base": id_base,
+            "variante_key": variante_key,
+            "nombre": (metadata_item.get("nombre") or data.get("nombre") or item.get("nombre")
+                       or item.get("description") or item.get("title") or "Producto"),
+            "precio_unitario": precio,
+            "cantidad": cantidad,
+            "talle": talle,
+            "color": color,
+            "imagen_url": miniatura(imagen_url)
+        })
+    return lineas
@@ -0,0 +1,120 @@
+import re
+import json
+import base64
+from datetime import datetime
+
+from google.cloud.firestore import FieldPath
+
+# Campos que devuelve el listado de pedidos; el detalle completo sigue en ordenes/{ref}
+CAMPOS_LISTA_PEDIDOS = [
+    "cliente_nombre", "cliente_email", "cliente_telefono", "estado", "total", "costo_envio",
+    "external_reference", "fecha_creacion", "comprobante_enviado", "payment_id"
+]
+
+
+def _pedidos_ref(db, email):
+    return db.collection("usuarios").document(email).collection("pedidos")
+
+
+def normalizar_email_cliente(valor):
+    return str(valor or "").strip().lower()
+
+
+def normalizar_telefono_cliente(valor):
+    """Solo dígitos, para que "+54 9 11 1234-5678" y "5491112345678" coincidan."""
+    return re.sub(r"\D", "", str(valor or ""))
+
+
+def campos_busqueda_pedido(cliente_email, cliente_telefono):
+    """Campos que indexan un pedido para la búsqueda por cliente (se guardan al crearlo)."""
+    return {
+        "cliente_email_normalizado": normalizar_email_cliente(cliente_email),
+        "cliente_telefono_normalizado": normalizar_telefono_cliente(cliente_telefono)
+    }
+
+
+def _codificar_cursor(fecha, pedido_id):
+    crudo = json.dumps([fecha.isoformat() if isinstance(fecha, datetime) else None, pedido_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(crudo).decode("ascii")
+
+
+def _decodificar_cursor(cursor):
+    fecha, pedido_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return datetime.fromisoformat(fecha), pedido_id
+
+
+def listar_pedidos(db, email, limite, cursor=None, estado=None, cliente_email=None, cliente_telefono=None):
+    """Página de pedidos del vendedor, del más nuevo al más viejo, con proyección de los campos de lista.
+
+    Filtra por estado y/o por cliente (email o teléfono normalizados) con igualdades que resuelven los
+    índices compuestos de firestore.indexes.json; el cursor (fecha_creacion, id) mantiene constante
+    el costo de cada página. Retorna (pedidos, cursor_siguiente).
+    """
+    pedidos_ref = _pedidos_ref(db, email)
+    query = pedidos_ref
+    if cliente_email:
+        query = query.where("cliente_email_normalizado", "==", normalizar_email_cliente(cliente_email))
+    elif cliente_telefono:
+        query = query.where("cliente_telefono_normalizado", "==", normalizar_telefono_cliente(cliente_telefono))
+    if estado:
+        query = query.where("estado", "==", estado)
+    query = query.order_by("fecha_creacion", direction="DESCENDING")\
+                 .order_by(FieldPath.document_id(), direction="DESCENDING")\
+                 .select(CAMPOS_LISTA_PEDIDOS)
+
+    if cursor:
+        fecha, pedido_id = _decodificar_cursor(cursor)
+        query = query.start_after([fecha, pedidos_ref.document(pedido_id)])
+
+    docs = list(query.limit(limite + 1).stream())
+    siguiente = None
+    if len(docs) > limite:
+        docs = docs[:limite]
+        ultimo = docs[-1]
+        siguiente = _codificar_cursor((ultimo.to_dict() or {}).get("fecha_creacion"), ultimo.id)
+
+    pedidos = []
+    for doc in docs:
+        pedido = {"id": doc.id, **(doc.to_dict() or {})}
+        if isinstance(pedido.get("fecha_creacion"), datetime):
+            pedido["fecha_creacion"] = pedido["fecha_creacion"].isoformat()
+        pedidos.append(pedido)
+    return pedidos, siguiente
+
+
+def migrar_pedidos(db, email=None, tamaño_lote=400):
+    """Completa en lotes los pedidos viejos: campos de búsqueda por cliente y estado tomado de ordenes/{ref}.
+
+    Retorna la cantidad de pedidos actualizados.
+    """
+    if email:
+        vendedores = [email]
+    else:
+        vendedores = [doc.id for doc in db.collection("usuarios").select([]).stream()]
+
+    migrados = 0
+    for vendedor in vendedores:
+        pendientes = [
+            doc for doc in _pedidos_ref(db, vendedor)
+            .select(["cliente_email", "cliente_telefono", "cliente_email_normalizado"]).stream()
+            if "cliente_email_normalizado" not in (doc.to_dict() or {})
+        ]
+        for i in range(0, len(pendientes), tamaño_lote):
+            lote = pendientes[i:i + tamaño_lote]
+            ordenes = {
+                snap.id: snap.to_dict() or {}
+                for snap in db.get_all([db.collection("ordenes").document(doc.id) for doc in lote])
+                if snap.exists
+            }
+            batch = db.batch()
+            for doc in lote:
+                pedido = doc.to_dict() or {}
+                cambios = campos_busqueda_pedido(pedido.get("cliente_email"), pedido.get("cliente_telefono"))
+                orden = ordenes.get(doc.id) or {}
+                for campo in ("estado", "payment_id"):
+                    if orden.get(campo) is not None:
+                        cambios[campo] = orden[campo]
+                batch.update(doc.reference, cambios)
+            batch.commit()
+            migrados += len(lote)
+    return migrados
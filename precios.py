@@ -0,0 +1,105 @@
+import re
+
+from catalogo import stock_disponible
+from ordenes import armar_lineas_orden
+from stock import leer_productos, productos_con_reservas
+from stock_fragmentado import aplicar_fragmentos
+
+
+def precio_numerico(valor):
+    """Precio guardado como número o como texto ("$12.500", "12500,50") a float."""
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    limpio = re.sub(r"[^\d,\.]", "", str(valor or ""))
+    if "," in limpio and "." in limpio:
+        limpio = limpio.replace(".", "").replace(",", ".")
+    elif "," in limpio:
+        limpio = limpio.replace(",", ".")
+    elif limpio.count(".") > 1 or (limpio.count(".") == 1 and len(limpio.rsplit(".", 1)[1]) == 3):
+        # Punto como separador de miles ("12.500")
+        limpio = limpio.replace(".", "")
+    try:
+        return float(limpio)
+    except ValueError:
+        return 0.0
+
+
+def cargar_productos(db, email, ids, catalogo_caliente=None, con_reservas=False):
+    """{id_base: datos} de los productos del carrito en una sola lectura.
+
+    Si el vendedor está en el catálogo caliente se usan sus productos en memoria (sin leer Firestore);
+    si no, un único get_all. Con `con_reservas`, el stock descuenta lo reservado por otros checkouts.
+    """
+    ids = list(dict.fromkeys(i for i in ids if i))
+    if not ids:
+        return {}
+    en_memoria = catalogo_caliente.productos_por_id(email) if catalogo_caliente is not None else None
+    if en_memoria is not None:
+        productos = aplicar_fragmentos(db, email, {i: en_memoria[i] for i in ids if i in en_memoria})
+    else:
+        productos = leer_productos(db, email, ids)
+    if con_reservas and productos:
+        productos = productos_con_reservas(db, email, productos)
+    return productos
+
+
+def cotizar_carrito(productos, items):
+    """Precios, stock y total del carrito con los datos del servidor, en una pasada en memoria.
+
+    El precio unitario sale siempre del producto, nunca del que manda el cliente. Sin color el stock se
+    controla por talle; solo va a `faltantes` la línea de un producto con variantes que no trae ni talle
+    ni color. Devuelve
+    {lineas, total, faltantes, no_encontrados, disponibles}: las líneas tienen el formato normalizado
+    de la orden (solo las de productos existentes) y `disponibles` es {(id_base, talle, color): stock}.
+    """
+    lineas = []
+    faltantes = []
+    no_encontrados = []
+    disponibles = {}
+    pedidos = {}
+    total = 0.0
+    for linea in armar_lineas_orden(items, productos):
+        data = productos.get(linea["id_base"])
+        if data is None:
+            no_encontrados.append(linea)
+            continue
+        linea["precio_unitario"] = precio_numerico(data.get("precio"))
+        total += linea["precio_unitario"] * linea["cantidad"]
+        lineas.append(linea)
+
+        sin_talle = (linea["talle"] or "unico") == "unico" and not linea["color"]
+        if not linea["variante_key"] and sin_talle and len(data.get("variantes") or {}) > 1:
+            # Sin talle ni color no hay ninguna variante que controlar ni descontar al aprobarse el pago
+            faltantes.append({
+                "id_base": linea["id_base"],
+                "nombre": linea["nombre"],
+                "talle": linea["talle"],
+                "color": linea["color"],
+                "solicitado": linea["cantidad"],
+                "disponible": 0,
+                "error": "Elegí talle y color"
+            })
+            continue
+
+        clave = (linea["id_base"], linea["talle"] or "unico", linea["color"])
+        if clave not in disponibles:
+            disponibles[clave] = stock_disponible(data, clave[1], linea["color"] or None)
+        # Varias líneas de la misma variante comparten el stock
+        anteriores = pedidos.get(clave, 0)
+        pedidos[clave] = anteriores + linea["cantidad"]
+        if pedidos[clave] > disponibles[clave]:
+            faltantes.append({
+                "id_base": linea["id_base"],
+                "nombre": linea["nombre"],
+                "talle": clave[1],
+                "color": linea["color"],
+                "solicitado": linea["cantidad"],
+                "disponible": max(0, disponibles[clave] - anteriores)
+            })
+    return {
+        "lineas": lineas,
+        "total": total,
+        "faltantes": faltantes,
+        "no_encontrados": no_encontrados,
+        "disponibles": disponibles
+    }
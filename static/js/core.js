@@ -2,6 +2,7 @@ console.log = function() {};
 const configWhatsApp = window.cliente?.whatsapp;
 const email = window.cliente?.email;
 const URL_BACKEND = "https://mpagina.onrender.com";
+const URL_R2 = "https://pub-715efd970fe0495b9f12469499d2ce20.r2.dev";
 const usarFirestore = false;
 
 let cargaCompleta = false;
@@ -82,12 +83,82 @@ function getVersionUrl(originalUrl, size) {
     return base + `_${size}.webp`;
 }
 
+const CLAVE_CATALOGO_LOCAL = `catalogo_${email}`;
+
+function leerCatalogoLocal() {
+  try {
+    const guardado = JSON.parse(localStorage.getItem(CLAVE_CATALOGO_LOCAL) || "null");
+    if (guardado && Array.isArray(guardado.productos) && Number.isInteger(guardado.version)) {
+      return guardado;
+    }
+  } catch (e) {
+  }
+  return null;
+}
+
+function guardarCatalogoLocal(version, productos) {
+  try {
+    localStorage.setItem(CLAVE_CATALOGO_LOCAL, JSON.stringify({ version, productos }));
+  } catch (e) {
+    localStorage.removeItem(CLAVE_CATALOGO_LOCAL);
+  }
+}
+
+// Catálogo publicado en R2: un puntero chico con la versión actual y el objeto inmutable de esa versión
+async function obtenerProductosR2(local) {
+  const carpeta = `${URL_R2}/catalogos/${email.replace('@', '_at_').replace(/\./g, '_dot_')}`;
+  const r = await fetch(`${carpeta}/actual.json`, { cache: "no-cache" });
+  if (!r.ok) throw new Error("HTTP " + r.status);
+  const puntero = await r.json();
+  if (local && local.version === puntero.version) return local.productos;
+
+  const rc = await fetch(`${URL_R2}/${puntero.objeto}`);
+  if (!rc.ok) throw new Error("HTTP " + rc.status);
+  const catalogo = await rc.json();
+  guardarCatalogoLocal(catalogo.version, catalogo.productos);
+  return catalogo.productos;
+}
+
+// Pide solo los cambios desde la última versión guardada y los aplica sobre la copia local
+async function obtenerProductos() {
+  const local = leerCatalogoLocal();
+  if (!window.modoAdmin) {
+    try {
+      return await obtenerProductosR2(local);
+    } catch (e) {
+      // Sin copia en R2 todavía: se sigue con el backend
+    }
+  }
+  if (!local) {
+    // Primera carga: catálogo completo (cacheado en el servidor) con su versión en una cabecera
+    const rc = await fetch(urlProductos);
+    if (!rc.ok) throw new Error("HTTP " + rc.status);
+    const productos = await rc.json();
+    const version = parseInt(rc.headers.get("X-Catalogo-Version"), 10);
+    if (Number.isInteger(version)) guardarCatalogoLocal(version, productos);
+    return productos;
+  }
+  const r = await fetch(`${urlProductos}&since=${local.version}`);
+  if (!r.ok) throw new Error("HTTP " + r.status);
+  const cambios = await r.json();
+
+  let productos;
+  if (cambios.completo) {
+    productos = cambios.productos || [];
+  } else {
+    const porId = new Map(local.productos.map(p => [p.id, p]));
+    (cambios.eliminados || []).forEach(id => porId.delete(id));
+    (cambios.productos || []).forEach(p => porId.set(p.id, p));
+    // Mismo orden que el servidor (campo "orden"): altas y productos reordenados quedan en su lugar
+    productos = [...porId.values()].sort((a, b) => (a.orden || 0) - (b.orden || 0));
+  }
+
+  guardarCatalogoLocal(cambios.version, productos);
+  return productos;
+}
+
 renderPagina(1, null);
-fetch(urlProductos)
-  .then(r => {
-    if (!r.ok) throw new Error("HTTP " + r.status);
-    return r.json();
-  })
+obtenerProductos()
   .then(lista => {
     const productosOrdenados = Array.isArray(lista) ? lista : [];
   
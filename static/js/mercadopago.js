@@ -250,6 +250,7 @@
     const itemsVerificar = carrito.filter(item => item.id_base).map(item => ({
       id_base: item.id_base,
       talle: item.talle || 'unico',
+      color: item.color || '',
       cantidad: item.cantidad
     }));
 
@@ -342,6 +343,7 @@
           precio: precio,
           cantidad: cantidad,
           talle: item.talle || "",
+          color: item.color || "",
           id_base: item.id_base || "",
           grupo: item.grupo || "",
           subgrupo: item.subgrupo || "",
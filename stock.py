@@ -0,0 +1,324 @@
+import os
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+
+from google.cloud.firestore import SERVER_TIMESTAMP, transactional
+
+from catalogo import asegurar_stock_canonico, buscar_variante, stock_canonico
+from stock_fragmentado import aplicar_fragmentos, descontar_fragmentos, escribir_fragmentos
+
+# Reservas de stock tomadas en /pagar mientras el comprador paga:
+#   usuarios/{email}/reservas_stock/{external_ref}__{id_base}__{variante_key}
+RESERVAS_COLECCION = "reservas_stock"
+RESERVA_STOCK_MINUTOS = int(os.getenv("RESERVA_STOCK_MINUTOS", "30"))
+RESERVAS_BARRIDO_SEG = int(os.getenv("RESERVAS_BARRIDO_SEG", "300"))
+
+
+def _productos_ref(db, email):
+    return db.collection("usuarios").document(email).collection("productos")
+
+
+def _reservas_ref(db, email):
+    return db.collection("usuarios").document(email).collection(RESERVAS_COLECCION)
+
+
+def _ahora():
+    return datetime.now(timezone.utc)
+
+
+def leer_productos(db, email, ids):
+    """{id_base: datos canónicos} de los productos indicados, en una sola lectura (más la de sus fragmentos, si tienen)."""
+    productos_ref = _productos_ref(db, email)
+    productos = {
+        snap.id: asegurar_stock_canonico(snap.to_dict())
+        for snap in db.get_all([productos_ref.document(i) for i in ids])
+        if snap.exists
+    }
+    return aplicar_fragmentos(db, email, productos)
+
+
+def _variante_linea(variantes, linea):
+    # Las líneas normalizadas en /pagar ya traen la variante; las viejas se resuelven por talle/color
+    if linea.get("variante_key") in variantes:
+        return linea["variante_key"]
+    return buscar_variante(variantes, linea.get("talle") or "", linea.get("color") or None)
+
+
+def _linea_sin_descontar(linea, motivo):
+    return {
+        "producto_id": linea["producto_id"],
+        "nombre": linea.get("nombre", ""),
+        "talle": linea.get("talle", ""),
+        "color": linea.get("color", ""),
+        "cantidad": linea["cantidad"],
+        "motivo": motivo
+    }
+
+
+def leer_reservas_activas(db, email, ids):
+    """Reservas vigentes de los productos indicados, ordenadas por momento de creación."""
+    ids = list(dict.fromkeys(ids))
+    ahora = _ahora()
+    activas = []
+    # El operador "in" admite hasta 30 valores por consulta
+    for i in range(0, len(ids), 30):
+        for snap in _reservas_ref(db, email).where("id_base", "in", ids[i:i + 30]).stream():
+            reserva = snap.to_dict() or {}
+            expira = reserva.get("expira_en")
+            if expira is not None and expira > ahora:
+                activas.append((snap.id, reserva))
+    activas.sort(key=lambda r: (r[1].get("creado") or ahora, r[0]))
+    return activas
+
+
+def restar_reservas(data, reservado):
+    """Datos canónicos del producto con el stock de cada variante descontando `reservado` ({variante_key: cantidad})."""
+    if not reservado:
+        return data
+    variantes = {
+        key: {**variante, "stock": max(0, int(variante.get("stock", 0)) - reservado.get(key, 0))}
+        for key, variante in (data.get("variantes") or {}).items()
+    }
+    return {**data, **stock_canonico({**data, "variantes": variantes})}
+
+
+def productos_con_reservas(db, email, productos):
+    """Aplica las reservas vigentes a {id_base: datos canónicos} (una sola consulta por cada 30 productos)."""
+    reservado = {}
+    for _, reserva in leer_reservas_activas(db, email, list(productos)):
+        por_variante = reservado.setdefault(reserva.get("id_base"), {})
+        key = reserva.get("variante_key")
+        por_variante[key] = por_variante.get(key, 0) + int(reserva.get("cantidad", 0))
+    return {pid: restar_reservas(data, reservado.get(pid)) for pid, data in productos.items()}
+
+
+def reservar_stock(db, email, external_ref, lineas, minutos=RESERVA_STOCK_MINUTOS, productos=None):
+    """Reserva el stock de una orden hasta que se apruebe el pago o venza la reserva.
+
+    No usa transacciones, para no serializar cientos de checkouts del mismo producto: primero
+    escribe las reservas y después relee todas las vigentes en orden de creación (timestamp del
+    servidor). Una reserva queda firme si, sumada a las anteriores de su variante, no supera el
+    stock; si no, se borran las de esta orden. Devuelve la lista de faltantes (vacía si reservó).
+    `productos` evita la primera lectura si quien llama ya los leyó.
+    """
+    ids = list(dict.fromkeys(linea["producto_id"] for linea in lineas if linea.get("producto_id")))
+    if not ids:
+        return []
+    if productos is None:
+        productos = leer_productos(db, email, ids)
+
+    pedidas = {}
+    nombres = {}
+    for linea in lineas:
+        data = productos.get(linea.get("producto_id"))
+        if data is None:
+            continue
+        key = _variante_linea(data.get("variantes") or {}, linea)
+        if key:
+            clave = (linea["producto_id"], key)
+            pedidas[clave] = pedidas.get(clave, 0) + int(linea.get("cantidad", 1))
+            nombres[clave] = data.get("nombre", "")
+    if not pedidas:
+        return []
+
+    expira = _ahora() + timedelta(minutes=minutos)
+    batch = db.batch()
+    propias = {}
+    for (id_base, key), cantidad in pedidas.items():
+        doc_id = f"{external_ref}__{id_base}__{key}"
+        propias[doc_id] = (id_base, key)
+        batch.set(_reservas_ref(db, email).document(doc_id), {
+            "external_ref": external_ref,
+            "id_base": id_base,
+            "variante_key": key,
+            "cantidad": cantidad,
+            "creado": SERVER_TIMESTAMP,
+            "expira_en": expira
+        })
+    batch.commit()
+
+    activas = leer_reservas_activas(db, email, [id_base for id_base, _ in pedidas])
+    # El stock se relee después de las reservas: si un webhook convirtió una reserva en el medio,
+    # a lo sumo se la cuenta dos veces (nunca se vende de más)
+    productos = leer_productos(db, email, list(productos))
+
+    acumulado = {}
+    faltantes = []
+    for doc_id, reserva in activas:
+        clave = (reserva.get("id_base"), reserva.get("variante_key"))
+        acumulado[clave] = acumulado.get(clave, 0) + int(reserva.get("cantidad", 0))
+        if doc_id in propias:
+            variante = (productos.get(clave[0]) or {}).get("variantes", {}).get(clave[1]) or {}
+            stock_variante = int(variante.get("stock", 0))
+            if acumulado[clave] > stock_variante:
+                faltantes.append({
+                    "id_base": clave[0],
+                    "nombre": nombres.get(clave, ""),
+                    "talle": variante.get("talle"),
+                    "color": variante.get("color"),
+                    "solicitado": pedidas[clave],
+                    "disponible": max(0, stock_variante - (acumulado[clave] - pedidas[clave]))
+                })
+
+    if faltantes:
+        liberar_reservas(db, email, external_ref)
+    return faltantes
+
+
+def liberar_reservas(db, email, external_ref):
+    """Borra las reservas de una orden (pago rechazado, preferencia fallida)."""
+    batch = db.batch()
+    borradas = 0
+    for snap in _reservas_ref(db, email).where("external_ref", "==", external_ref).stream():
+        batch.delete(snap.reference)
+        borradas += 1
+    if borradas:
+        batch.commit()
+    return borradas
+
+
+def liberar_reservas_vencidas(db, tamaño_lote=400):
+    """Borra en lotes las reservas vencidas de todos los vendedores. Devuelve cuántas borró."""
+    total = 0
+    while True:
+        vencidas = list(db.collection_group(RESERVAS_COLECCION)
+                        .where("expira_en", "<", _ahora()).limit(tamaño_lote).stream())
+        if not vencidas:
+            return total
+        batch = db.batch()
+        for snap in vencidas:
+            batch.delete(snap.reference)
+        batch.commit()
+        total += len(vencidas)
+        if len(vencidas) < tamaño_lote:
+            return total
+
+
+def iniciar_barrido_reservas(db, intervalo=RESERVAS_BARRIDO_SEG):
+    """Hilo en segundo plano que libera reservas vencidas cada `intervalo` segundos."""
+    def ciclo():
+        while True:
+            try:
+                liberar_reservas_vencidas(db)
+            except Exception:
+                pass
+            time.sleep(intervalo)
+
+    threading.Thread(target=ciclo, daemon=True).start()
+
+
+@transactional
+def _descontar_en_transaccion(transaccion, db, email, lineas, external_ref, payment_id, orden_ref):
+    if orden_ref is not None:
+        orden = orden_ref.get(transaction=transaccion)
+        if orden.exists and (orden.to_dict() or {}).get("stock_actualizado"):
+            return []
+    productos_ref = _productos_ref(db, email)
+    refs = list({linea["producto_id"]: productos_ref.document(linea["producto_id"]) for linea in lineas}.values())
+    snaps = {snap.id: snap for snap in transaccion.get_all(refs)}
+    reservas = _reservas_ref(db, email).where("external_ref", "==", external_ref).get(transaction=transaccion)
+
+    # Productos que no existen con ese id: se buscan por nombre (órdenes viejas con ids distintos)
+    por_id = {}
+    # Líneas pagadas que no se pudieron descontar: quedan anotadas en la orden para revisarlas a mano
+    sin_descontar = []
+    for linea in lineas:
+        snap = snaps.get(linea["producto_id"])
+        if (snap is None or not snap.exists) and linea.get("nombre"):
+            encontrados = productos_ref.where("nombre", "==", linea["nombre"]).limit(1).get(transaction=transaccion)
+            snap = encontrados[0] if encontrados else None
+        if snap is not None and snap.exists:
+            por_id.setdefault(snap.id, (snap.reference, asegurar_stock_canonico(snap.to_dict()), []))[2].append(linea)
+        else:
+            sin_descontar.append(_linea_sin_descontar(linea, "producto inexistente"))
+
+    historiales = []
+    productos_actualizados = []
+    fragmentos_leidos = {}
+    for producto_id, (ref, data, lineas_producto) in por_id.items():
+        variantes = dict(data.get("variantes") or {})
+        fragmentos = data.get("stock_fragmentado")
+        for linea in lineas_producto:
+            historial = {
+                "orden_id": external_ref,
+                "fecha": SERVER_TIMESTAMP,
+                "cantidad_descontada": linea["cantidad"],
+                "payment_id": payment_id,
+                "talle": linea["talle"],
+                "color": linea["color"],
+                "nombre_producto": data.get("nombre", "")
+            }
+            variante_key = _variante_linea(variantes, linea)
+            if variante_key and fragmentos:
+                # Producto fragmentado: se descuenta de sus fragmentos, sin escribir el documento del producto
+                stock_leido, descontado = descontar_fragmentos(
+                    transaccion, db, email, producto_id, variante_key, fragmentos, linea["cantidad"], fragmentos_leidos
+                )
+                historial.update({
+                    "stock_fragmentos_leidos": stock_leido,
+                    "cantidad_descontada": descontado,
+                    "tipo": "compra_webhook_fragmentado",
+                    "variante_key": variante_key
+                })
+                historial_id = f"{external_ref}_{variante_key}"
+            elif variante_key:
+                stock_variante = variantes[variante_key].get("stock", 0)
+                nuevo_stock_variante = max(0, stock_variante - linea["cantidad"])
+                variantes[variante_key] = {**variantes[variante_key], "stock": nuevo_stock_variante}
+                historial.update({
+                    "stock_antes": stock_variante,
+                    "stock_despues": nuevo_stock_variante,
+                    "tipo": "compra_webhook_variante",
+                    "variante_key": variante_key
+                })
+                historial_id = f"{external_ref}_{variante_key}"
+            else:
+                motivo = "variante ambigua" if len(variantes) > 1 else "variante inexistente"
+                historial.update({
+                    "stock_antes": data.get("stock", 0),
+                    "stock_despues": data.get("stock", 0),
+                    "tipo": "compra_webhook_sin_variante",
+                    "motivo": motivo
+                })
+                historial_id = external_ref
+                sin_descontar.append(_linea_sin_descontar(linea, motivo))
+            historiales.append((ref.collection("stock_historial").document(historial_id), historial))
+
+        if not fragmentos:
+            # Variante y totales se escriben juntos, una vez por producto
+            productos_actualizados.append((ref, stock_canonico({**data, "variantes": variantes})))
+
+    # Todas las lecturas van antes de la primera escritura de la transacción
+    escribir_fragmentos(transaccion, fragmentos_leidos)
+    for ref, datos in productos_actualizados:
+        transaccion.update(ref, datos)
+    for ref, historial in historiales:
+        transaccion.set(ref, historial)
+    # El descuento real reemplaza a las reservas de la orden
+    for reserva in reservas:
+        transaccion.delete(reserva.reference)
+    if orden_ref is not None:
+        transaccion.update(orden_ref, {
+            "stock_actualizado": True,
+            "stock_actualizado_fecha": SERVER_TIMESTAMP,
+            "stock_sin_descontar": sin_descontar
+        })
+    return [ref.id for ref, _ in productos_actualizados]
+
+
+def descontar_stock_orden(db, email, lineas, external_ref, payment_id, orden_ref=None):
+    """Descuenta el stock de todas las líneas de una orden en una sola transacción.
+
+    Cada línea es {producto_id, cantidad, talle, color, nombre} y opcionalmente variante_key. Lee todos los productos juntos,
+    aplica los descuentos en memoria y escribe variantes, totales e historial en un único commit;
+    si otro webhook modifica los mismos productos, Firestore reintenta la transacción.
+    Las reservas de la orden se borran en el mismo commit. Con `orden_ref`, la orden queda marcada
+    con stock_actualizado en esa misma transacción y una orden ya marcada no se descuenta de nuevo; las líneas
+    que no se pudieron descontar (producto inexistente o talle/color que no identifica una sola variante)
+    quedan en su campo stock_sin_descontar. Devuelve los ids de los productos cuyo documento se modificó
+    (los fragmentados solo escriben sus fragmentos).
+    """
+    if not lineas:
+        return []
+    return _descontar_en_transaccion(db.transaction(), db, email, lineas, external_ref, payment_id, orden_ref)
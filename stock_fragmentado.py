@@ -0,0 +1,251 @@
+import os
+import time
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+
+from google.cloud.firestore import SERVER_TIMESTAMP, DELETE_FIELD, transactional
+
+from catalogo import asegurar_stock_canonico, stock_canonico
+from catalogo_caliente import _Tasa
+
+# Stock fragmentado para productos con muchas ventas por segundo: cada variante se reparte en N documentos
+#   usuarios/{email}/stock_fragmentos/{id_base}__{variante_key}__{i}
+# y el producto queda con stock_fragmentado = N. Las ventas descuentan de un fragmento al azar y no
+# escriben el documento del producto (Firestore sostiene ~1 escritura/seg por documento).
+FRAGMENTOS_COLECCION = "stock_fragmentos"
+STOCK_FRAGMENTOS = int(os.getenv("STOCK_FRAGMENTOS", "10"))
+# Escrituras por minuto a un mismo producto a partir de las que se fragmenta
+STOCK_FRAGMENTAR_UMBRAL_WPM = float(os.getenv("STOCK_FRAGMENTAR_UMBRAL_WPM", "30"))
+# Un producto fragmentado sin ventas en este plazo vuelve a tener el stock en su documento
+STOCK_CONSOLIDAR_MINUTOS = int(os.getenv("STOCK_CONSOLIDAR_MINUTOS", "60"))
+STOCK_CONSOLIDAR_SEG = int(os.getenv("STOCK_CONSOLIDAR_SEG", "600"))
+_RECHEQUEO = 300.0
+
+
+def _fragmentos_ref(db, email):
+    return db.collection("usuarios").document(email).collection(FRAGMENTOS_COLECCION)
+
+
+def _fragmento_ref(db, email, id_base, variante_key, indice):
+    return _fragmentos_ref(db, email).document(f"{id_base}__{variante_key}__{indice}")
+
+
+def _entero(valor):
+    try:
+        return int(valor or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _ahora():
+    return datetime.now(timezone.utc)
+
+
+def leer_fragmentos(db, email, ids):
+    """{id_base: {variante_key: stock}} sumando los fragmentos (una consulta por cada 30 productos)."""
+    ids = list(dict.fromkeys(ids))
+    totales = {}
+    for i in range(0, len(ids), 30):
+        for snap in _fragmentos_ref(db, email).where("id_base", "in", ids[i:i + 30]).stream():
+            fragmento = snap.to_dict() or {}
+            por_variante = totales.setdefault(fragmento.get("id_base"), {})
+            key = fragmento.get("variante_key")
+            por_variante[key] = por_variante.get(key, 0) + _entero(fragmento.get("stock"))
+    return totales
+
+
+def _con_totales(data, totales):
+    variantes = {
+        key: {**variante, "stock": totales.get(key, _entero(variante.get("stock")))}
+        for key, variante in (data.get("variantes") or {}).items()
+    }
+    return {**data, **stock_canonico({**data, "tiene_variantes": True, "variantes": variantes})}
+
+
+def aplicar_fragmentos(db, email, productos):
+    """{id: datos} con el stock de los productos fragmentados sumado desde sus fragmentos.
+
+    Si ninguno está fragmentado no se hace ninguna lectura.
+    """
+    ids = [pid for pid, data in productos.items() if data.get("stock_fragmentado")]
+    if not ids:
+        return productos
+    totales = leer_fragmentos(db, email, ids)
+    return {pid: _con_totales(data, totales.get(pid, {})) if pid in ids else data for pid, data in productos.items()}
+
+
+def con_stock_fragmentado(db, email, productos):
+    """Lista de productos normalizados con aplicar_fragmentos(), en el mismo orden."""
+    por_id = aplicar_fragmentos(db, email, {p["id"]: p for p in productos})
+    return [por_id[p["id"]] for p in productos]
+
+
+def descontar_fragmentos(transaccion, db, email, id_base, variante_key, fragmentos, cantidad, leidos):
+    """Descuenta `cantidad` de los fragmentos de una variante dentro de una transacción.
+
+    Empieza por un fragmento al azar y sigue con otros solo si no alcanza, así las ventas simultáneas
+    caen en documentos distintos. `leidos` ({ruta: [ref, stock leído, stock actual]}) se comparte entre las líneas de la
+    misma transacción y se escribe al final con escribir_fragmentos(). Devuelve (stock leído, descontado).
+    """
+    restante = cantidad
+    leido = 0
+    for indice in random.sample(range(fragmentos), fragmentos):
+        if restante <= 0:
+            break
+        ref = _fragmento_ref(db, email, id_base, variante_key, indice)
+        if ref.path not in leidos:
+            snap = ref.get(transaction=transaccion)
+            stock = _entero((snap.to_dict() or {}).get("stock")) if snap.exists else 0
+            leidos[ref.path] = [ref, stock, stock]
+        stock = leidos[ref.path][2]
+        leido += stock
+        tomado = min(stock, restante)
+        leidos[ref.path][2] = stock - tomado
+        restante -= tomado
+    return leido, cantidad - restante
+
+
+def escribir_fragmentos(transaccion, leidos):
+    """Escribe los fragmentos leídos con descontar_fragmentos() cuyo stock cambió."""
+    for ref, original, stock in leidos.values():
+        if stock != original:
+            transaccion.update(ref, {"stock": stock, "actualizado": SERVER_TIMESTAMP})
+
+
+@transactional
+def _fragmentar_en_transaccion(transaccion, db, email, id_base, fragmentos):
+    ref = db.collection("usuarios").document(email).collection("productos").document(id_base)
+    snap = ref.get(transaction=transaccion)
+    if not snap.exists:
+        return False
+    data = asegurar_stock_canonico(snap.to_dict())
+    if data.get("stock_fragmentado"):
+        return False
+    for key, variante in (data.get("variantes") or {}).items():
+        stock = _entero(variante.get("stock"))
+        for indice in range(fragmentos):
+            # El resto de la división va a los primeros fragmentos
+            transaccion.set(_fragmento_ref(db, email, id_base, key, indice), {
+                "id_base": id_base,
+                "variante_key": key,
+                "stock": stock // fragmentos + (1 if indice < stock % fragmentos else 0),
+                "actualizado": SERVER_TIMESTAMP
+            })
+    transaccion.update(ref, {**stock_canonico(data), "stock_fragmentado": fragmentos})
+    return True
+
+
+def fragmentar_producto(db, email, id_base, fragmentos=STOCK_FRAGMENTOS):
+    """Reparte el stock de cada variante del producto en `fragmentos` documentos. Devuelve True si lo fragmentó."""
+    return _fragmentar_en_transaccion(db.transaction(), db, email, id_base, fragmentos)
+
+
+@transactional
+def _consolidar_en_transaccion(transaccion, db, email, id_base, inactivo_desde):
+    ref = db.collection("usuarios").document(email).collection("productos").document(id_base)
+    snap = ref.get(transaction=transaccion)
+    fragmentos = _fragmentos_ref(db, email).where("id_base", "==", id_base).get(transaction=transaccion)
+    if inactivo_desde is not None:
+        for fragmento in fragmentos:
+            actualizado = (fragmento.to_dict() or {}).get("actualizado")
+            if isinstance(actualizado, datetime) and actualizado >= inactivo_desde:
+                return False
+    totales = {}
+    for fragmento in fragmentos:
+        datos = fragmento.to_dict() or {}
+        key = datos.get("variante_key")
+        totales[key] = totales.get(key, 0) + _entero(datos.get("stock"))
+        transaccion.delete(fragmento.reference)
+    if snap.exists:
+        data = asegurar_stock_canonico(snap.to_dict())
+        if data.get("stock_fragmentado"):
+            transaccion.update(ref, {
+                **stock_canonico(_con_totales(data, totales)),
+                "stock_fragmentado": DELETE_FIELD
+            })
+    return bool(fragmentos)
+
+
+def consolidar_producto(db, email, id_base, inactivo_desde=None):
+    """Suma los fragmentos al documento del producto y los borra (antes de editar el stock a mano).
+
+    Con `inactivo_desde`, no hace nada si algún fragmento se vendió después de esa fecha.
+    Devuelve True si el producto dejó de estar fragmentado.
+    """
+    return _consolidar_en_transaccion(db.transaction(), db, email, id_base, inactivo_desde)
+
+
+def preparar_edicion_stock(db, email, snap):
+    """Snapshot del producto listo para reescribir su stock en el documento.
+
+    Si está fragmentado, antes suma y borra los fragmentos y lo vuelve a leer.
+    """
+    if not (snap.to_dict() or {}).get("stock_fragmentado"):
+        return snap
+    consolidar_producto(db, email, snap.id)
+    return snap.reference.get()
+
+
+def consolidar_fragmentos_inactivos(db, minutos=STOCK_CONSOLIDAR_MINUTOS):
+    """Consolida los productos fragmentados sin ventas en los últimos `minutos`. Devuelve [(email, id_base)]."""
+    limite = _ahora() - timedelta(minutes=minutos)
+    candidatos = set()
+    for snap in db.collection_group(FRAGMENTOS_COLECCION).where("actualizado", "<", limite).stream():
+        email = snap.reference.parent.parent.id
+        candidatos.add((email, (snap.to_dict() or {}).get("id_base")))
+    return [(email, id_base) for email, id_base in sorted(candidatos)
+            if id_base and consolidar_producto(db, email, id_base, inactivo_desde=limite)]
+
+
+def iniciar_consolidacion_fragmentos(db, al_consolidar=None, intervalo=STOCK_CONSOLIDAR_SEG):
+    """Hilo en segundo plano que consolida los productos fragmentados que se enfriaron."""
+    def ciclo():
+        while True:
+            try:
+                for email, id_base in consolidar_fragmentos_inactivos(db):
+                    if al_consolidar:
+                        al_consolidar(email, [id_base])
+            except Exception:
+                pass
+            time.sleep(intervalo)
+
+    threading.Thread(target=ciclo, daemon=True).start()
+
+
+class PromotorFragmentos:
+    """Mide las escrituras de stock por producto y fragmenta los que superan `umbral_wpm`."""
+
+    def __init__(self, db, umbral_wpm=STOCK_FRAGMENTAR_UMBRAL_WPM, fragmentos=STOCK_FRAGMENTOS):
+        self.db = db
+        self.umbral_wpm = umbral_wpm
+        self.fragmentos = fragmentos
+        self._tasas = {}
+        # Productos que ya se sabe que están fragmentados: no se vuelven a consultar por un rato
+        self._fragmentados = {}
+        self._lock = threading.Lock()
+        self.promovidos = 0
+
+    def registrar(self, email, ids):
+        """Cuenta una escritura a cada producto y devuelve los que fragmentó en esta llamada."""
+        if not self.db or self.umbral_wpm <= 0:
+            return []
+        ahora = time.monotonic()
+        calientes = []
+        with self._lock:
+            for id_base in ids:
+                valor = self._tasas.setdefault((email, id_base), _Tasa()).sumar(ahora)
+                if valor >= self.umbral_wpm and ahora - self._fragmentados.get((email, id_base), -_RECHEQUEO) >= _RECHEQUEO:
+                    calientes.append(id_base)
+                    self._fragmentados[(email, id_base)] = ahora
+            if len(self._tasas) > 10000:
+                # Descarta los productos que ya no reciben escrituras
+                self._tasas = {k: tasa for k, tasa in self._tasas.items() if tasa.actual(ahora) >= 1}
+                self._fragmentados = {k: t for k, t in self._fragmentados.items() if ahora - t < _RECHEQUEO}
+        promovidos = [id_base for id_base in calientes if fragmentar_producto(self.db, email, id_base, self.fragmentos)]
+        self.promovidos += len(promovidos)
+        return promovidos
+
+    def estadisticas(self):
+        with self._lock:
+            return {"productos_medidos": len(self._tasas), "promovidos": self.promovidos}
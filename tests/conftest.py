@@ -0,0 +1,35 @@
+import os
+import sys
+import types
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_firestore
+
+# Los módulos se prueban contra la Firestore en memoria, esté o no instalado el SDK
+if "google" not in sys.modules:
+    sys.modules["google"] = types.ModuleType("google")
+if "google.cloud" not in sys.modules:
+    sys.modules["google.cloud"] = types.ModuleType("google.cloud")
+    sys.modules["google"].cloud = sys.modules["google.cloud"]
+sys.modules["google.cloud.firestore"] = fake_firestore
+sys.modules["google.cloud"].firestore = fake_firestore
+# Las excepciones del SDK son las que lanza la Firestore en memoria
+if "google.api_core" not in sys.modules:
+    sys.modules["google.api_core"] = types.ModuleType("google.api_core")
+    sys.modules["google"].api_core = sys.modules["google.api_core"]
+excepciones = types.ModuleType("google.api_core.exceptions")
+excepciones.AlreadyExists = fake_firestore.AlreadyExists
+excepciones.NotFound = fake_firestore.NotFound
+excepciones.InvalidArgument = fake_firestore.InvalidArgument
+sys.modules["google.api_core.exceptions"] = excepciones
+sys.modules["google.api_core"].exceptions = excepciones
+
+
+@pytest.fixture
+def db():
+    return fake_firestore.Client()
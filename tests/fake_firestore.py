@@ -0,0 +1,332 @@
+"""Firestore en memoria para las pruebas: lo justo de la API que usan los módulos de la app.
+
+Se registra como `google.cloud.firestore` en conftest.py. Cada Client tiene su propio almacén;
+las transacciones aplican sus escrituras al final, como un batch, sin reintentos.
+"""
+import copy
+import itertools
+import re
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+
+
+class _Centinela:
+    def __init__(self, nombre):
+        self.nombre = nombre
+
+    def __repr__(self):
+        return self.nombre
+
+
+SERVER_TIMESTAMP = _Centinela("SERVER_TIMESTAMP")
+DELETE_FIELD = _Centinela("DELETE_FIELD")
+
+
+class Increment:
+    def __init__(self, valor):
+        self.value = valor
+
+
+class ArrayUnion:
+    def __init__(self, valores):
+        self.values = valores
+
+
+class AlreadyExists(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class InvalidArgument(Exception):
+    pass
+
+
+class FieldPath:
+    def __init__(self, *partes):
+        self.partes = partes
+
+    def to_api_repr(self):
+        return ".".join(
+            p if re.match(r"^[_a-zA-Z][_a-zA-Z0-9]*$", p) else "`" + p.replace("\\", "\\\\").replace("`", "\\`") + "`"
+            for p in self.partes
+        )
+
+    @staticmethod
+    def document_id():
+        return "__name__"
+
+
+def _partir(ruta):
+    partes, actual, entre_comillas, i = [], "", False, 0
+    while i < len(ruta):
+        c = ruta[i]
+        if c == "`":
+            entre_comillas = not entre_comillas
+        elif c == "\\" and entre_comillas:
+            i += 1
+            actual += ruta[i]
+        elif c == "." and not entre_comillas:
+            partes.append(actual)
+            actual = ""
+        else:
+            actual += c
+        i += 1
+    partes.append(actual)
+    return partes
+
+
+class _Almacen:
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.RLock()
+        # Timestamps de servidor estrictamente crecientes, para que el orden de creación sea determinista
+        self._base = datetime.now(timezone.utc)
+        self._contador = itertools.count()
+
+    def marca_tiempo(self):
+        return self._base + timedelta(microseconds=next(self._contador))
+
+    def resolver(self, valor, anterior):
+        if valor is SERVER_TIMESTAMP:
+            return self.marca_tiempo()
+        if isinstance(valor, Increment):
+            return anterior + valor.value if isinstance(anterior, (int, float)) else valor.value
+        if isinstance(valor, ArrayUnion):
+            base = list(anterior or [])
+            base.extend(v for v in valor.values if v not in base)
+            return base
+        if isinstance(valor, dict):
+            anterior = anterior if isinstance(anterior, dict) else {}
+            return {k: self.resolver(v, anterior.get(k)) for k, v in valor.items() if v is not DELETE_FIELD}
+        return copy.deepcopy(valor)
+
+    def combinar(self, destino, origen):
+        for k, v in origen.items():
+            if v is DELETE_FIELD:
+                destino.pop(k, None)
+            elif isinstance(v, dict) and isinstance(destino.get(k), dict):
+                self.combinar(destino[k], v)
+            else:
+                destino[k] = self.resolver(v, destino.get(k))
+
+
+class DocumentSnapshot:
+    def __init__(self, referencia, datos):
+        self.reference = referencia
+        self.id = referencia.id
+        self._datos = datos
+        self.exists = datos is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._datos) if self._datos is not None else None
+
+    def get(self, campo):
+        valor = self._datos
+        for parte in _partir(campo):
+            valor = valor.get(parte) if isinstance(valor, dict) else None
+        return valor
+
+
+class DocumentReference:
+    def __init__(self, almacen, ruta):
+        self._almacen = almacen
+        self.path = ruta
+        self.id = ruta.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._almacen, self.path.rsplit("/", 1)[0])
+
+    def collection(self, nombre):
+        return CollectionReference(self._almacen, f"{self.path}/{nombre}")
+
+    def get(self, transaction=None, field_paths=None):
+        with self._almacen.lock:
+            datos = copy.deepcopy(self._almacen.docs.get(self.path))
+        if datos is not None and field_paths is not None:
+            datos = {k: v for k, v in datos.items() if k in field_paths}
+        return DocumentSnapshot(self, datos)
+
+    def set(self, datos, merge=False):
+        with self._almacen.lock:
+            if merge and self.path in self._almacen.docs:
+                self._almacen.combinar(self._almacen.docs[self.path], datos)
+            else:
+                self._almacen.docs[self.path] = self._almacen.resolver(datos, None)
+
+    def create(self, datos):
+        with self._almacen.lock:
+            if self.path in self._almacen.docs:
+                raise AlreadyExists(self.path)
+            self._almacen.docs[self.path] = self._almacen.resolver(datos, None)
+
+    def update(self, datos):
+        with self._almacen.lock:
+            if self.path not in self._almacen.docs:
+                raise NotFound(self.path)
+            doc = self._almacen.docs[self.path]
+            for campo, valor in datos.items():
+                partes = _partir(campo)
+                actual = doc
+                for parte in partes[:-1]:
+                    actual = actual.setdefault(parte, {})
+                if valor is DELETE_FIELD:
+                    actual.pop(partes[-1], None)
+                else:
+                    actual[partes[-1]] = self._almacen.resolver(valor, actual.get(partes[-1]))
+
+    def delete(self):
+        with self._almacen.lock:
+            self._almacen.docs.pop(self.path, None)
+
+
+_OPERADORES = {
+    "==": lambda a, b: a == b,
+    "in": lambda a, b: a in b,
+    "array_contains": lambda a, b: b in (a or []),
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+}
+
+
+class Query:
+    def __init__(self, almacen, coleccion, grupo=False, filtros=(), ordenes=(), limite=None, campos=None, despues=None):
+        self._almacen = almacen
+        self._coleccion = coleccion
+        self._grupo = grupo
+        self._filtros = list(filtros)
+        self._ordenes = list(ordenes)
+        self._limite = limite
+        self._campos = campos
+        self._despues = despues
+
+    def _copiar(self, **cambios):
+        args = dict(filtros=self._filtros, ordenes=self._ordenes, limite=self._limite,
+                    campos=self._campos, despues=self._despues)
+        args.update(cambios)
+        return Query(self._almacen, self._coleccion, self._grupo, **args)
+
+    def where(self, campo, operador, valor):
+        return self._copiar(filtros=self._filtros + [(campo, operador, valor)])
+
+    def order_by(self, campo, direction="ASCENDING"):
+        return self._copiar(ordenes=self._ordenes + [(campo, direction)])
+
+    def limit(self, limite):
+        return self._copiar(limite=limite)
+
+    def select(self, campos):
+        return self._copiar(campos=list(campos))
+
+    def start_after(self, valores):
+        return self._copiar(despues=[v.id if isinstance(v, DocumentReference) else v for v in valores])
+
+    @staticmethod
+    def _valor(snap, campo):
+        return snap.id if campo == "__name__" else snap.get(campo)
+
+    def _docs(self):
+        with self._almacen.lock:
+            snaps = []
+            for ruta, datos in self._almacen.docs.items():
+                padre = ruta.rsplit("/", 1)[0]
+                if (padre.rsplit("/", 1)[-1] if self._grupo else padre) != self._coleccion:
+                    continue
+                snaps.append(DocumentSnapshot(DocumentReference(self._almacen, ruta), copy.deepcopy(datos)))
+        snaps = [s for s in snaps if all(_OPERADORES[op](self._valor(s, campo), valor) for campo, op, valor in self._filtros)]
+        for campo, direccion in reversed(self._ordenes):
+            snaps.sort(key=lambda s: self._valor(s, campo), reverse=direccion == "DESCENDING")
+        if self._despues is not None:
+            def posterior(snap):
+                for (campo, direccion), cursor in zip(self._ordenes, self._despues):
+                    valor = self._valor(snap, campo)
+                    if valor != cursor:
+                        return valor < cursor if direccion == "DESCENDING" else valor > cursor
+                return False
+            snaps = [s for s in snaps if posterior(s)]
+        if self._limite is not None:
+            snaps = snaps[:self._limite]
+        if self._campos is not None:
+            for snap in snaps:
+                snap._datos = {k: v for k, v in snap._datos.items() if k in self._campos}
+        return snaps
+
+    def stream(self, transaction=None):
+        return iter(self._docs())
+
+    def get(self, transaction=None):
+        return self._docs()
+
+
+class CollectionReference(Query):
+    def __init__(self, almacen, ruta):
+        super().__init__(almacen, ruta)
+        self.path = ruta
+        self.id = ruta.rsplit("/", 1)[-1]
+
+    def document(self, doc_id=None):
+        return DocumentReference(self._almacen, f"{self.path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+
+class WriteBatch:
+    def __init__(self):
+        self._operaciones = []
+
+    def set(self, referencia, datos, merge=False):
+        self._operaciones.append(lambda: referencia.set(datos, merge=merge))
+
+    def create(self, referencia, datos):
+        self._operaciones.append(lambda: referencia.create(datos))
+
+    def update(self, referencia, datos):
+        self._operaciones.append(lambda: referencia.update(datos))
+
+    def delete(self, referencia):
+        self._operaciones.append(referencia.delete)
+
+    def commit(self):
+        operaciones, self._operaciones = self._operaciones, []
+        for operacion in operaciones:
+            operacion()
+
+
+class Transaction(WriteBatch):
+    def get_all(self, referencias):
+        return [r.get() for r in referencias]
+
+
+def transactional(fn):
+    def envoltura(transaccion, *args, **kwargs):
+        resultado = fn(transaccion, *args, **kwargs)
+        transaccion.commit()
+        return resultado
+    return envoltura
+
+
+class Client:
+    def __init__(self):
+        self._almacen = _Almacen()
+
+    def collection(self, nombre):
+        return CollectionReference(self._almacen, nombre)
+
+    def collection_group(self, nombre):
+        return Query(self._almacen, nombre, grupo=True)
+
+    def document(self, ruta):
+        return DocumentReference(self._almacen, ruta)
+
+    def batch(self):
+        return WriteBatch()
+
+    def transaction(self, **kwargs):
+        return Transaction()
+
+    def get_all(self, referencias, field_paths=None, transaction=None):
+        return [r.get(field_paths=field_paths) for r in referencias]
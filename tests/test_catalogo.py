@@ -0,0 +1,128 @@
+import pytest
+from google.api_core.exceptions import InvalidArgument
+
+import catalogo
+from catalogo import actualizar_productos_catalogo, leer_cambios_catalogo, reconstruir_catalogo
+
+EMAIL = "tienda@ejemplo.com"
+
+
+def _productos(db):
+    return db.collection("usuarios").document(EMAIL).collection("productos")
+
+
+def _alta(db, id_base, orden, stock=3, **extra):
+    _productos(db).document(id_base).set({
+        "nombre": id_base.title(),
+        "precio": 1000,
+        "orden": orden,
+        "tiene_variantes": True,
+        "variantes": {"M_Rojo": {"talle": "M", "color": "Rojo", "stock": stock}},
+        **extra
+    })
+
+
+def _ids(cambios):
+    return [p["id"] for p in cambios["productos"]]
+
+
+def test_sin_snapshot_responde_el_catalogo_completo(db):
+    _alta(db, "remera", 1)
+    _alta(db, "buzo", 2)
+
+    cambios = leer_cambios_catalogo(db, EMAIL, 5)
+
+    assert cambios["completo"] is True
+    assert cambios["version"] == 1
+    assert _ids(cambios) == ["remera", "buzo"]
+
+
+def test_misma_version_no_trae_nada(db):
+    _alta(db, "remera", 1)
+    _, version = reconstruir_catalogo(db, EMAIL)
+
+    assert leer_cambios_catalogo(db, EMAIL, version) == {
+        "version": version, "completo": False, "productos": [], "eliminados": []
+    }
+
+
+def test_trae_solo_lo_posterior_a_desde(db):
+    _alta(db, "remera", 1)
+    _alta(db, "buzo", 2)
+    _, v1 = reconstruir_catalogo(db, EMAIL)
+
+    _alta(db, "remera", 1, stock=7)
+    actualizar_productos_catalogo(db, EMAIL, ["remera"])
+    _productos(db).document("buzo").delete()
+    actualizar_productos_catalogo(db, EMAIL, ["buzo"])
+
+    desde_v1 = leer_cambios_catalogo(db, EMAIL, v1)
+    assert desde_v1["version"] == v1 + 2
+    assert (desde_v1["completo"], _ids(desde_v1), desde_v1["eliminados"]) == (False, ["remera"], ["buzo"])
+    assert desde_v1["productos"][0]["stock"] == 7
+
+    # Desde la versión intermedia solo queda la baja
+    desde_v2 = leer_cambios_catalogo(db, EMAIL, v1 + 1)
+    assert (_ids(desde_v2), desde_v2["eliminados"]) == ([], ["buzo"])
+
+
+def test_versiones_fuera_de_rango_responden_completo(db):
+    _alta(db, "remera", 1)
+    _, version = reconstruir_catalogo(db, EMAIL)
+
+    for desde in (0, -1, version + 1):
+        cambios = leer_cambios_catalogo(db, EMAIL, desde)
+        assert (cambios["completo"], _ids(cambios)) == (True, ["remera"])
+
+
+def test_desde_anterior_a_las_bajas_conservadas_responde_completo(db, monkeypatch):
+    monkeypatch.setattr(catalogo, "CATALOGO_MAX_TOMBSTONES", 1)
+    for i, id_base in enumerate(["a", "b", "c"]):
+        _alta(db, id_base, i)
+    _, v1 = reconstruir_catalogo(db, EMAIL)
+    for id_base in ("a", "b"):
+        _productos(db).document(id_base).delete()
+        actualizar_productos_catalogo(db, EMAIL, [id_base])
+
+    # La baja de "a" se descartó del historial: un cliente en v1 no podría enterarse
+    cambios = leer_cambios_catalogo(db, EMAIL, v1)
+    assert (cambios["completo"], _ids(cambios)) == (True, ["c"])
+    # Desde después de la baja descartada, el delta sigue siendo válido
+    cambios = leer_cambios_catalogo(db, EMAIL, v1 + 1)
+    assert (cambios["completo"], cambios["eliminados"]) == (False, ["b"])
+
+
+def test_productos_fragmentados_van_siempre_con_el_stock_de_sus_fragmentos(db):
+    _alta(db, "remera", 1, stock_fragmentado=2)
+    _alta(db, "buzo", 2)
+    fragmentos = db.collection("usuarios").document(EMAIL).collection("stock_fragmentos")
+    for indice, stock in enumerate([4, 5]):
+        fragmentos.document(f"remera__M_Rojo__{indice}").set(
+            {"id_base": "remera", "variante_key": "M_Rojo", "stock": stock}
+        )
+    _, version = reconstruir_catalogo(db, EMAIL)
+
+    cambios = leer_cambios_catalogo(db, EMAIL, version)
+
+    assert (cambios["completo"], _ids(cambios)) == (False, ["remera"])
+    assert cambios["productos"][0]["stock"] == 9
+
+
+def test_solo_shard_inexistente_o_excedido_reconstruye(db, monkeypatch):
+    _alta(db, "remera", 1)
+    reconstruir_catalogo(db, EMAIL)
+    reconstrucciones = []
+    monkeypatch.setattr(catalogo, "reconstruir_catalogo", lambda db, email: reconstrucciones.append(email))
+
+    def excedido(*args):
+        raise InvalidArgument("Document exceeds maximum size")
+    monkeypatch.setattr(catalogo, "_parchear_catalogo", excedido)
+    actualizar_productos_catalogo(db, EMAIL, ["remera"])
+    assert reconstrucciones == [EMAIL]
+
+    def contencion(*args):
+        raise RuntimeError("Aborted: too much contention")
+    monkeypatch.setattr(catalogo, "_parchear_catalogo", contencion)
+    with pytest.raises(RuntimeError):
+        actualizar_productos_catalogo(db, EMAIL, ["remera"])
+    assert reconstrucciones == [EMAIL]
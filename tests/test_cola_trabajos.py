@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import cola_trabajos
+from cola_trabajos import ColaSQLite
+
+
+@pytest.fixture
+def cola(tmp_path):
+    return ColaSQLite(str(tmp_path / "cola.sqlite3"), max_intentos=3)
+
+
+def test_tomar_reserva_el_trabajo(cola):
+    cola.encolar("pago_mp", {"payment_id": "1"})
+
+    trabajo_id, tipo, datos, intentos = cola.tomar()
+
+    assert (tipo, datos, intentos) == ("pago_mp", {"payment_id": "1"}, 1)
+    # Tomado por este worker: nadie más lo recibe mientras dure el bloqueo
+    assert cola.tomar() is None
+    cola.completar(trabajo_id)
+    assert cola.estadisticas() == {"hecho": 1}
+
+
+def test_bloqueo_vencido_libera_el_trabajo(cola):
+    cola.encolar("pago_mp", {"payment_id": "1"})
+    trabajo_id, _, _, _ = cola.tomar(bloqueo=-1)
+
+    # El worker que lo tomó murió: pasado el bloqueo otro lo vuelve a tomar
+    assert cola.tomar() == (trabajo_id, "pago_mp", {"payment_id": "1"}, 2)
+
+
+def test_demora_posterga_el_trabajo(cola):
+    cola.encolar("comprobante", {"external_ref": "A"}, demora=60)
+
+    assert cola.tomar() is None
+
+
+def test_misma_clave_pendiente_no_se_duplica(cola):
+    cola.encolar("pago_mp", {"payment_id": "1"}, clave="pago_mp:1")
+    cola.encolar("pago_mp", {"payment_id": "1"}, clave="pago_mp:1")
+
+    assert cola.estadisticas() == {"pendiente": 1}
+
+
+def test_clave_en_proceso_admite_un_pendiente_nuevo(cola):
+    cola.encolar("pago_mp", {"payment_id": "1"}, clave="pago_mp:1")
+    trabajo_id, _, _, intentos = cola.tomar()
+    # Llega otra notificación mientras se procesa: queda pendiente para después
+    cola.encolar("pago_mp", {"payment_id": "1"}, clave="pago_mp:1")
+    assert cola.estadisticas() == {"pendiente": 1, "procesando": 1}
+
+    # Si el primero falla, se reprograma y absorbe al pendiente: queda uno solo
+    cola.fallar(trabajo_id, intentos, "timeout")
+    assert cola.estadisticas() == {"pendiente": 1}
+
+
+def test_fallar_reintenta_con_backoff(cola, monkeypatch):
+    monkeypatch.setattr(cola_trabajos, "COLA_BACKOFF_BASE_SEG", 10)
+    cola.encolar("pago_mp", {"payment_id": "1"})
+    trabajo_id, _, _, intentos = cola.tomar()
+
+    antes = time.time()
+    cola.fallar(trabajo_id, intentos, "MP respondió 500")
+
+    assert cola.tomar() is None
+    conexion = cola._conectar()
+    estado, disponible_en, error = conexion.execute(
+        "SELECT estado, disponible_en, error FROM trabajos WHERE id = ?", (trabajo_id,)
+    ).fetchone()
+    assert (estado, error) == ("pendiente", "MP respondió 500")
+    assert disponible_en >= antes + 10
+
+
+def test_fallar_en_el_ultimo_intento_lo_marca_fallido(cola):
+    cola.encolar("pago_mp", {"payment_id": "1"})
+    trabajo_id, _, _, _ = cola.tomar()
+
+    cola.fallar(trabajo_id, 3, "sin orden")
+
+    assert cola.estadisticas() == {"fallido": 1}
+    assert cola.tomar() is None
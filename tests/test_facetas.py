@@ -0,0 +1,13 @@
+from facetas import IndiceFacetas
+
+
+def test_rango_de_precios_con_precios_en_texto():
+    indice = IndiceFacetas()
+    indice.indexar({"id": "remera", "precio": "$12.500", "orden": 1})
+    indice.indexar({"id": "gorra", "precio": 3000, "orden": 2})
+    indice.indexar({"id": "buzo", "precio": "18500,50", "orden": 3})
+
+    resultado = indice.filtrar({}, precio_min=10000, precio_max=20000)
+
+    assert resultado["ids"] == ["remera", "buzo"]
+    assert resultado["precio"] == {"min": 12500.0, "max": 18500.5}
@@ -0,0 +1,52 @@
+from ordenes import armar_lineas_orden, completar_items_mp
+
+# Forma exacta del payload que arma static/js/mercadopago.js
+ITEMS_MP = [
+    {"title": "Remera (M)", "quantity": 2, "unit_price": 1000, "currency_id": "ARS"},
+    {"title": "Gorra", "quantity": 1, "unit_price": 500, "currency_id": "ARS"},
+]
+CARRITO = [
+    {"nombre": "Remera", "precio": 1000, "cantidad": 2, "talle": "M", "color": "Azul", "id_base": "remera",
+     "grupo": "", "subgrupo": "", "subtotal": 2000},
+    {"nombre": "Gorra", "precio": 500, "cantidad": 1, "talle": "", "color": "", "id_base": "gorra",
+     "grupo": "", "subgrupo": "", "subtotal": 500},
+]
+PRODUCTOS = {
+    "remera": {"nombre": "Remera", "precio": 1000, "variantes": {
+        "M_Rojo": {"talle": "M", "color": "Rojo", "stock": 3},
+        "M_Azul": {"talle": "M", "color": "Azul", "stock": 1},
+        "L_Rojo": {"talle": "L", "color": "Rojo", "stock": 4},
+    }},
+    "gorra": {"nombre": "Gorra", "precio": 500, "stock": 10},
+}
+
+
+def test_items_mp_toman_id_talle_y_color_del_carrito():
+    lineas = armar_lineas_orden(completar_items_mp(ITEMS_MP, CARRITO), PRODUCTOS)
+
+    assert [(l["id_base"], l["variante_key"], l["talle"], l["color"], l["cantidad"]) for l in lineas] == [
+        ("remera", "M_Azul", "M", "Azul", 2),
+        ("gorra", None, "", "", 1),
+    ]
+
+
+def test_sin_color_en_el_carrito_queda_el_talle_del_titulo():
+    # Carritos guardados por versiones del front que no mandaban color
+    carrito = [dict(CARRITO[0], color=""), CARRITO[1]]
+    lineas = armar_lineas_orden(completar_items_mp(ITEMS_MP, carrito), PRODUCTOS)
+
+    assert lineas[0]["talle"] == "M"
+    assert lineas[0]["variante_key"] == "M_Rojo"
+
+
+def test_listas_desalineadas_se_emparejan_por_titulo():
+    items = completar_items_mp(list(reversed(ITEMS_MP)), CARRITO[:1])
+
+    assert items[0].get("id_base") is None
+    assert (items[1]["id_base"], items[1]["talle"], items[1]["color"]) == ("remera", "M", "Azul")
+
+
+def test_talle_desde_titulo_armado_por_pagar():
+    items = [{"title": "Remera (Talle: L, Color: Rojo)", "quantity": 1, "unit_price": 1000, "id_base": "remera"}]
+
+    assert armar_lineas_orden(items, PRODUCTOS)[0]["variante_key"] == "L_Rojo"
@@ -0,0 +1,74 @@
+from ordenes import completar_items_mp
+from precios import cargar_productos, cotizar_carrito, precio_numerico
+
+EMAIL = "tienda@ejemplo.com"
+
+
+def _producto(db, id_base, datos):
+    db.collection("usuarios").document(EMAIL).collection("productos").document(id_base).set(
+        {"nombre": id_base.title(), "precio": "$1.000", **datos})
+
+
+def _variantes(*pares):
+    return {"tiene_variantes": True, "variantes": {
+        f"{talle}_{color}": {"talle": talle, "color": color, "stock": stock} for talle, color, stock in pares
+    }}
+
+
+def _cotizar(db, items):
+    return cotizar_carrito(cargar_productos(db, EMAIL, [i.get("id_base") for i in items]), items)
+
+
+def test_precio_numerico_en_texto():
+    assert precio_numerico("$12.500") == 12500.0
+    assert precio_numerico("12500,50") == 12500.5
+    assert precio_numerico(None) == 0.0
+
+
+def test_pagar_con_talle_solo_en_el_titulo(db):
+    _producto(db, "remera", _variantes(("M", "Rojo", 2), ("L", "Rojo", 5)))
+
+    cotizacion = _cotizar(db, [{"title": "Remera (M)", "id_base": "remera", "quantity": 1, "unit_price": 1}])
+
+    assert cotizacion["faltantes"] == []
+    assert cotizacion["lineas"][0]["variante_key"] == "M_Rojo"
+    # El precio sale del producto, no del que manda el cliente
+    assert cotizacion["total"] == 1000.0
+
+
+def test_verificar_con_talle_sin_color_controla_el_stock_del_talle(db):
+    _producto(db, "remera", _variantes(("M", "Rojo", 2), ("M", "Azul", 1)))
+
+    assert _cotizar(db, [{"id_base": "remera", "talle": "M", "cantidad": 3}])["faltantes"] == []
+    faltantes = _cotizar(db, [{"id_base": "remera", "talle": "M", "cantidad": 4}])["faltantes"]
+    assert [(f["solicitado"], f["disponible"]) for f in faltantes] == [(4, 3)]
+
+
+def test_verificar_producto_sin_variantes(db):
+    # mercadopago.js manda talle 'unico' cuando el item no tiene talle
+    _producto(db, "gorra", {"stock": 2})
+
+    cotizacion = _cotizar(db, [{"id_base": "gorra", "talle": "unico", "color": "", "cantidad": 2}])
+
+    assert cotizacion["faltantes"] == []
+    assert cotizacion["total"] == 2000.0
+
+
+def test_sin_talle_ni_color_en_producto_con_variantes(db):
+    _producto(db, "remera", _variantes(("M", "Rojo", 2), ("L", "Rojo", 5)))
+
+    faltantes = _cotizar(db, [{"id_base": "remera", "talle": "unico", "cantidad": 1}])["faltantes"]
+
+    assert [f.get("error") for f in faltantes] == ["Elegí talle y color"]
+
+
+def test_payload_de_pagar_con_items_mp_y_carrito(db):
+    _producto(db, "remera", _variantes(("M", "Rojo", 2), ("M", "Azul", 1)))
+    items_mp = [{"title": "Remera (M)", "quantity": 2, "unit_price": 1000, "currency_id": "ARS"}]
+    carrito = [{"nombre": "Remera", "precio": 1000, "cantidad": 2, "talle": "M", "color": "Azul",
+                "id_base": "remera", "grupo": "", "subgrupo": "", "subtotal": 2000}]
+
+    faltantes = _cotizar(db, completar_items_mp(items_mp, carrito))["faltantes"]
+
+    # Con color elegido el control es por variante: de M Azul queda una sola unidad
+    assert [(f["color"], f["solicitado"], f["disponible"]) for f in faltantes] == [("Azul", 2, 1)]
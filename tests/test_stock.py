@@ -0,0 +1,71 @@
+from stock import reservar_stock, leer_reservas_activas, liberar_reservas
+
+EMAIL = "tienda@ejemplo.com"
+
+
+def _producto(db, id_base, stock, talle="M", color="Rojo"):
+    key = f"{talle}_{color}"
+    db.collection("usuarios").document(EMAIL).collection("productos").document(id_base).set({
+        "nombre": id_base.title(),
+        "precio": 1000,
+        "tiene_variantes": True,
+        "variantes": {key: {"talle": talle, "color": color, "stock": stock}}
+    })
+    return key
+
+
+def _linea(id_base, cantidad, talle="M", color="Rojo"):
+    return {"producto_id": id_base, "cantidad": cantidad, "talle": talle, "color": color, "nombre": id_base.title()}
+
+
+def test_reserva_dentro_del_stock(db):
+    _producto(db, "remera", 5)
+
+    assert reservar_stock(db, EMAIL, "ORD1", [_linea("remera", 3)]) == []
+
+    activas = leer_reservas_activas(db, EMAIL, ["remera"])
+    assert [(r["external_ref"], r["cantidad"]) for _, r in activas] == [("ORD1", 3)]
+
+
+def test_la_reserva_posterior_se_queda_con_el_faltante(db):
+    _producto(db, "remera", 5)
+
+    assert reservar_stock(db, EMAIL, "ORD1", [_linea("remera", 3)]) == []
+    faltantes = reservar_stock(db, EMAIL, "ORD2", [_linea("remera", 4)])
+
+    # La primera reserva conserva sus 3 unidades; a la segunda le quedan 2 disponibles
+    assert faltantes == [{
+        "id_base": "remera",
+        "nombre": "Remera",
+        "talle": "M",
+        "color": "Rojo",
+        "solicitado": 4,
+        "disponible": 2
+    }]
+    # La orden con faltantes libera lo que había reservado
+    activas = leer_reservas_activas(db, EMAIL, ["remera"])
+    assert [r["external_ref"] for _, r in activas] == ["ORD1"]
+
+
+def test_lineas_repetidas_de_una_variante_se_suman(db):
+    _producto(db, "remera", 5)
+
+    faltantes = reservar_stock(db, EMAIL, "ORD1", [_linea("remera", 3), _linea("remera", 3)])
+
+    assert [(f["solicitado"], f["disponible"]) for f in faltantes] == [(6, 5)]
+
+
+def test_liberar_devuelve_el_stock_a_las_ordenes_siguientes(db):
+    _producto(db, "remera", 5)
+
+    assert reservar_stock(db, EMAIL, "ORD1", [_linea("remera", 5)]) == []
+    assert reservar_stock(db, EMAIL, "ORD2", [_linea("remera", 1)])[0]["disponible"] == 0
+    assert liberar_reservas(db, EMAIL, "ORD1") == 1
+    assert reservar_stock(db, EMAIL, "ORD3", [_linea("remera", 5)]) == []
+
+
+def test_reservas_vencidas_no_cuentan(db):
+    _producto(db, "remera", 2)
+
+    assert reservar_stock(db, EMAIL, "ORD1", [_linea("remera", 2)], minutos=-1) == []
+    assert reservar_stock(db, EMAIL, "ORD2", [_linea("remera", 2)]) == []
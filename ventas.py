@@ -0,0 +1,122 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+from google.cloud.firestore import SERVER_TIMESTAMP, Increment
+
+# Resúmenes de ventas por vendedor, actualizados con incrementos atómicos al aprobarse cada pago:
+#   usuarios/{email}/ventas/dia_{YYYY-MM-DD}
+#   usuarios/{email}/ventas/mes_{YYYY-MM}
+# El panel lee un puñado de documentos sin importar cuántas órdenes haya.
+VENTAS_COLECCION = "ventas"
+ZONA_VENTAS = timezone(timedelta(hours=int(os.getenv("VENTAS_UTC_OFFSET", "-3"))))
+VENTAS_TOP_PRODUCTOS = int(os.getenv("VENTAS_TOP_PRODUCTOS", "10"))
+
+
+def _ventas_ref(db, email):
+    return db.collection("usuarios").document(email).collection(VENTAS_COLECCION)
+
+
+def fecha_venta(date_approved=None):
+    """Fecha de la venta en la zona del negocio, desde date_approved de MP (o ahora)."""
+    if date_approved:
+        try:
+            return datetime.fromisoformat(str(date_approved).replace("Z", "+00:00")).astimezone(ZONA_VENTAS)
+        except ValueError:
+            pass
+    return datetime.now(ZONA_VENTAS)
+
+
+def registrar_venta(batch, db, email, fecha, total, lineas):
+    """Agrega al batch los incrementos del día y del mes de la venta.
+
+    `lineas` tiene el formato normalizado de la orden (id_base, variante_key, nombre, precio_unitario,
+    cantidad, talle, color). Hay que confirmarlo en el mismo commit que marca la orden como registrada,
+    para que un reintento no cuente dos veces la misma venta.
+    """
+    productos = {}
+    variantes = {}
+    unidades = 0
+    for linea in lineas:
+        id_base = linea.get("id_base")
+        if not id_base:
+            continue
+        cantidad = int(linea.get("cantidad") or 0)
+        ingresos = float(linea.get("precio_unitario") or 0) * cantidad
+        unidades += cantidad
+        producto = productos.setdefault(id_base, {"nombre": linea.get("nombre", ""), "unidades": 0, "ingresos": 0.0})
+        producto["unidades"] += cantidad
+        producto["ingresos"] += ingresos
+        if linea.get("variante_key"):
+            clave = f"{id_base}__{linea['variante_key']}"
+            variante = variantes.setdefault(clave, {
+                "id_base": id_base,
+                "talle": linea.get("talle", ""),
+                "color": linea.get("color", ""),
+                "unidades": 0
+            })
+            variante["unidades"] += cantidad
+
+    datos = {
+        "ingresos": Increment(float(total or 0)),
+        "ordenes": Increment(1),
+        "unidades": Increment(unidades),
+        "productos": {
+            id_base: {"nombre": p["nombre"], "unidades": Increment(p["unidades"]), "ingresos": Increment(p["ingresos"])}
+            for id_base, p in productos.items()
+        },
+        "variantes": {
+            clave: {**{k: v for k, v in var.items() if k != "unidades"}, "unidades": Increment(var["unidades"])}
+            for clave, var in variantes.items()
+        },
+        "actualizado": SERVER_TIMESTAMP
+    }
+    for tipo, periodo in (("dia", fecha.strftime("%Y-%m-%d")), ("mes", fecha.strftime("%Y-%m"))):
+        batch.set(_ventas_ref(db, email).document(f"{tipo}_{periodo}"),
+                  {**datos, "tipo": tipo, "periodo": periodo}, merge=True)
+
+
+def _resumen(periodo, data):
+    return {
+        "periodo": periodo,
+        "ingresos": data.get("ingresos", 0),
+        "ordenes": data.get("ordenes", 0),
+        "unidades": data.get("unidades", 0)
+    }
+
+
+def _mas_vendidos(mapa, limite):
+    return sorted(
+        ({"id": clave, **valores} for clave, valores in (mapa or {}).items()),
+        key=lambda v: -(v.get("unidades") or 0)
+    )[:limite]
+
+
+def leer_resumen_ventas(db, email, dias=30, meses=12, top=VENTAS_TOP_PRODUCTOS):
+    """Ventas de los últimos `dias` días y `meses` meses con un solo get_all de dias + meses documentos.
+
+    Los períodos sin ventas aparecen en cero. Cada mes trae además sus productos y variantes más vendidos.
+    """
+    hoy = datetime.now(ZONA_VENTAS).date()
+    periodos_dia = [(hoy - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(dias - 1, -1, -1)]
+    periodos_mes = []
+    anio, mes = hoy.year, hoy.month
+    for _ in range(meses):
+        periodos_mes.append(f"{anio:04d}-{mes:02d}")
+        anio, mes = (anio, mes - 1) if mes > 1 else (anio - 1, 12)
+    periodos_mes.reverse()
+
+    ventas_ref = _ventas_ref(db, email)
+    refs = [ventas_ref.document(f"dia_{p}") for p in periodos_dia] + [ventas_ref.document(f"mes_{p}") for p in periodos_mes]
+    docs = {snap.id: snap.to_dict() or {} for snap in db.get_all(refs) if snap.exists}
+
+    return {
+        "dias": [_resumen(p, docs.get(f"dia_{p}", {})) for p in periodos_dia],
+        "meses": [
+            {
+                **_resumen(p, docs.get(f"mes_{p}", {})),
+                "productos": _mas_vendidos(docs.get(f"mes_{p}", {}).get("productos"), top),
+                "variantes": _mas_vendidos(docs.get(f"mes_{p}", {}).get("variantes"), top)
+            }
+            for p in periodos_mes
+        ]
+    }